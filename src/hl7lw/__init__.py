@@ -1,4 +1,11 @@
 from .exceptions import *
 from .parser import Hl7Field, Hl7Message, Hl7Segment, Hl7Parser
-from .mllp import MllpClient, MllpServer
+from .mllp import MllpClient, MllpServer, MllpConnectionPool, MllpStoreAndForward, AckPolicy
+from .template import Hl7Template
+from .aio import AsyncMllpClient, AsyncMllpServer
+from . import dedup
+from . import ids
+from . import journal
+from . import metrics
+from . import routing
 from . import utils
\ No newline at end of file
@@ -0,0 +1,243 @@
+from __future__ import annotations
+import asyncio
+import inspect
+import traceback
+from typing import Optional, Callable, Union, Awaitable
+
+from .exceptions import MllpConnectionError, MllpMessageTooLarge
+from .mllp import START_BYTE, END_BYTES, BUFSIZE, AckPolicy, MllpFrameDecoder, make_ack
+from .utils import Acks
+
+
+class AsyncMllpClient:
+    """
+    asyncio version of `MllpClient`, with the same framing and the same limits.
+
+    ```
+    c = AsyncMllpClient()
+    await c.connect(host="127.0.0.1", port=1234)
+    await c.send(message)
+    ack = await c.recv()
+    await c.close()
+    ```
+    """
+    def __init__(self, bufsize: int = BUFSIZE) -> None:
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.connected: bool = False
+        self.host: Optional[str] = None
+        self.port: Optional[int] = None
+        self.bufsize = bufsize
+        self.decoder = MllpFrameDecoder()
+
+    def is_connected(self) -> bool:
+        """
+        Used to check if connected.
+        """
+        return self.connected
+
+    async def _reset(self) -> None:
+        self.connected = False
+        self.decoder.clear()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass  # Already broken, which is why we are closing.
+
+    async def close(self) -> None:
+        """
+        Close the connection, also resets the internal state.
+
+        Raises an `MllpConnectionError` if called on a closed connection.
+        """
+        if not self.connected:
+            raise MllpConnectionError("Not connected!")
+        await self._reset()
+
+    async def connect(self, host: str, port: int) -> None:
+        """
+        Connect to an `host` and `port`, closing the previous connection if there's
+        one. Network related exceptions will get wrapped into an `MllpConnectionError`.
+        """
+        self.host = host
+        self.port = port
+        if self.connected:
+            await self._reset()
+        try:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        except asyncio.TimeoutError as e:
+            raise MllpConnectionError(f"Timed out trying to connect to {host}:{port}") from e
+        except OSError as e:
+            raise MllpConnectionError(f"Failed to connect to {host}:{port}") from e
+        self.connected = True
+
+    async def send(self, message: bytes, auto_reconnect: bool = True) -> None:
+        """
+        Send a `message` over the connection, see `MllpClient.send()`.
+
+        The coroutine completes once the message has been handed to the transport,
+        waiting for the transport's buffer to drain if needed.
+        """
+        if not self.connected:
+            if auto_reconnect:
+                if self.host is None or self.port is None:
+                    raise MllpConnectionError("No host configured!")
+                await self.connect(host=self.host, port=self.port)
+            else:
+                raise MllpConnectionError("Not connected!")
+        try:
+            self.writer.write(START_BYTE + message + END_BYTES)
+            await self.writer.drain()
+        except Exception as e:
+            await self._reset()
+            raise MllpConnectionError("Failed to send message to client.") from e
+
+    async def recv(self) -> bytes:
+        """
+        Receive a message from the connection, see `MllpClient.recv()`.
+        """
+        if not self.connected:
+            raise MllpConnectionError("Not connected!")
+        message = self.decoder.next_frame()
+        while message is None:
+            try:
+                data = await self.reader.read(self.bufsize)
+            except Exception as e:
+                await self._reset()
+                raise MllpConnectionError("Failed to read from socket, closing it.") from e
+            if not data:
+                await self._reset()
+                raise MllpConnectionError("Connection closed by the other side.")
+            self.decoder.feed(data)
+            try:
+                message = self.decoder.next_frame()
+            except MllpMessageTooLarge:
+                await self._reset()
+                raise
+        return message
+
+
+AsyncCallback = Callable[[bytes], Union[None, bytes, Acks, Awaitable[Union[None, bytes, Acks]]]]
+
+
+class AsyncMllpServer:
+    """
+    asyncio version of `MllpServer`. The `callback` can be a coroutine function
+    (`async def`) or a plain function, and can return the same things as for
+    `MllpServer`, including when `auto_ack` is used.
+
+    ```
+    async def callback(message: bytes) -> Optional[Acks]:
+        await save_to_database(message)
+        return Acks.AA
+
+    server = AsyncMllpServer(port=1234, callback=callback, auto_ack=AckPolicy.AfterCallback)
+    await server.serve_forever()
+    ```
+
+    Messages of a connection are processed one after the other, in order, while
+    the connections are served concurrently. As with `MllpServer`, an exception
+    raised by the callback is not handled, but here it only kills the connection
+    the message came from. With `AckPolicy.AfterCallback`, the message gets an AE
+    instead and the connection carries on, like with `MllpServer`.
+    """
+    def __init__(self,
+                 port: int,
+                 callback: AsyncCallback,
+                 auto_ack: Optional[AckPolicy] = None,
+                 ack_encoding: str = 'ascii',
+                 host: Optional[str] = None) -> None:
+        """
+        Initialize the server configuration, see `MllpServer`. If `host` is `None`,
+        the server listens on all interfaces.
+        """
+        self.port = port
+        self.host = host
+        self.callback = callback
+        self.auto_ack = auto_ack
+        self.ack_encoding = ack_encoding
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        """
+        Start listening. Like `MllpServer.listen()`, `self.port` is updated with
+        the actual port, which matters when binding to port 0.
+        """
+        if self.server is None:
+            self.server = await asyncio.start_server(self.handle_connection, host=self.host, port=self.port)
+            self.port = self.server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self) -> None:
+        """
+        Start listening if not already done and serve until cancelled or `close()`d.
+        """
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            # close() cancels serve_forever() and that's a normal return, but being
+            # cancelled from the outside still has to propagate.
+            if self.server is not None:
+                raise
+
+    async def close(self) -> None:
+        """
+        Stop listening. Connections already opened are left to finish.
+        """
+        if self.server is not None:
+            server = self.server
+            self.server = None
+            server.close()
+            await server.wait_closed()
+
+    async def run_callback(self, message: bytes) -> Union[None, bytes, Acks]:
+        try:
+            result = self.callback(message)
+            if inspect.isawaitable(result):
+                result = await result
+        except Exception as e:
+            result = self.callback_failed(e)
+        return result
+
+    def callback_failed(self, error: Exception) -> Acks:
+        """
+        See `MllpServer.callback_failed()`.
+        """
+        if self.auto_ack is not AckPolicy.AfterCallback:
+            raise error
+        traceback.print_exception(type(error), error, error.__traceback__)
+        return Acks.AE
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        decoder = MllpFrameDecoder()
+        try:
+            while True:
+                data = await reader.read(BUFSIZE)
+                if not data:
+                    return
+                decoder.feed(data)
+                while True:
+                    message = decoder.next_frame()
+                    if message is None:
+                        break
+                    if self.auto_ack is AckPolicy.OnReceipt:
+                        ack = make_ack(message, None, self.auto_ack, self.ack_encoding)
+                        if ack is not None:
+                            writer.write(START_BYTE + ack + END_BYTES)
+                            await writer.drain()
+                        await self.run_callback(message)
+                    else:
+                        result = await self.run_callback(message)
+                        ack = make_ack(message, result, self.auto_ack, self.ack_encoding)
+                        if ack is not None:
+                            writer.write(START_BYTE + ack + END_BYTES)
+                            await writer.drain()
+        except (MllpMessageTooLarge, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()  # Lets the transport flush what's left.
+            except (ConnectionError, OSError):
+                pass
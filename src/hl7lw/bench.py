@@ -0,0 +1,369 @@
+"""
+MLLP load generator and latency benchmark.
+
+Starts a local `MllpServer`, or targets an existing listener with `--host` and
+`--port`, and drives it with concurrent `MllpClient` connections. Reports the
+throughput, the ACK latency percentiles and the CPU and memory used, as text or
+as JSON with `--json` to compare builds.
+
+```
+python -m hl7lw.bench --connections 8 --messages 100000 --pipeline 16
+python -m hl7lw.bench --host ris --port 2575 --rate 500 --duration 60 --json
+```
+
+The corpus is made of the files given with `--corpus`, one message per file, or
+directories of such files. Without it, a small ADT^A08 is used. Messages are
+sent in turn, round robin.
+
+With `--rate`, sends are scheduled at fixed times and the latency is measured
+from the scheduled time, so a stalled receiver shows up in the latency rather
+than being hidden by sending less (coordinated omission).
+"""
+from __future__ import annotations
+from typing import Optional
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from .exceptions import MllpException
+from .mllp import MllpClient, MllpPipeline, MllpServer, AckPolicy
+
+
+DEFAULT_MESSAGE = (b"MSH|^~\\&|BENCH|HL7LW|RECEIVER|HL7LW|20240101120000||ADT^A08|1|P|2.5\r"
+                   b"EVN|A08|20240101120000\r"
+                   b"PID|1||123456^^^HOSP^MR||DOE^JOHN^Q||19700101|M|||1 MAIN ST^^TOWN^ST^12345\r"
+                   b"PV1|1|I|WARD^101^1|||||||MED\r")
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def load_corpus(paths: list[str]) -> list[bytes]:
+    """
+    Read the messages from `paths`, files or directories of files. Line feeds
+    are turned into carriage returns since corpora are often edited as text.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if os.path.isfile(os.path.join(path, name)))
+        else:
+            files.append(path)
+    messages = []
+    for name in files:
+        with open(name, 'rb') as f:
+            message = f.read().replace(b'\r\n', b'\r').replace(b'\n', b'\r')
+        if message:
+            messages.append(message if message.endswith(b'\r') else message + b'\r')
+    if not messages:
+        raise ValueError("The corpus is empty.")
+    return messages
+
+
+def percentile(ordered: list[float], p: float) -> Optional[float]:
+    """
+    Nearest-rank percentile of the already sorted `ordered`.
+    """
+    if not ordered:
+        return None
+    rank = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def serve(port_queue, stop_event) -> None:
+    """
+    Run an auto-acknowledging `MllpServer` on a free port until `stop_event` is
+    set. Meant to be the target of a separate process or thread.
+    """
+    server = MllpServer(0, lambda message: None, auto_ack=AckPolicy.AfterCallback)
+    server.listen()
+    port_queue.put(server.port)
+    threading.Thread(target=lambda: (stop_event.wait(), server.shutdown()), daemon=True).start()
+    server.serve_forever()
+
+
+class Connection:
+    """
+    One client connection of the benchmark, run in its own thread.
+    """
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 messages: list[bytes],
+                 count: Optional[int],
+                 deadline: Optional[float],
+                 rate: Optional[float],
+                 pipeline: int,
+                 offset: int) -> None:
+        self.host = host
+        self.port = port
+        self.messages = messages
+        self.count = count
+        self.deadline = deadline
+        self.rate = rate
+        self.pipeline = pipeline
+        self.offset = offset  # Spreads the connections over the corpus.
+        self.latencies: list[float] = []
+        self.sent = 0
+        self.bytes_sent = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def _next(self, start: float) -> Optional[tuple[bytes, float]]:
+        # The message to send and when it should be sent, or None when done.
+        if self.count is not None and self.sent >= self.count:
+            return None
+        scheduled = time.perf_counter()
+        if self.rate is not None:
+            # Drift-free, the schedule does not depend on when sends actually happened.
+            scheduled = start + self.sent / self.rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            return None
+        message = self.messages[(self.offset + self.sent) % len(self.messages)]
+        self.sent += 1
+        self.bytes_sent += len(message)
+        return message, scheduled
+
+    def run(self) -> None:
+        client = MllpClient()
+        try:
+            client.connect(host=self.host, port=self.port)
+        except MllpException:
+            self.errors += 1
+            return
+        start = time.perf_counter()
+        try:
+            if self.pipeline <= 1:
+                self._run_lockstep(client, start)
+            else:
+                self._run_pipelined(client, start)
+        finally:
+            if client.is_connected():
+                client.close()
+
+    def _run_lockstep(self, client: MllpClient, start: float) -> None:
+        while True:
+            item = self._next(start)
+            if item is None:
+                return
+            message, scheduled = item
+            try:
+                client.send(message)
+                client.recv()
+            except MllpException:
+                self.errors += 1
+                continue  # send() reconnects.
+            self.latencies.append(time.perf_counter() - scheduled)
+
+    def _run_pipelined(self, client: MllpClient, start: float) -> None:
+        # FIFO matching so the corpus doesn't need unique MSH-10.
+        pipeline = MllpPipeline(client, window=self.pipeline, match_by_id=False)
+
+        def done(future, scheduled):
+            with self._lock:
+                if future.cancelled() or future.exception() is not None:
+                    self.errors += 1
+                else:
+                    self.latencies.append(time.perf_counter() - scheduled)
+
+        try:
+            while True:
+                item = self._next(start)
+                if item is None:
+                    break
+                message, scheduled = item
+                pipeline.submit(message, callback=lambda f, s=scheduled: done(f, s))
+        except MllpException:
+            with self._lock:  # Also updated by done(), from the reader thread.
+                self.errors += 1
+        finally:
+            pipeline.close()
+
+
+def cpu_and_memory(children: bool = True) -> dict:
+    """
+    CPU seconds and peak RSS of this process and, with `children`, of its
+    waited-for children.
+    """
+    if resource is None:
+        return {}
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS.
+    scale = 1 if sys.platform == 'darwin' else 1024
+    report = {
+        'cpu_user_seconds': usage.ru_utime,
+        'cpu_system_seconds': usage.ru_stime,
+        'max_rss_bytes': usage.ru_maxrss * scale,
+    }
+    if children:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        report.update({
+            'children_cpu_user_seconds': usage.ru_utime,
+            'children_cpu_system_seconds': usage.ru_stime,
+            'children_max_rss_bytes': usage.ru_maxrss * scale,
+        })
+    return report
+
+
+def run(connections: int = 4,
+        messages: Optional[int] = 10000,
+        duration: Optional[float] = None,
+        rate: Optional[float] = None,
+        pipeline: int = 1,
+        corpus: Optional[list[bytes]] = None,
+        host: Optional[str] = None,
+        port: Optional[int] = None,
+        server_mode: str = 'process') -> dict:
+    """
+    Run a benchmark and return the report as a `dict`. Either a total number of
+    `messages` or a `duration` in seconds must be given, `rate` is the total
+    target rate in messages per second, split evenly across the connections.
+    """
+    if corpus is None:
+        corpus = [DEFAULT_MESSAGE]
+    if messages is None and duration is None:
+        raise ValueError("Either messages or duration is needed.")
+    stop = None
+    server = None
+    if host is None:
+        if server_mode == 'process':
+            port_queue = multiprocessing.Queue()
+            stop = multiprocessing.Event()
+            server = multiprocessing.Process(target=serve, args=(port_queue, stop), daemon=True)
+        else:
+            import queue
+            port_queue = queue.Queue()
+            stop = threading.Event()
+            server = threading.Thread(target=serve, args=(port_queue, stop), daemon=True)
+        server.start()
+        host, port = '127.0.0.1', port_queue.get(timeout=10)
+
+    counts = [None] * connections
+    if messages is not None:
+        counts = [messages // connections + (1 if i < messages % connections else 0)
+                  for i in range(connections)]
+    per_connection_rate = None if rate is None else rate / connections
+    started = time.perf_counter()
+    deadline = None if duration is None else started + duration
+    workers = [Connection(host, port, corpus, counts[i], deadline, per_connection_rate, pipeline, i)
+               for i in range(connections)]
+    threads = [threading.Thread(target=w.run, daemon=True) for w in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    if server is not None:
+        stop.set()
+        server.join(timeout=10)
+
+    latencies = sorted(latency for w in workers for latency in w.latencies)
+    acked = len(latencies)
+    report = {
+        'target': f"{host}:{port}",
+        'local_server': server_mode if server is not None else None,
+        'connections': connections,
+        'pipeline': pipeline,
+        'target_rate': rate,
+        'corpus_size': len(corpus),
+        'sent': sum(w.sent for w in workers),
+        'acked': acked,
+        'errors': sum(w.errors for w in workers),
+        'elapsed_seconds': elapsed,
+        'throughput_per_second': acked / elapsed if elapsed else 0.0,
+        'throughput_bytes_per_second': sum(w.bytes_sent for w in workers) / elapsed if elapsed else 0.0,
+        'latency_seconds': {
+            'min': latencies[0] if latencies else None,
+            'mean': sum(latencies) / acked if latencies else None,
+            **{f"p{p:g}": percentile(latencies, p) for p in PERCENTILES},
+            'max': latencies[-1] if latencies else None,
+        },
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
+    # The children are only the server process, a server thread is counted with
+    # the clients and an external one isn't measured.
+    report.update(cpu_and_memory(children=server is not None and server_mode == 'process'))
+    return report
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"target           {report['target']} (local server: {report['local_server']})",
+        f"connections      {report['connections']}, pipeline {report['pipeline']}, "
+        f"target rate {report['target_rate']}",
+        f"messages         {report['sent']} sent, {report['acked']} acked, {report['errors']} errors",
+        f"elapsed          {report['elapsed_seconds']:.3f} s",
+        f"throughput       {report['throughput_per_second']:.1f} msg/s, "
+        f"{report['throughput_bytes_per_second'] / 1024 / 1024:.2f} MiB/s",
+    ]
+    latency = report['latency_seconds']
+    if latency['min'] is not None:
+        lines.append("latency (ms)     " + ", ".join(f"{name} {value * 1000:.3f}"
+                                                     for name, value in latency.items()))
+    if 'cpu_user_seconds' in report:
+        cpu = (f"cpu              {report['cpu_user_seconds']:.2f} s user, "
+               f"{report['cpu_system_seconds']:.2f} s system")
+        rss = f"max rss          {report['max_rss_bytes'] / 1024 / 1024:.1f} MiB"
+        if 'children_cpu_user_seconds' in report:
+            cpu += (f" (server process {report['children_cpu_user_seconds']:.2f} s user, "
+                    f"{report['children_cpu_system_seconds']:.2f} s system)")
+            rss += f" (server process {report['children_max_rss_bytes'] / 1024 / 1024:.1f} MiB)"
+        lines.append(cpu)
+        lines.append(rss)
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m hl7lw.bench', description="MLLP load generator.")
+    parser.add_argument('--host', help="Target this listener instead of starting a local server.")
+    parser.add_argument('--port', type=int, help="Port of the listener given with --host.")
+    parser.add_argument('--server', choices=('process', 'thread'), default='process',
+                        help="Run the local server in a separate process (default) or a thread.")
+    parser.add_argument('-c', '--connections', type=int, default=4, help="Concurrent connections.")
+    limit = parser.add_mutually_exclusive_group()
+    limit.add_argument('-n', '--messages', type=int, help="Total messages to send (default 10000).")
+    limit.add_argument('-d', '--duration', type=float, help="Send for this many seconds instead.")
+    parser.add_argument('-r', '--rate', type=float, help="Target total rate in messages per second.")
+    parser.add_argument('-p', '--pipeline', type=int, default=1,
+                        help="Messages in flight per connection, 1 waits for each ACK.")
+    parser.add_argument('--corpus', nargs='+', default=[],
+                        help="Message files, or directories of message files.")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON.")
+    args = parser.parse_args(argv)
+    if (args.host is None) != (args.port is None):
+        parser.error("--host and --port go together.")
+    if args.messages is None and args.duration is None:
+        args.messages = 10000
+    report = run(connections=args.connections,
+                 messages=args.messages,
+                 duration=args.duration,
+                 rate=args.rate,
+                 pipeline=args.pipeline,
+                 corpus=load_corpus(args.corpus) if args.corpus else None,
+                 host=args.host,
+                 port=args.port,
+                 server_mode=args.server)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+    return 0 if report['errors'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
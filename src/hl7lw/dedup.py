@@ -0,0 +1,163 @@
+from __future__ import annotations
+from collections import OrderedDict
+from typing import BinaryIO, Callable, Optional, Union
+import hashlib
+import threading
+import time
+
+from .exceptions import Hl7Exception
+from .utils import Acks, peek_msh, peek_msa
+
+
+HEADER = 'header'
+CONTENT = 'content'
+DIGEST_SIZE = 16
+COPY_SIZE = 64 * 1024
+ACCEPTED = (Acks.AA.name, Acks.CA.name)
+
+
+class DedupCache:
+    """
+    Remembers the ACKs of the messages received recently, so a message sent again
+    by a client that missed its ACK can be answered with the same ACK instead of
+    being processed twice. Pass it as `dedup` to an `MllpServer`.
+
+    ```
+    server = MllpServer(port=2575, callback=callback, auto_ack=AckPolicy.AfterCallback,
+                        dedup=DedupCache(max_size=1_000_000, ttl=3600))
+    ```
+
+    Messages are identified by `key`:
+
+    `"header"` -- MSH-3, MSH-4 and MSH-10, the sending application and facility and
+                  the message control ID. Only the header is read. Messages with an
+                  empty MSH-10 are never considered duplicates.
+
+    `"content"` -- The whole message, byte for byte.
+
+    The identity is stored as a 16 bytes BLAKE2b digest, never the message itself.
+    At most `max_size` entries are kept, the least recently used ones are evicted
+    first, and an entry is forgotten `ttl` seconds after it was added, `None` for
+    no expiry. ACKs generated by the server from an `Acks` code are stored as the
+    code alone and generated again for the duplicate, an entry then costs about
+    250 bytes whatever the message size. ACKs returned as `bytes` by the callback
+    are stored as-is, on top of that.
+
+    Only accepted messages, with an AA or CA ACK, are remembered. A message that
+    was rejected or failed is processed again if it's sent again. A duplicate
+    arriving before the ACK of the first copy was decided, like when a callback
+    runs in an executor, is processed again as well.
+    """
+    def __init__(self,
+                 max_size: int = 100000,
+                 ttl: Optional[float] = 3600.0,
+                 key: str = HEADER,
+                 encoding: str = 'ascii',
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        if key not in (HEADER, CONTENT):
+            raise ValueError(f"Unknown key {key!r}, expected {HEADER!r} or {CONTENT!r}.")
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1.")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.key = key
+        self.encoding = encoding
+        self.clock = clock
+        self.hits = 0
+        self._entries: OrderedDict[bytes, tuple[float, Union[Acks, bytes]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def digest(self, message: Union[bytes, memoryview, BinaryIO]) -> Optional[bytes]:
+        """
+        Returns the identity of `message`, or `None` if it has none and can't be
+        deduplicated.
+        """
+        h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        if self.key == CONTENT:
+            if isinstance(message, (bytes, bytearray, memoryview)):
+                h.update(message)
+            else:
+                # A spilled frame, the file position is kept.
+                position = message.tell()
+                message.seek(0)
+                for chunk in iter(lambda: message.read(COPY_SIZE), b''):
+                    h.update(chunk)
+                message.seek(position)
+            return h.digest()
+        if not isinstance(message, (bytes, bytearray, memoryview)):
+            position = message.tell()
+            message.seek(0)
+            head = message.read(COPY_SIZE)  # Plenty for the MSH.
+            message.seek(position)
+            message = head
+        try:
+            msh = peek_msh(message, encoding=self.encoding)
+            sender, facility, control_id = msh[3], msh[4], msh[10]
+        except (Hl7Exception, UnicodeDecodeError):
+            return None
+        if not control_id:
+            return None
+        for field in (sender, facility, control_id):
+            h.update(field.encode('utf-8'))
+            h.update(b'\0')
+        return h.digest()
+
+    def get(self, digest: bytes) -> Union[None, Acks, bytes]:
+        """
+        Returns what was stored for `digest` with `put()`, if it's still there.
+        """
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            expires, ack = entry
+            if expires < self.clock():
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return ack
+
+    def put(self, digest: bytes, ack: Union[Acks, bytes]) -> None:
+        """
+        Remember the `ack` of the message identified by `digest`, an `Acks` code or
+        the `bytes` of the ACK.
+        """
+        now = self.clock()
+        expires = float('inf') if self.ttl is None else now + self.ttl
+        with self._lock:
+            self._entries[digest] = (expires, ack)
+            self._entries.move_to_end(digest)
+            # The least recently used entries are the most likely to be expired.
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if len(self._entries) <= self.max_size and oldest[0] >= now:
+                    break
+                self._entries.popitem(last=False)
+
+    def remember(self, digest: Optional[bytes], result: Union[None, bytes, Acks], ack: Optional[bytes]) -> None:
+        """
+        Called by `MllpServer` with the `ack` sent for the message identified by
+        `digest`, and `result` the callback's return value. Only accepted messages
+        are remembered.
+        """
+        if digest is None or ack is None:
+            return
+        try:
+            code = peek_msa(ack, encoding=self.encoding)[1]
+        except (Hl7Exception, UnicodeDecodeError):
+            return
+        if code not in ACCEPTED:
+            return
+        # Generated ACKs can be generated again, for the header of the duplicate.
+        self.put(digest, ack if isinstance(result, bytes) else Acks[code])
+
+    def clear(self) -> None:
+        """
+        Forget everything.
+        """
+        with self._lock:
+            self._entries.clear()
@@ -34,5 +34,25 @@ class MllpConnectionError(MllpException):
     pass
 
 
+class MllpMessageTooLarge(MllpConnectionError):
+    pass
+
+
 class MllpServerError(MllpException):
     pass
+
+
+class MllpAckTimeout(MllpException):
+    pass
+
+
+class InvalidHl7Template(Hl7Exception):
+    pass
+
+
+class MllpPoolExhausted(MllpConnectionError):
+    pass
+
+
+class JournalError(Exception):
+    pass
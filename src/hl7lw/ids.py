@@ -0,0 +1,178 @@
+from typing import Callable, Optional
+import datetime
+import hashlib
+import os
+import random
+import socket
+import threading
+import time
+
+
+DIGITS = "0123456789"
+BASE36 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+MSH_10_MAX_LENGTH = 20  # ST(20) in the 2.x specs.
+SNOWFLAKE_EPOCH = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def default_node_id(node_bits: int) -> int:
+    """
+    Node ID of the current process for a `SnowflakeIdGenerator`, a hash of the
+    host name and the process ID folded into `node_bits`.
+    """
+    identity = f"{socket.gethostname()}:{os.getpid()}".encode('utf-8')
+    digest = hashlib.blake2b(identity, digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % (2 ** node_bits)
+
+
+class MessageIdGenerator:
+    """
+    Base class for message control ID generators, suitable for MSH-10.
+
+    A generator is simply a callable returning a new ID as a `str` on every call,
+    anything with that signature can be used where a generator is expected. This
+    class is there to document the contract and for the `max_length` attribute
+    which is the longest ID the generator will produce.
+    """
+    max_length: int = MSH_10_MAX_LENGTH
+
+    def __call__(self) -> str:
+        raise NotImplementedError()
+
+
+class TimestampRandomIdGenerator(MessageIdGenerator):
+    """
+    The original ID generator, a second resolution timestamp followed by 6 random
+    digits.
+
+    This generator is not suitable for very high volume message generation as it
+    generates only 1 million possible ID for a given second and with the birthday
+    paradox, you would expect a collision after 1178 messages, 50% of the time.
+    """
+    def __call__(self) -> str:
+        return f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}{random.randint(0, 999999):06d}"
+
+
+class SnowflakeIdGenerator(MessageIdGenerator):
+    """
+    Snowflake style generator. Every ID is made of a millisecond timestamp, a node
+    ID and a sequence number, packed together in an integer and written out with
+    a fixed width in `alphabet`, so IDs from one generator sort in generation order.
+
+    IDs are unique within a node, across threads, at up to `2 ** sequence_bits` IDs
+    per millisecond (4 million per second by default). When the sequence runs out
+    or the clock goes backward, the generator borrows from the next millisecond
+    rather than ever repeating itself.
+
+    The node ID defaults to a hash of the host name and the process ID, see
+    `default_node_id()`, and is recomputed in forked children. Process IDs don't
+    fit in the node bits, so two processes can end up on the same node, with odds
+    of about `n ** 2 / 2 ** (node_bits + 1)` for `n` processes, and would then
+    only repeat an ID if they generate one in the same millisecond with the same
+    sequence number. For a guarantee, give every process its own `node_id`.
+
+    The defaults produce 20 decimal digits, the MSH-10 limit. For a shorter limit,
+    use a larger alphabet, like `BASE36` which fits in 13 characters:
+
+    ```
+    g = SnowflakeIdGenerator(max_length=16, alphabet=BASE36)
+    msh[10] = g()
+    ```
+
+    A `ValueError` is raised if the ID does not leave enough room for the timestamp
+    to last at least 30 years.
+    """
+    def __init__(self,
+                 node_id: Optional[int] = None,
+                 max_length: int = MSH_10_MAX_LENGTH,
+                 alphabet: str = DIGITS,
+                 node_bits: int = 14,
+                 sequence_bits: int = 12,
+                 epoch: datetime.datetime = SNOWFLAKE_EPOCH) -> None:
+        if len(alphabet) < 2 or len(set(alphabet)) != len(alphabet):
+            raise ValueError("The alphabet needs at least 2 distinct characters.")
+        total_bits = (len(alphabet) ** max_length).bit_length() - 1
+        timestamp_bits = total_bits - node_bits - sequence_bits
+        if timestamp_bits < 40:
+            raise ValueError(f"{max_length} characters of a base {len(alphabet)} alphabet only leave "
+                             f"{timestamp_bits} bits for the timestamp, at least 40 are needed.")
+        if node_id is not None and not 0 <= node_id < 2 ** node_bits:
+            raise ValueError(f"node_id must be between 0 and {2 ** node_bits - 1}")
+        self.max_length = max_length
+        self.alphabet = alphabet
+        self.node_bits = node_bits
+        self.sequence_bits = sequence_bits
+        self.epoch_ms = int(epoch.timestamp() * 1000)
+        self.explicit_node_id = node_id
+        self._timestamp_mask = 2 ** timestamp_bits - 1
+        self._max_sequence = 2 ** sequence_bits - 1
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self._pid = os.getpid()
+        if self.explicit_node_id is None:
+            self.node_id = default_node_id(self.node_bits)
+        else:
+            self.node_id = self.explicit_node_id
+        self._last_timestamp = -1
+        self._sequence = 0
+
+    def next_value(self) -> int:
+        """
+        Returns the next ID as an integer, before it's written out.
+        """
+        if os.getpid() != self._pid:
+            # Forked, the state and possibly the lock belong to the parent.
+            self._lock = threading.Lock()
+            self._reset()
+        with self._lock:
+            now = time.time_ns() // 1000000 - self.epoch_ms
+            if now > self._last_timestamp:
+                self._last_timestamp = now
+                self._sequence = 0
+            else:
+                self._sequence += 1
+                if self._sequence > self._max_sequence:
+                    self._last_timestamp += 1
+                    self._sequence = 0
+            timestamp = self._last_timestamp
+            sequence = self._sequence
+        return ((((timestamp & self._timestamp_mask) << self.node_bits) | self.node_id)
+                << self.sequence_bits) | sequence
+
+    def __call__(self) -> str:
+        value = self.next_value()
+        if self.alphabet == DIGITS:
+            return f"{value:0{self.max_length}d}"
+        base = len(self.alphabet)
+        chars = []
+        while value:
+            value, digit = divmod(value, base)
+            chars.append(self.alphabet[digit])
+        chars.extend(self.alphabet[0] * (self.max_length - len(chars)))
+        return ''.join(reversed(chars))
+
+
+_default_generator: Callable[[], str] = SnowflakeIdGenerator()
+
+
+def get_default_generator() -> Callable[[], str]:
+    """
+    Returns the generator used when none is given to `hl7lw.utils.generate_ack()`,
+    `hl7lw.utils.OrmBuilder` and such.
+    """
+    return _default_generator
+
+
+def set_default_generator(generator: Callable[[], str]) -> None:
+    """
+    Replace the default generator for the whole process. The default is a
+    `SnowflakeIdGenerator` with a derived node ID, giving each process its own
+    `node_id` rules out collisions between processes entirely:
+
+    ```
+    hl7lw.ids.set_default_generator(hl7lw.ids.SnowflakeIdGenerator(node_id=worker_number))
+    ```
+    """
+    global _default_generator
+    _default_generator = generator
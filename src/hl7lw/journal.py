@@ -0,0 +1,389 @@
+from __future__ import annotations
+from typing import BinaryIO, Callable, Iterator, Optional, Union
+import os
+import struct
+import threading
+import zlib
+
+from .exceptions import JournalError
+
+
+SEGMENT_SUFFIX = '.log'
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+HEADER = struct.Struct('<II')  # Payload length, CRC32 of the payload
+COPY_SIZE = 64 * 1024
+
+
+class Journal:
+    """
+    Append-only log of messages on local disk, split in segment files of about
+    `segment_size` bytes in `directory`.
+
+    Every record is addressed by its position, its offset from the start of the
+    journal across all segments, and `append()` returns it. Segments are named
+    after the position of their first record, so a position can be found without
+    any index. Records carry a CRC32, a torn record at the end of the journal,
+    left by a crash in the middle of a write, is cut off when the journal is
+    opened again.
+
+    `append()` only buffers the record, it is durable once `commit()` returns for
+    its position. Commits are grouped, while one thread waits on `os.fsync()` the
+    records appended by others accumulate and the next fsync covers them all. A
+    single threaded writer can do the same by appending a batch of records and
+    calling `sync()` once. With `fsync=False`, commits only flush to the OS.
+
+    ```
+    journal = Journal("/var/spool/hl7/out")
+    position = journal.append(message)
+    journal.commit(position)
+    ```
+
+    Records are read back with a `JournalReader`, see `read()`. A `Journal` is
+    safe to use from many threads, but only one process may write to a directory.
+    """
+    def __init__(self,
+                 directory: str,
+                 segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 fsync: bool = True) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self._cond = threading.Condition()
+        self._syncing = False
+        segments = self.segments()
+        if segments:
+            self.segment_start = segments[-1]
+            self._recover(self.segment_path(self.segment_start))
+            self._file: BinaryIO = open(self.segment_path(self.segment_start), 'ab')
+            self.end = self.segment_start + self._file.tell()
+        else:
+            self.segment_start = 0
+            self.end = 0
+            self._file = self._create_segment(0)
+        self.synced = self.end  # Everything on disk when opening is durable enough.
+        self.closed = False
+
+    def __enter__(self) -> Journal:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def segments(self) -> list[int]:
+        """
+        Start positions of the segments on disk, in order.
+        """
+        return list_segments(self.directory)
+
+    def segment_path(self, start: int) -> str:
+        return segment_path(self.directory, start)
+
+    def _create_segment(self, start: int) -> BinaryIO:
+        f = open(self.segment_path(start), 'ab')
+        if self.fsync:
+            # Make the new file itself durable, not only its content.
+            fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return f
+
+    def _recover(self, path: str) -> None:
+        with open(path, 'rb') as f:
+            valid = 0
+            for _, _, end in _scan(f):
+                valid = end
+            size = f.seek(0, os.SEEK_END)
+        if size != valid:
+            with open(path, 'r+b') as f:
+                f.truncate(valid)
+
+    def append(self, payload: Union[bytes, memoryview, BinaryIO]) -> int:
+        """
+        Buffer `payload` as a new record and return its position. Use `commit()`
+        to wait for it to be durable.
+
+        The `payload` can also be a binary file, read from its current position to
+        the end and copied in chunks, like the spilled frames of an `MllpServer`.
+        The file position is restored afterward.
+        """
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            header = HEADER.pack(len(payload), zlib.crc32(payload))
+            return self._write(header, len(payload), lambda f: f.write(payload))
+        start = payload.tell()
+        crc = 0
+        size = 0
+        for chunk in iter(lambda: payload.read(COPY_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+
+        def copy(f: BinaryIO) -> None:
+            payload.seek(start)
+            for chunk in iter(lambda: payload.read(COPY_SIZE), b''):
+                f.write(chunk)
+            payload.seek(start)
+
+        return self._write(HEADER.pack(size, crc), size, copy)
+
+    def _write(self, header: bytes, size: int, write_payload: Callable[[BinaryIO], None]) -> int:
+        with self._cond:
+            if self.closed:
+                raise JournalError("Journal is closed.")
+            length = len(header) + size
+            if self.end > self.segment_start and self.end - self.segment_start + length > self.segment_size:
+                self._rotate()
+            position = self.end
+            self._file.write(header)
+            write_payload(self._file)
+            self.end += length
+        return position
+
+    def _rotate(self) -> None:
+        # Must hold the lock. The old segment is made durable before moving on
+        # since the group commit only ever syncs the current segment.
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self.segment_start = self.end
+        self._file = self._create_segment(self.segment_start)
+
+    def commit(self, position: Optional[int] = None) -> None:
+        """
+        Block until the record at `position`, and everything before it, is on disk.
+        Without a `position`, everything appended so far is committed.
+        """
+        with self._cond:
+            target = self.end if position is None else position + 1
+            while self.synced < target:
+                if self._syncing:
+                    self._cond.wait()  # The leader's fsync may well cover us.
+                    continue
+                if self.closed:
+                    raise JournalError("Journal is closed.")
+                self._syncing = True
+                covered = self.end
+                self._file.flush()
+                # A dup stays valid even if the segment is rotated meanwhile.
+                fd = os.dup(self._file.fileno())
+                self._cond.release()
+                try:
+                    if self.fsync:
+                        os.fsync(fd)
+                finally:
+                    os.close(fd)
+                    self._cond.acquire()
+                    self._syncing = False
+                    self._cond.notify_all()
+                self.synced = max(self.synced, covered)
+
+    def sync(self) -> None:
+        """
+        Commit everything appended so far, see `commit()`.
+        """
+        self.commit()
+
+    def read(self, position: int = 0) -> JournalReader:
+        """
+        Returns a reader starting at `position`, which only sees committed records.
+        """
+        return JournalReader(self.directory, position, journal=self)
+
+    def purge(self, position: int) -> int:
+        """
+        Delete the segments holding only records before `position`, typically once
+        they were all consumed. The current segment is never deleted. Returns the
+        number of segments deleted.
+        """
+        segments = self.segments()
+        deleted = 0
+        for start, next_start in zip(segments, segments[1:]):
+            if next_start > position or start == self.segment_start:
+                break
+            os.remove(self.segment_path(start))
+            deleted += 1
+        return deleted
+
+    def close(self) -> None:
+        """
+        Commit everything and close the journal.
+        """
+        if self.closed:
+            return
+        self.commit()
+        with self._cond:
+            self.closed = True
+            self._file.close()
+
+
+class JournalReader:
+    """
+    Reads the records of the journal in `directory` from `position` onward. It can
+    be used from another process than the one writing, it then sees the records
+    as soon as they are flushed to the OS.
+
+    ```
+    reader = JournalReader("/var/spool/hl7/in", cursor.load())
+    for position, message in reader:
+        process(message)
+        cursor.save(reader.position)
+    ```
+
+    Iterating stops at the end of what was written so far, iterate again later to
+    get new records, or use `follow()`. `position` is where the next record will
+    be read from.
+
+    A `JournalError` is raised if the journal is corrupted or if `position` was
+    purged already.
+    """
+    def __init__(self, directory: str, position: int = 0, journal: Optional[Journal] = None) -> None:
+        self.directory = directory
+        self.position = position
+        self.journal = journal
+        self._file: Optional[BinaryIO] = None
+        self.segment_start = -1
+
+    def __enter__(self) -> JournalReader:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __iter__(self) -> Iterator[tuple[int, bytes]]:
+        while True:
+            record = self.next_record()
+            if record is None:
+                return
+            yield record
+
+    def _open(self) -> bool:
+        segments = list_segments(self.directory)
+        candidates = [s for s in segments if s <= self.position]
+        if not candidates:
+            if segments and self.position < segments[0]:
+                raise JournalError(f"Position {self.position} was purged from the journal.")
+            return False
+        if self._file is not None:
+            self._file.close()
+        self.segment_start = candidates[-1]
+        self._file = open(segment_path(self.directory, self.segment_start), 'rb')
+        return True
+
+    def next_record(self) -> Optional[tuple[int, bytes]]:
+        """
+        Returns the next `(position, payload)`, or `None` if there's nothing more
+        to read for now.
+        """
+        if self.journal is not None and self.position >= self.journal.synced:
+            return None
+        if self._file is None and not self._open():
+            return None
+        self._file.seek(self.position - self.segment_start)
+        record = _read_record(self._file)
+        if record is None:
+            # Maybe the end of the segment and the writer moved on to the next one.
+            if self.position == self.segment_start or self.position not in list_segments(self.directory):
+                return None
+            self._open()
+            record = _read_record(self._file)
+            if record is None:
+                return None
+        position = self.position
+        self.position += HEADER.size + len(record)
+        return position, record
+
+    def follow(self, poll_interval: float = 0.5,
+               stop: Optional[threading.Event] = None) -> Iterator[tuple[int, bytes]]:
+        """
+        Like iterating over the reader, but waits for new records instead of
+        stopping at the end, until `stop` is set.
+        """
+        if stop is None:
+            stop = threading.Event()
+        while not stop.is_set():
+            record = self.next_record()
+            if record is None:
+                stop.wait(poll_interval)
+                continue
+            yield record
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class JournalCursor:
+    """
+    Persists a reader's position in the file `path`, so a consumer can resume
+    where it left off. The file is replaced atomically on every `save()`.
+    """
+    def __init__(self, path: str, fsync: bool = False) -> None:
+        self.path = path
+        self.fsync = fsync
+
+    def load(self) -> int:
+        """
+        Returns the saved position, 0 if none was saved yet.
+        """
+        try:
+            with open(self.path, 'r') as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def save(self, position: int) -> None:
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(position))
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+def list_segments(directory: str) -> list[int]:
+    """
+    Start positions of the segments in `directory`, in order.
+    """
+    starts = []
+    for name in os.listdir(directory):
+        stem = name[:-len(SEGMENT_SUFFIX)]
+        if name.endswith(SEGMENT_SUFFIX) and stem.isdigit():
+            starts.append(int(stem))
+    return sorted(starts)
+
+
+def segment_path(directory: str, start: int) -> str:
+    return os.path.join(directory, f"{start:020d}{SEGMENT_SUFFIX}")
+
+
+def _read_record(f: BinaryIO) -> Optional[bytes]:
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    length, crc = HEADER.unpack(header)
+    payload = f.read(length)
+    if len(payload) < length:
+        return None  # Still being written, or torn.
+    if zlib.crc32(payload) != crc:
+        raise JournalError(f"Corrupted record at offset {f.tell() - length - HEADER.size} of {f.name}")
+    return payload
+
+
+def _scan(f: BinaryIO) -> Iterator[tuple[int, bytes, int]]:
+    # (offset, payload, end offset) of the valid records of a segment, stopping at
+    # the first torn or corrupted one.
+    offset = 0
+    while True:
+        try:
+            payload = _read_record(f)
+        except JournalError:
+            return
+        if payload is None:
+            return
+        end = offset + HEADER.size + len(payload)
+        yield offset, payload, end
+        offset = end
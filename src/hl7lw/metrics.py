@@ -0,0 +1,192 @@
+from __future__ import annotations
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Sequence
+import threading
+import time
+
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072,
+                262144, 524288, 1048576, 4194304)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# The metrics reported by the library: name -> (type, help, buckets)
+DEFINITIONS: dict[str, tuple[str, str, Optional[Sequence[float]]]] = {
+    'mllp_server_connections_accepted_total': (COUNTER, "Connections accepted.", None),
+    'mllp_server_connections_open': (GAUGE, "Connections currently open.", None),
+    'mllp_server_connections_rejected_total': (COUNTER, "Connections refused by the connection limits.", None),
+    'mllp_server_idle_timeouts_total': (COUNTER, "Connections closed by the idle timeout.", None),
+    'mllp_server_frame_timeouts_total': (COUNTER, "Connections closed by the frame timeout.", None),
+    'mllp_server_messages_received_total': (COUNTER, "Messages received.", None),
+    'mllp_server_bytes_received_total': (COUNTER, "Bytes read from the network.", None),
+    'mllp_server_frame_size_bytes': (HISTOGRAM, "Size of the messages received.", SIZE_BUCKETS),
+    'mllp_server_callback_seconds': (HISTOGRAM, "Time spent in the callback.", LATENCY_BUCKETS),
+    'mllp_server_callback_errors_total': (COUNTER, "Callbacks that raised, answered with an AE.", None),
+    'mllp_server_messages_sent_total': (COUNTER, "ACKs queued for sending.", None),
+    'mllp_server_bytes_sent_total': (COUNTER, "Bytes written to the network.", None),
+    'mllp_server_write_queue_bytes': (GAUGE, "Bytes waiting to be sent, all connections.", None),
+    'mllp_server_read_pauses_total': (COUNTER, "Times reading was paused by the high water mark.", None),
+    'mllp_server_duplicates_total': (COUNTER, "Duplicates answered from the dedup cache.", None),
+    'mllp_client_messages_sent_total': (COUNTER, "Messages sent.", None),
+    'mllp_client_bytes_sent_total': (COUNTER, "Bytes written to the network.", None),
+    'mllp_client_frame_size_bytes': (HISTOGRAM, "Size of the messages sent.", SIZE_BUCKETS),
+    'mllp_client_messages_received_total': (COUNTER, "Messages (ACKs) received.", None),
+    'mllp_client_bytes_received_total': (COUNTER, "Bytes read from the network.", None),
+    'mllp_client_ack_seconds': (HISTOGRAM, "Time from sending a message to receiving its ACK.",
+                                LATENCY_BUCKETS),
+    'parser_parse_seconds': (HISTOGRAM, "Time spent in Hl7Parser.parse_message().", LATENCY_BUCKETS),
+    'parser_format_seconds': (HISTOGRAM, "Time spent in Hl7Parser.format_message().", LATENCY_BUCKETS),
+    'parser_errors_total': (COUNTER, "Messages that failed to parse.", None),
+}
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed bucket upper bounds, the Prometheus way.
+    """
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[float, int]]:
+        """
+        Returns `(upper bound, count of values <= bound)` for every bucket, the last
+        bound being infinity.
+        """
+        total = 0
+        out = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            out.append((bound, total))
+        return out
+
+
+class Metrics:
+    """
+    Collects counters, gauges and histograms from the MLLP classes and the parser.
+    Pass the same instance as `metrics=` to any `MllpServer`, `MllpClient` or
+    `Hl7Parser` to instrument them, without it they don't pay any cost.
+
+    ```
+    metrics = Metrics()
+    server = MllpServer(port=2575, callback=callback, metrics=metrics)
+    ...
+    text = metrics.render_prometheus()
+    ```
+
+    Every update is also passed to the `sink`, if one is given, as
+    `sink(kind, name, value)` where `kind` is `"counter"`, `"gauge"` or
+    `"histogram"` and `value` is the increment, the new gauge value or the
+    observation. This is the hook to forward to statsd or any other system. The
+    sink is called from whatever thread made the update, outside of any lock.
+
+    Names are reported with `prefix` prepended. See `DEFINITIONS` for the metrics
+    reported by the library, anything else is accepted as well.
+    """
+    def __init__(self,
+                 sink: Optional[Callable[[str, str, float], None]] = None,
+                 prefix: str = 'hl7lw_') -> None:
+        self.sink = sink
+        self.prefix = prefix
+        self.counters: dict[str, float] = {}
+        self.gauges: dict[str, float] = {}
+        self.histograms: dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1) -> None:
+        """
+        Increment the counter `name` by `value`.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.sink is not None:
+            self.sink(COUNTER, self.prefix + name, value)
+
+    def gauge_add(self, name: str, delta: float) -> None:
+        """
+        Move the gauge `name` by `delta`, which can be negative.
+        """
+        with self._lock:
+            value = self.gauges[name] = self.gauges.get(name, 0) + delta
+        if self.sink is not None:
+            self.sink(GAUGE, self.prefix + name, value)
+
+    def gauge_set(self, name: str, value: float) -> None:
+        """
+        Set the gauge `name` to `value`.
+        """
+        with self._lock:
+            self.gauges[name] = value
+        if self.sink is not None:
+            self.sink(GAUGE, self.prefix + name, value)
+
+    def observe(self, name: str, value: float) -> None:
+        """
+        Add `value` to the histogram `name`. The buckets come from `DEFINITIONS`,
+        or `LATENCY_BUCKETS` for names that aren't defined there.
+        """
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                definition = DEFINITIONS.get(name)
+                buckets = definition[2] if definition is not None and definition[2] else LATENCY_BUCKETS
+                histogram = self.histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+        if self.sink is not None:
+            self.sink(HISTOGRAM, self.prefix + name, value)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """
+        Observe the duration of the block, in seconds, into the histogram `name`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def render_prometheus(self) -> str:
+        """
+        Returns all the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            for kind, values in ((COUNTER, self.counters), (GAUGE, self.gauges)):
+                for name in sorted(values):
+                    self._header(lines, name, kind)
+                    lines.append(f"{self.prefix}{name} {_format_number(values[name])}")
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                self._header(lines, name, HISTOGRAM)
+                for bound, count in histogram.cumulative():
+                    lines.append(f'{self.prefix}{name}_bucket{{le="{_format_number(bound)}"}} {count}')
+                lines.append(f"{self.prefix}{name}_sum {_format_number(histogram.sum)}")
+                lines.append(f"{self.prefix}{name}_count {histogram.count}")
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def _header(self, lines: list[str], name: str, kind: str) -> None:
+        definition = DEFINITIONS.get(name)
+        if definition is not None:
+            lines.append(f"# HELP {self.prefix}{name} {definition[1]}")
+        lines.append(f"# TYPE {self.prefix}{name} {kind}")
+
+
+def _format_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
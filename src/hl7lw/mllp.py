@@ -1,14 +1,314 @@
+from __future__ import annotations
+import asyncio
+import heapq
+import inspect
+import itertools
+import os
+import signal
 import socket
-import select
-from typing import Optional, Callable
+import selectors
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Executor, Future
+from enum import Enum
+from tempfile import SpooledTemporaryFile
+from typing import Awaitable, BinaryIO, Optional, Callable, Iterable, Iterator, Union
 
-from .exceptions import MllpConnectionError
+from .exceptions import (MllpConnectionError, MllpMessageTooLarge, MllpServerError, MllpAckTimeout,
+                         MllpPoolExhausted, MllpException, Hl7Exception, InvalidHl7Message, JournalError)
+from .dedup import DedupCache
+from .journal import Journal, JournalCursor, DEFAULT_SEGMENT_SIZE
+from .metrics import Metrics
+from .utils import Acks, generate_ack_bytes, peek_msh, peek_msa
 
 
 START_BYTE = b'\x0B'
 END_BYTES = b'\x1C\x0D'
 BUFSIZE = 4096
 MAX_MESSAGE_SIZE = 1 * 1024 * 1024  # 1 MB is probably reasonable.
+FRAME_HEAD_SIZE = 64 * 1024  # Enough to hold the MSH of a spilled frame.
+WRITE_HIGH_WATER = 256 * 1024
+WRITE_LOW_WATER = 64 * 1024
+CLOSE_GRACE = 5.0  # Longest MllpStoreAndForward.close() waits for an ACK in flight.
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+HAS_MSG_DONTWAIT = hasattr(socket, 'MSG_DONTWAIT')
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def send_buffers(sock: socket.socket, buffers: list[bytes]) -> None:
+    """
+    Send all of `buffers`, in order, on the blocking socket `sock` without joining
+    them in a new `bytes` first. The buffers go to the kernel with `sendmsg()`, up
+    to `IOV_MAX` at a time, and partial sends are resumed with views. Platforms
+    without `sendmsg()` fall back on `sendall()` of the joined buffers.
+    """
+    if not HAS_SENDMSG:
+        sock.sendall(b''.join(buffers))
+        return
+    views = [memoryview(b) for b in buffers if len(b)]
+    first = 0
+    while first < len(views):
+        sent = sock.sendmsg(views[first:first + IOV_MAX])
+        while first < len(views) and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent:
+            views[first] = views[first][sent:]
+
+
+class MllpFrameDecoder:
+    """
+    Incremental MLLP framing. Bytes are fed in as they are read from the network
+    and complete messages are taken out with `next_frame()`, with the framing bytes
+    removed. Anything outside of a frame is junk and is discarded.
+
+    The bytes are accumulated in a `bytearray` and the search for the end of the
+    frame resumes where the previous search stopped, so the cost of receiving a
+    message is linear in its size no matter how many reads it takes.
+
+    If a frame grows beyond `max_message_size` without being terminated, an
+    `MllpMessageTooLarge` exception is raised. If `max_message_size` is `None`,
+    `hl7lw.mllp.MAX_MESSAGE_SIZE` is used.
+
+    With a `spill_threshold`, a frame growing beyond that many bytes is moved out
+    of memory into a `tempfile.SpooledTemporaryFile`, and the rest of the frame is
+    streamed to it as it arrives. `next_frame()` then returns the file, positioned
+    at the start of the message, instead of `bytes`. The caller owns the file and
+    must close it.
+    """
+    def __init__(self,
+                 max_message_size: Optional[int] = None,
+                 spill_threshold: Optional[int] = None) -> None:
+        self.max_message_size = max_message_size
+        self.spill_threshold = spill_threshold
+        self.buffer = bytearray()
+        self._in_frame = False  # buffer starts with START_BYTE
+        self._scan_from = 0
+        self._spool: Optional[SpooledTemporaryFile] = None  # Holds the start of the frame
+        self._spool_size = 0
+
+    def __len__(self) -> int:
+        return len(self.buffer)
+
+    def clear(self) -> None:
+        """
+        Discard everything buffered.
+        """
+        self.buffer.clear()
+        self._in_frame = False
+        self._scan_from = 0
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+            self._spool_size = 0
+
+    def feed(self, data: bytes) -> None:
+        """
+        Append `data` read from the network.
+        """
+        self.buffer += data
+
+    def release(self) -> None:
+        """
+        Nothing to do, the frames are copies. For compatibility with
+        `ZeroCopyFrameDecoder`.
+        """
+
+    def in_frame(self) -> bool:
+        """
+        Whether a frame was started and not completed yet, as of the last call
+        to `next_frame()`.
+        """
+        return self._in_frame
+
+    def _max_message_size(self) -> int:
+        if self.max_message_size is None:
+            return MAX_MESSAGE_SIZE
+        return self.max_message_size
+
+    def next_frame(self) -> Union[None, bytes, SpooledTemporaryFile]:
+        """
+        Returns the next complete message, or `None` if more bytes are needed.
+        """
+        if self._spool is not None:
+            return self._next_spilled_frame()
+        buffer = self.buffer
+        if not self._in_frame:
+            start = buffer.find(START_BYTE)
+            if start == -1:
+                # Only junk, get rid of it to minimize memory footprint.
+                buffer.clear()
+                return None
+            if start > 0:
+                del buffer[:start]
+            self._in_frame = True
+            self._scan_from = len(START_BYTE)
+        end = buffer.find(END_BYTES, self._scan_from)
+        if end == -1:
+            # END_BYTES could be split across reads, so back off a little.
+            self._scan_from = max(len(START_BYTE), len(buffer) - len(END_BYTES) + 1)
+            max_message_size = self._max_message_size()
+            if len(buffer) > max_message_size:
+                raise MllpMessageTooLarge(f"Maximum messages size {max_message_size} exceeded!")
+            if self.spill_threshold is not None and len(buffer) > self.spill_threshold:
+                self._spool = SpooledTemporaryFile(max_size=self.spill_threshold)
+                self._spill(len(START_BYTE), self._scan_from)
+            return None
+        with memoryview(buffer) as view:
+            message = bytes(view[len(START_BYTE):end])  # Only copy once.
+        del buffer[:end + len(END_BYTES)]
+        self._in_frame = False
+        return message
+
+    def _spill(self, start: int, end: int) -> None:
+        # Move buffer[start:end] to the spool and drop buffer[:end].
+        with memoryview(self.buffer) as view:
+            self._spool.write(view[start:end])
+        self._spool_size += end - start
+        del self.buffer[:end]
+
+    def _next_spilled_frame(self) -> Optional[SpooledTemporaryFile]:
+        # While spilling, the buffer only holds what's after the spooled bytes.
+        # The size is checked before anything is written, the last chunk included.
+        end = self.buffer.find(END_BYTES)
+        max_message_size = self._max_message_size()
+        if self._spool_size + (len(self.buffer) if end == -1 else end) > max_message_size:
+            raise MllpMessageTooLarge(f"Maximum messages size {max_message_size} exceeded!")
+        if end == -1:
+            # Keep what could be the start of END_BYTES.
+            self._spill(0, max(0, len(self.buffer) - len(END_BYTES) + 1))
+            return None
+        self._spill(0, end)
+        del self.buffer[:len(END_BYTES)]
+        spool = self._spool
+        spool.seek(0)
+        self._spool = None
+        self._spool_size = 0
+        self._in_frame = False
+        return spool
+
+
+class ZeroCopyFrameDecoder:
+    """
+    Variant of `MllpFrameDecoder` that reads straight from the socket into a
+    preallocated buffer with `recv_into()` and returns the messages as `memoryview`
+    of that buffer, without any copy.
+
+    The views are only valid until `release()` is called, which makes every view
+    handed out unusable (any access raises a `ValueError`) so the space can be
+    reused. Views can't be kept beyond that, take a `bytes()` copy of those that
+    need to live longer. Reading more data requires all views to be released, a
+    `BufferError` is raised otherwise.
+
+    The buffer starts at `capacity` bytes and grows as needed to hold a frame, up
+    to `max_message_size` (`hl7lw.mllp.MAX_MESSAGE_SIZE` if `None`).
+    """
+    def __init__(self, max_message_size: Optional[int] = None, capacity: int = 16 * BUFSIZE) -> None:
+        self.max_message_size = max_message_size
+        self.buffer = bytearray(capacity)
+        self._start = 0  # Unconsumed data is in buffer[_start:_end]
+        self._end = 0
+        self._in_frame = False  # buffer[_start] is START_BYTE
+        self._scan_from = 0
+        self._views: list[memoryview] = []
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def in_frame(self) -> bool:
+        """
+        Whether a frame was started and not completed yet, as of the last call
+        to `next_frame()`.
+        """
+        return self._in_frame
+
+    def release(self) -> None:
+        """
+        Invalidate all the frames returned so far so the buffer can be reused.
+        """
+        for view in self._views:
+            view.release()
+        self._views.clear()
+
+    def clear(self) -> None:
+        """
+        Release all frames and discard everything buffered.
+        """
+        self.release()
+        self._start = self._end = 0
+        self._in_frame = False
+        self._scan_from = 0
+
+    def _make_room(self, size: int) -> None:
+        if self._views:
+            raise BufferError("Frames must be released before reading more data.")
+        if self._start > 0:
+            # Move the partial frame to the front, same size so no reallocation.
+            length = self._end - self._start
+            self.buffer[:length] = self.buffer[self._start:self._end]
+            self._scan_from -= self._start
+            self._start, self._end = 0, length
+        if len(self.buffer) - self._end < size:
+            self.buffer.extend(bytes(size - (len(self.buffer) - self._end)))
+
+    def recv_into(self, sock: socket.socket, size: int = BUFSIZE) -> int:
+        """
+        Read up to `size` bytes from `sock` straight into the buffer. Returns the
+        number of bytes read, 0 meaning the connection was closed.
+        """
+        self._make_room(size)
+        with memoryview(self.buffer) as view:
+            target = view[self._end:self._end + size]
+            try:
+                count = sock.recv_into(target)
+            finally:
+                target.release()
+        self._end += count
+        return count
+
+    def feed(self, data: bytes) -> None:
+        """
+        Append `data`, for when the bytes were read by other means.
+        """
+        self._make_room(len(data))
+        self.buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def next_frame(self) -> Optional[memoryview]:
+        """
+        Returns the next complete message as a view, or `None` if more bytes are
+        needed. The view is valid until `release()`.
+        """
+        buffer = self.buffer
+        if not self._in_frame:
+            start = buffer.find(START_BYTE, self._start, self._end)
+            if start == -1:
+                self._start = self._end = 0  # Only junk.
+                return None
+            self._start = start
+            self._in_frame = True
+            self._scan_from = start + len(START_BYTE)
+        end = buffer.find(END_BYTES, self._scan_from, self._end)
+        if end == -1:
+            self._scan_from = max(self._start + len(START_BYTE), self._end - len(END_BYTES) + 1)
+            max_message_size = self.max_message_size
+            if max_message_size is None:
+                max_message_size = MAX_MESSAGE_SIZE
+            if self._end - self._start > max_message_size:
+                raise MllpMessageTooLarge(f"Maximum messages size {max_message_size} exceeded!")
+            return None
+        with memoryview(buffer) as view:
+            message = view[self._start + len(START_BYTE):end]
+        self._views.append(message)
+        self._start = end + len(END_BYTES)
+        self._in_frame = False
+        return message
 
 
 class MllpClient:
@@ -20,7 +320,19 @@ class MllpClient:
     single connection. Encryption is not currently supported.
 
     There is a 1MB limit for the messages out of the box to control the memory usage,
-    this can be changed by setting `hl7lw.mllp.MAX_MESSAGE_SIZE` to another value.
+    this can be changed with `max_message_size` or for all instances by setting
+    `hl7lw.mllp.MAX_MESSAGE_SIZE` to another value.
+
+    Reads from the socket are done `bufsize` bytes at a time, raising it can help
+    when receiving very large messages.
+
+    Pass a `hl7lw.metrics.Metrics` as `metrics` to count messages and bytes and
+    time the round-trip between a `send()` and the `recv()` of its ACK.
+
+    With `zero_copy`, the socket is read with `recv_into()` into a reusable buffer,
+    see `ZeroCopyFrameDecoder`, and `recv()` returns a `memoryview` instead of
+    `bytes`. The view is only valid until the next call to `recv()` or `close()`,
+    after which using it raises a `ValueError`.
 
     The basic usage goes like:
 
@@ -33,12 +345,22 @@ class MllpClient:
     ```
 
     """
-    def __init__(self) -> None:
+    def __init__(self,
+                 bufsize: int = BUFSIZE,
+                 metrics: Optional[Metrics] = None,
+                 zero_copy: bool = False,
+                 max_message_size: Optional[int] = None) -> None:
         self.socket: Optional[socket.socket] = None
         self.connected: bool = False
         self.host: Optional[str] = None
         self.port: Optional[int] = None
-        self.buffer: bytes = b''
+        self.bufsize = bufsize
+        self.zero_copy = zero_copy
+        self.decoder: Union[MllpFrameDecoder, ZeroCopyFrameDecoder] = (
+            ZeroCopyFrameDecoder(max_message_size=max_message_size) if zero_copy
+            else MllpFrameDecoder(max_message_size=max_message_size))
+        self.metrics = metrics
+        self._sent_at: deque[float] = deque(maxlen=1024)  # For the ACK round-trip
 
     def is_connected(self) -> bool:
         """
@@ -54,7 +376,7 @@ class MllpClient:
         """
         if self.connected:
             self.connected = False
-            self.buffer = b''
+            self.decoder.clear()
             self.socket.close()
         else:
             raise MllpConnectionError("Not connected!")
@@ -76,8 +398,9 @@ class MllpClient:
         if self.connected:
             # If we were connected, reset the state.
             self.connected = False
-            self.buffer = b''
+            self.decoder.clear()
             self.socket.close()
+        self._sent_at.clear()
         try:
             self.socket = socket.create_connection((host, port))
         except TimeoutError as e:
@@ -99,8 +422,58 @@ class MllpClient:
         exception is re-raised as an `MllpConnectionError`. There's no way to know how
         much of the message was sent.
 
-        MLLP framing is handled by the method.
+        MLLP framing is handled by the method, the framing bytes and the message are
+        handed to the kernel together without copying the message.
         """
+        self._ensure_connected(auto_reconnect)
+        try:
+            send_buffers(self.socket, [START_BYTE, message, END_BYTES])
+        except Exception as e:
+            self.socket.close()
+            self.connected = False
+            self.decoder.clear()
+            raise MllpConnectionError("Failed to send message to client.") from e
+        if self.metrics is not None:
+            self._record_sent([message])
+
+    def send_many(self, messages: Iterable[bytes], auto_reconnect: bool = True) -> None:
+        """
+        Send all of `messages`, framed, in as few system calls as possible. Meant for
+        feeds where the ACKs are not waited on between messages, they still all need
+        to be read with `recv()`.
+
+        Where available (Linux), the socket is corked with `TCP_CORK` for the whole
+        batch so the kernel sends full packets, and uncorked at the end to push out
+        the tail right away instead of letting Nagle's algorithm hold it back.
+
+        Connection handling and errors are as for `send()`. On error there's no way
+        to know how many of the messages were sent.
+        """
+        messages = list(messages)
+        if not messages:
+            return
+        self._ensure_connected(auto_reconnect)
+        buffers = []
+        for message in messages:
+            buffers.extend((START_BYTE, message, END_BYTES))
+        cork = getattr(socket, 'TCP_CORK', None)
+        try:
+            if cork is not None:
+                self.socket.setsockopt(socket.IPPROTO_TCP, cork, 1)
+            try:
+                send_buffers(self.socket, buffers)
+            finally:
+                if cork is not None:
+                    self.socket.setsockopt(socket.IPPROTO_TCP, cork, 0)  # Flushes
+        except Exception as e:
+            self.socket.close()
+            self.connected = False
+            self.decoder.clear()
+            raise MllpConnectionError("Failed to send messages to client.") from e
+        if self.metrics is not None:
+            self._record_sent(messages)
+
+    def _ensure_connected(self, auto_reconnect: bool) -> None:
         if not self.connected:
             if auto_reconnect:
                 if self.host is None or self.port is None:
@@ -108,15 +481,16 @@ class MllpClient:
                 self.connect(host=self.host, port=self.port)
             else:
                 raise MllpConnectionError("Not connected!")
-        try:
-            self.socket.sendall(START_BYTE + message + END_BYTES)
-        except Exception as e:
-            self.socket.close()
-            self.connected = False
-            self.buffer = b''
-            raise MllpConnectionError("Failed to send message to client.") from e
+
+    def _record_sent(self, messages: list[bytes]) -> None:
+        now = time.perf_counter()
+        for message in messages:
+            self._sent_at.append(now)
+            self.metrics.inc('mllp_client_messages_sent_total')
+            self.metrics.inc('mllp_client_bytes_sent_total', len(message) + len(START_BYTE) + len(END_BYTES))
+            self.metrics.observe('mllp_client_frame_size_bytes', len(message))
     
-    def recv(self) -> bytes:
+    def recv(self) -> Union[bytes, memoryview]:
         """
         Receive a message from the connection. If there's multiple messages to
         be read, this method needs to be called repeatedly. The method will block
@@ -143,35 +517,806 @@ class MllpClient:
             # Maybe if asynch ACKs are used? But this client implementation really
             # isn't that smart.
             raise MllpConnectionError("Not connected!")
-        # self.buffer is for any excess bytes after last message. A busy sender that
+        self.decoder.release()  # The frame returned by the last call, in zero copy mode.
+        # The decoder keeps any excess bytes after last message. A busy sender that
         # does not expect ack can send messages fast enough they run into each other.
-        buffer = self.buffer
-        self.buffer = b''
-        while True:
+        message = self.decoder.next_frame()
+        while message is None:
             try:
-                # This is slow for very large messages.
-                buffer += self.socket.recv(BUFSIZE)
+                if self.zero_copy:
+                    count = self.decoder.recv_into(self.socket, self.bufsize)
+                else:
+                    data = self.socket.recv(self.bufsize)
+                    count = len(data)
             except Exception as e:
                 self.connected = False
+                self.decoder.clear()
                 self.socket.close()
                 raise MllpConnectionError("Failed to read from socket, closing it.") from e
-            start = buffer.find(START_BYTE)
-            if start == -1:
-                # This only happens if buffer is only junk, so get rid of it to minimize
-                # memory footprint.
-                buffer = b''
-            elif start > 0:
-                # START_BYTE at index 0 is expected normal when message is split
-                buffer = buffer[start:]
-            end = buffer.find(END_BYTES)
-            if end != -1:
-                message = buffer[:end]
-                self.buffer = buffer[end:]
-                return message[1:]  # Discard leading START_BYTE
-            if len(buffer) > MAX_MESSAGE_SIZE:
+            if not count:
                 self.connected = False
+                self.decoder.clear()
                 self.socket.close()
-                raise MllpConnectionError(f"Maximum messages size {MAX_MESSAGE_SIZE} exceeded!")
+                raise MllpConnectionError("Connection closed by the other side.")
+            if self.metrics is not None:
+                self.metrics.inc('mllp_client_bytes_received_total', count)
+            if not self.zero_copy:
+                self.decoder.feed(data)
+            try:
+                message = self.decoder.next_frame()
+            except MllpMessageTooLarge:
+                self.connected = False
+                self.decoder.clear()
+                self.socket.close()
+                raise
+        if self.metrics is not None:
+            self.metrics.inc('mllp_client_messages_received_total')
+            if self._sent_at:
+                self.metrics.observe('mllp_client_ack_seconds', time.perf_counter() - self._sent_at.popleft())
+        return message
+
+
+class PipelinedMessage:
+    """
+    A message sent through an `MllpPipeline` and waiting for its ACK.
+    """
+    def __init__(self, message_id: Optional[str], deadline: Optional[float]) -> None:
+        self.message_id = message_id
+        self.deadline = deadline
+        self.sent_at = time.perf_counter()
+        self.future: Future = Future()
+        self.outcome: Union[None, bytes, Exception] = None  # Until completed
+
+
+class MllpPipeline:
+    """
+    Windowed sending over an `MllpClient`. Up to `window` messages are sent without
+    waiting for their ACKs, and the ACKs are matched to the messages by comparing
+    MSA-2 to MSH-10. Over links with high latency, this is a lot faster than the
+    send and recv lockstep of `MllpClient`.
+
+    ```
+    c = MllpClient()
+    c.connect(host="127.0.0.1", port=1234)
+    pipeline = MllpPipeline(c, window=32)
+    futures = [pipeline.submit(message) for message in messages]
+    acks = [f.result() for f in futures]
+    pipeline.close()
+    c.close()
+    ```
+
+    `submit()` returns a `concurrent.futures.Future` resolved with the ACK `bytes`,
+    and blocks while the window is full. A future fails with `MllpAckTimeout` if
+    there's no ACK after `timeout` seconds, and an ACK arriving afterward is ignored.
+    If the connection fails, all pending futures fail with `MllpConnectionError`
+    and the pipeline can't be used anymore.
+
+    Options:
+
+    `ordered` -- Complete the futures in the order the messages were sent, even if
+                 the ACKs arrive out of order.
+
+    `match_by_id` -- When disabled, ACKs are matched to messages in order instead of
+                     by ID, for receivers that don't echo MSH-10 in MSA-2.
+
+    The pipeline reads from the client in a background thread, so the client's
+    `recv()` must not be used while the pipeline is open.
+    """
+    def __init__(self,
+                 client: MllpClient,
+                 window: int = 16,
+                 timeout: Optional[float] = 30.0,
+                 ordered: bool = False,
+                 match_by_id: bool = True,
+                 encoding: str = 'ascii') -> None:
+        if not client.is_connected():
+            raise MllpConnectionError("Not connected!")
+        self.client = client
+        self.window = window
+        self.timeout = timeout
+        self.ordered = ordered
+        self.match_by_id = match_by_id
+        self.encoding = encoding
+        self.broken: Optional[Exception] = None
+        self._slots = threading.BoundedSemaphore(window)
+        self._lock = threading.Lock()
+        self._drained = threading.Condition(self._lock)  # Notified when messages leave _in_flight
+        self._send_lock = threading.Lock()
+        self._in_flight: deque[PipelinedMessage] = deque()  # In send order
+        self._by_id: dict[Optional[str], deque[PipelinedMessage]] = {}
+        self._closing = False
+        self._reader = threading.Thread(target=self._read_acks, daemon=True)
+        self._reader.start()
+
+    def in_flight(self) -> int:
+        """
+        Number of messages sent and not yet completed.
+        """
+        return len(self._in_flight)
+
+    def submit(self,
+               message: bytes,
+               callback: Optional[Callable[[Future], None]] = None) -> Future:
+        """
+        Send `message` and return a future for its ACK. Blocks while `window` messages
+        are already waiting for an ACK. The optional `callback` is attached to the
+        future with `add_done_callback()`.
+        """
+        if self.match_by_id:
+            try:
+                message_id = peek_msh(message, encoding=self.encoding)[10]
+            except (Hl7Exception, UnicodeDecodeError) as e:
+                raise InvalidHl7Message("Cannot pipeline a message without MSH-10.") from e
+        else:
+            message_id = None
+        self._slots.acquire()
+        if self.broken is not None or self._closing:
+            self._slots.release()
+            raise MllpConnectionError("Pipeline is closed.") from self.broken
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        pending = PipelinedMessage(message_id, deadline)
+        if callback is not None:
+            pending.future.add_done_callback(callback)
+        with self._lock:
+            self._in_flight.append(pending)
+            self._by_id.setdefault(message_id, deque()).append(pending)
+        try:
+            with self._send_lock:
+                self.client.send(message, auto_reconnect=False)
+        except MllpConnectionError as e:
+            self._fail_all(e)
+        return pending.future
+
+    def close(self, wait: bool = True) -> None:
+        """
+        Stop the pipeline. With `wait`, the messages in flight get their ACKs or
+        time out first, otherwise their futures are cancelled. The client is left
+        open.
+        """
+        self._closing = True
+        with self._lock:
+            if wait:
+                self._drained.wait_for(lambda: not self._in_flight or self.broken is not None)
+            cancelled = self._settle_all(MllpConnectionError("Pipeline is closed."))
+        for pending in cancelled:
+            self._slots.release()
+            pending.future.cancel()
+        self._reader.join()
+
+    def _settle_all(self, error: Exception) -> list[PipelinedMessage]:
+        # Called with the lock held. Every message in flight gets an outcome, so a
+        # late ACK or timeout finds it completed already, and is removed.
+        settled = list(self._in_flight)
+        for pending in settled:
+            if pending.outcome is None:
+                pending.outcome = error
+        self._in_flight.clear()
+        self._by_id.clear()
+        self._drained.notify_all()
+        return settled
+
+    def _fail_all(self, error: Exception) -> None:
+        with self._lock:
+            if self.broken is None:
+                self.broken = error
+            failed = self._settle_all(error)
+        for pending in failed:
+            self._slots.release()
+            if isinstance(pending.outcome, bytes):
+                pending.future.set_result(pending.outcome)  # Was waiting on an earlier message.
+            else:
+                pending.future.set_exception(pending.outcome)
+
+    def _complete(self, pending: PipelinedMessage, outcome: Union[bytes, Exception]) -> None:
+        with self._lock:
+            if pending.outcome is not None:
+                return  # Settled already, like a late ACK after a timeout or a failure.
+            pending.outcome = outcome
+            same_id = self._by_id.get(pending.message_id)
+            if same_id is not None:
+                same_id.remove(pending)
+                if not same_id:
+                    del self._by_id[pending.message_id]
+            done = []
+            if self.ordered:
+                while self._in_flight and self._in_flight[0].outcome is not None:
+                    done.append(self._in_flight.popleft())
+            else:
+                self._in_flight.remove(pending)
+                done.append(pending)
+            if done:
+                self._drained.notify_all()
+        for pending in done:
+            self._slots.release()
+            if isinstance(pending.outcome, Exception):
+                pending.future.set_exception(pending.outcome)
+            else:
+                pending.future.set_result(pending.outcome)
+
+    def _on_ack(self, ack: bytes) -> None:
+        with self._lock:
+            if self.match_by_id:
+                try:
+                    ack_id = peek_msa(ack, encoding=self.encoding)[2]
+                except (Hl7Exception, UnicodeDecodeError):
+                    return  # Can't be matched.
+                same_id = self._by_id.get(ack_id)
+                pending = same_id[0] if same_id else None
+            else:
+                pending = next((p for p in self._in_flight if p.outcome is None), None)
+        metrics = self.client.metrics
+        if metrics is not None:
+            metrics.inc('mllp_client_messages_received_total')
+            if pending is not None and pending.outcome is None:
+                metrics.observe('mllp_client_ack_seconds', time.perf_counter() - pending.sent_at)
+        if pending is not None:
+            self._complete(pending, ack)
+
+    def _expire(self) -> Optional[float]:
+        """
+        Time out overdue messages and return how long until the next deadline.
+        """
+        if self.timeout is None:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            overdue = [p for p in self._in_flight if p.outcome is None and p.deadline <= now]
+            waiting = [p.deadline for p in self._in_flight if p.outcome is None and p.deadline > now]
+        for pending in overdue:
+            self._complete(pending, MllpAckTimeout(f"No ACK received after {self.timeout} seconds."))
+        return min(waiting) - now if waiting else None
+
+    def _read_acks(self) -> None:
+        client = self.client
+        # A selector, select.select() can't watch descriptors past FD_SETSIZE.
+        selector = selectors.DefaultSelector()
+        try:
+            selector.register(client.socket, selectors.EVENT_READ)
+        except (OSError, ValueError) as e:
+            selector.close()
+            self._fail_all(MllpConnectionError(f"Failed to read from socket: {e}"))
+            return
+        try:
+            self._read_loop(selector)
+        finally:
+            selector.close()
+
+    def _read_loop(self, selector: selectors.BaseSelector) -> None:
+        client = self.client
+        while self.broken is None and not (self._closing and not self._in_flight):
+            try:
+                wait = self._expire()
+                wait = 0.1 if wait is None else min(wait, 0.1)
+                if not selector.select(wait):
+                    continue
+                data = client.socket.recv(client.bufsize)
+                if not data:
+                    raise MllpConnectionError("Connection closed by the other side.")
+                if client.metrics is not None:
+                    client.metrics.inc('mllp_client_bytes_received_total', len(data))
+                client.decoder.feed(data)
+                while True:
+                    ack = client.decoder.next_frame()
+                    if ack is None:
+                        break
+                    self._on_ack(bytes(ack))  # Not a view, it outlives the buffer.
+                client.decoder.release()
+            except Exception as e:
+                # Nothing may kill the reader, submit() would wait for a slot forever.
+                if not isinstance(e, MllpConnectionError):
+                    e = MllpConnectionError(f"Failed to read from socket: {e}")
+                if client.connected:
+                    client.connected = False
+                    client.decoder.clear()
+                    client.socket.close()
+                self._fail_all(e)
+
+
+class MllpConnectionPool:
+    """
+    A pool of `MllpClient` connections, keyed by `(host, port)`, that can be shared
+    by many threads. Connections are reused across checkouts instead of being opened
+    for every batch, and at most `max_size` connections are ever open to a given
+    `(host, port)`.
+
+    ```
+    pool = MllpConnectionPool(max_size=4)
+    with pool.connection("127.0.0.1", 1234) as c:
+        c.send(message)
+        ack = c.recv()
+    pool.close()
+    ```
+
+    When all `max_size` connections to a destination are checked out, `checkout()`
+    blocks until one is checked in, for up to `checkout_timeout` seconds (forever
+    if `None`) before raising `MllpPoolExhausted`.
+
+    Idle connections are checked before being handed out, a connection that was
+    closed, has unread bytes or was closed by the other side is discarded and
+    replaced. Connections idle for more than `idle_timeout` seconds are closed on
+    the next `checkout()` or `prune()` for their destination, except for the
+    `min_size` that are kept open. `warm()` opens the `min_size` connections ahead
+    of time.
+
+    A connection must only be checked in once the exchange is complete, with the
+    ACK consumed. If anything goes wrong midway, check it in with `discard=True`,
+    which `connection()` does for you when an exception is raised.
+
+    The `bufsize` and `metrics` are passed on to every `MllpClient` created.
+    """
+    def __init__(self,
+                 min_size: int = 0,
+                 max_size: int = 8,
+                 idle_timeout: Optional[float] = 300.0,
+                 checkout_timeout: Optional[float] = None,
+                 bufsize: int = BUFSIZE,
+                 metrics: Optional[Metrics] = None) -> None:
+        if max_size < 1 or not 0 <= min_size <= max_size:
+            raise ValueError("Pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1.")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.bufsize = bufsize
+        self.metrics = metrics
+        self.closed = False
+        self._cond = threading.Condition()
+        self._idle: dict[tuple[str, int], deque[tuple[MllpClient, float]]] = {}
+        self._size: dict[tuple[str, int], int] = {}  # Idle and checked out.
+        self._checked_out: set[MllpClient] = set()
+
+    def __enter__(self) -> MllpConnectionPool:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def size(self, host: str, port: int) -> int:
+        """
+        Number of connections open to `host` and `port`, idle or checked out.
+        """
+        with self._cond:
+            return self._size.get((host, port), 0)
+
+    def idle(self, host: str, port: int) -> int:
+        """
+        Number of idle connections to `host` and `port`.
+        """
+        with self._cond:
+            return len(self._idle.get((host, port), ()))
+
+    @staticmethod
+    def is_healthy(client: MllpClient) -> bool:
+        """
+        Check that an idle `client` can be used. Beyond `is_connected()`, nothing
+        should be waiting to be read from an idle connection, if the socket is
+        readable the other side either closed it or sent something unexpected.
+        """
+        if not client.is_connected() or len(client.decoder):
+            return False
+        try:
+            if HAS_MSG_DONTWAIT:
+                # Works on any descriptor, select.select() stops at FD_SETSIZE.
+                client.socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+                return False
+            with selectors.DefaultSelector() as selector:
+                selector.register(client.socket, selectors.EVENT_READ)
+                return not selector.select(0)
+        except BlockingIOError:
+            return True  # Nothing to read, as expected.
+        except (OSError, ValueError):
+            return False
+
+    def checkout(self, host: str, port: int, timeout: Optional[float] = None) -> MllpClient:
+        """
+        Take a connection to `host` and `port` out of the pool, connecting a new one
+        if there's no healthy idle connection and the pool isn't full. `timeout`
+        overrides `checkout_timeout`.
+
+        Raises `MllpPoolExhausted` if no connection was available in time, or
+        `MllpConnectionError` if connecting failed.
+        """
+        key = (host, port)
+        if timeout is None:
+            timeout = self.checkout_timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        discarded = []
+        try:
+            with self._cond:
+                while True:
+                    if self.closed:
+                        raise MllpConnectionError("Pool is closed.")
+                    discarded.extend(self._evict(key, time.monotonic()))
+                    idle = self._idle.get(key)
+                    while idle:
+                        # Most recently used first, so the surplus can age out.
+                        client, _ = idle.pop()
+                        if self.is_healthy(client):
+                            self._checked_out.add(client)
+                            return client
+                        discarded.append(client)
+                        self._size[key] -= 1
+                    if self._size.get(key, 0) < self.max_size:
+                        self._size[key] = self._size.get(key, 0) + 1
+                        break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise MllpPoolExhausted(f"No connection to {host}:{port} available "
+                                                f"after {timeout} seconds.")
+                    self._cond.wait(remaining)
+        finally:
+            self._close_all(discarded)
+        # Connect without holding the lock, the slot is already reserved.
+        client = MllpClient(bufsize=self.bufsize, metrics=self.metrics)
+        try:
+            client.connect(host=host, port=port)
+        except BaseException:
+            with self._cond:
+                self._size[key] -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._checked_out.add(client)
+        return client
+
+    def checkin(self, client: MllpClient, discard: bool = False) -> None:
+        """
+        Return a connection obtained from `checkout()` to the pool. With `discard`,
+        or if the connection is no longer healthy, it's closed instead of being
+        kept for reuse.
+        """
+        key = (client.host, client.port)
+        with self._cond:
+            if client not in self._checked_out:
+                raise ValueError("Connection was not checked out from this pool.")
+            self._checked_out.remove(client)
+            keep = not (discard or self.closed) and self.is_healthy(client)
+            if keep:
+                self._idle.setdefault(key, deque()).append((client, time.monotonic()))
+            else:
+                self._size[key] -= 1
+            self._cond.notify()
+        if not keep:
+            self._close_all([client])
+
+    @contextmanager
+    def connection(self, host: str, port: int, timeout: Optional[float] = None) -> Iterator[MllpClient]:
+        """
+        Context manager around `checkout()` and `checkin()`. If the block raises, the
+        connection is discarded since it's in an unknown state.
+        """
+        client = self.checkout(host, port, timeout=timeout)
+        try:
+            yield client
+        except BaseException:
+            self.checkin(client, discard=True)
+            raise
+        self.checkin(client)
+
+    def warm(self, host: str, port: int) -> None:
+        """
+        Open connections to `host` and `port` until there's at least `min_size`.
+        """
+        clients = []
+        try:
+            while self.size(host, port) < self.min_size:  # Checked out connections count already.
+                clients.append(self.checkout(host, port))
+        finally:
+            for client in clients:
+                self.checkin(client)
+
+    def prune(self) -> int:
+        """
+        Close the connections idle for longer than `idle_timeout`, for all
+        destinations, keeping `min_size` per destination. Returns how many were
+        closed.
+        """
+        now = time.monotonic()
+        with self._cond:
+            discarded = []
+            for key in list(self._idle):
+                discarded.extend(self._evict(key, now))
+        self._close_all(discarded)
+        return len(discarded)
+
+    def close(self) -> None:
+        """
+        Close all the idle connections. Connections currently checked out are
+        closed when they are checked in, and `checkout()` fails from now on.
+        """
+        with self._cond:
+            self.closed = True
+            discarded = [client for idle in self._idle.values() for client, _ in idle]
+            for key, idle in self._idle.items():
+                self._size[key] -= len(idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        self._close_all(discarded)
+
+    def _evict(self, key: tuple[str, int], now: float) -> list[MllpClient]:
+        # Must hold the lock. The oldest idle connections are on the left.
+        evicted = []
+        if self.idle_timeout is None:
+            return evicted
+        idle = self._idle.get(key)
+        while idle and self._size[key] > self.min_size and now - idle[0][1] > self.idle_timeout:
+            evicted.append(idle.popleft()[0])
+            self._size[key] -= 1
+        if not idle:
+            self._idle.pop(key, None)
+        return evicted
+
+    @staticmethod
+    def _close_all(clients: list[MllpClient]) -> None:
+        for client in clients:
+            if client.is_connected():
+                client.close()
+
+
+class MllpStoreAndForward:
+    """
+    Durable outbound queue in front of an `MllpClient`. `send()` writes the message
+    to a `hl7lw.journal.Journal` in `directory` and returns as soon as it is on
+    disk, whether or not `host` and `port` are up. A background thread delivers
+    the journal in order, one message at a time, and moves a delivery cursor
+    forward on every ACK.
+
+    ```
+    forwarder = MllpStoreAndForward("/var/spool/hl7/ris", host="ris", port=2575)
+    forwarder.send(message)
+    ...
+    forwarder.close()
+    ```
+
+    The cursor is saved in `directory` too, so after a crash or a restart the
+    delivery resumes with the first message that wasn't ACKed. Delivery is at
+    least once, so the cursor is only saved every `cursor_interval` seconds, before
+    segments are deleted and on `close()`, rather than after every ACK. The
+    messages ACKed since the last save are sent again after a crash.
+
+    Commits to the journal are grouped, see `Journal.commit()`, so many threads
+    calling `send()` share the same fsync and the throughput is not bound by the
+    latency of the disk. With `fsync=False`, messages are only flushed to the OS,
+    which survives a crash of the process but not of the host. A single thread with
+    many messages at hand should rather use `send_many()`, which pays for one
+    commit for all of them instead of one each.
+
+    When the connection fails, or no ACK comes within `ack_timeout` seconds, the
+    message is sent again after `retry_delay` seconds, forever. A message that gets
+    a negative ACK (anything but AA or CA in MSA-1) is not retried, it's passed to
+    `on_reject(message, ack)` if set and then skipped, even if `on_reject` raises.
+    Errors reading the journal or saving the cursor are kept in `last_error`, like
+    the connection errors, and retried after `retry_delay` seconds too.
+
+    Segments of the journal are deleted once all their messages were delivered.
+    """
+    def __init__(self,
+                 directory: str,
+                 host: str,
+                 port: int,
+                 segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 fsync: bool = True,
+                 retry_delay: float = 1.0,
+                 ack_timeout: Optional[float] = 30.0,
+                 on_reject: Optional[Callable[[bytes, bytes], None]] = None,
+                 encoding: str = 'ascii',
+                 client: Optional[MllpClient] = None,
+                 cursor_interval: float = 1.0) -> None:
+        self.host = host
+        self.port = port
+        self.retry_delay = retry_delay
+        self.ack_timeout = ack_timeout
+        self.cursor_interval = cursor_interval
+        self.on_reject = on_reject
+        self.encoding = encoding
+        self.client = client if client is not None else MllpClient()
+        self.journal = Journal(directory, segment_size=segment_size, fsync=fsync)
+        self.cursor = JournalCursor(os.path.join(directory, 'cursor'), fsync=fsync)
+        self.delivered = self.cursor.load()  # Position of the next message to deliver
+        self._saved = self.delivered
+        self._saved_at = time.monotonic()
+        self.last_error: Optional[Exception] = None
+        self._reader = self.journal.read(self.delivered)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._progress = threading.Condition()
+        self._thread = threading.Thread(target=self._deliver, daemon=True)
+        self._thread.start()
+
+    def send(self, message: bytes) -> int:
+        """
+        Queue `message` for delivery and return its position in the journal once
+        it's durable. Does not wait for the delivery.
+        """
+        position = self.journal.append(message)
+        self.journal.commit(position)
+        self._wake.set()
+        return position
+
+    def send_many(self, messages: Iterable[bytes]) -> list[int]:
+        """
+        Like `send()` for several messages at once, which are made durable together
+        by a single commit. Returns their positions, in order.
+        """
+        positions = [self.journal.append(message) for message in messages]
+        if positions:
+            self.journal.commit(positions[-1])
+            self._wake.set()
+        return positions
+
+    def backlog(self) -> int:
+        """
+        Bytes in the journal waiting to be delivered.
+        """
+        return self.journal.end - self.delivered
+
+    def wait_delivered(self, position: Optional[int] = None, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until the message at `position`, or everything sent so far, has been
+        delivered. Returns `False` if `timeout` expired first.
+        """
+        target = self.journal.end if position is None else position + 1
+        with self._progress:
+            return self._progress.wait_for(lambda: self.delivered >= target, timeout)
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop delivering and close the journal and the connection. Messages not
+        delivered yet stay in the journal for the next time. With a `timeout`,
+        delivery of the backlog is given that long to complete first.
+
+        The ACK of a message in flight is waited for up to `ack_timeout` seconds, but
+        never more than `CLOSE_GRACE`, after which the connection is shut down and
+        the message is sent again the next time.
+        """
+        if timeout is not None:
+            self.wait_delivered(timeout=timeout)
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(CLOSE_GRACE if self.ack_timeout is None else min(self.ack_timeout, CLOSE_GRACE))
+        if self._thread.is_alive():
+            sock = self.client.socket
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)  # Wakes up the recv() with a closed connection.
+                except OSError:
+                    pass
+            self._thread.join()
+        self._reader.close()
+        self.journal.close()
+        if self.client.is_connected():
+            self.client.close()
+
+    def _exchange(self, message: bytes) -> bytes:
+        if not self.client.is_connected():
+            self.client.connect(host=self.host, port=self.port)
+            try:
+                self.client.socket.settimeout(self.ack_timeout)
+            except OSError as e:
+                raise MllpConnectionError("Failed to configure socket.") from e
+        self.client.send(message, auto_reconnect=False)
+        return self.client.recv()
+
+    def _deliver(self) -> None:
+        try:
+            self._deliver_records()
+        finally:
+            try:
+                self._save_cursor()
+            except OSError as e:
+                self.last_error = e
+
+    def _save_cursor(self) -> None:
+        if self._saved != self.delivered:
+            self.cursor.save(self.delivered)
+            self._saved = self.delivered
+        self._saved_at = time.monotonic()
+
+    def _deliver_records(self) -> None:
+        purged_up_to = -1
+        while not self._stop.is_set():
+            try:
+                if time.monotonic() - self._saved_at >= self.cursor_interval:
+                    self._save_cursor()
+                record = self._reader.next_record()
+                if record is None:
+                    self._wake.wait(min(1.0, self.cursor_interval))
+                    self._wake.clear()
+                    continue
+                _, message = record
+                ack = self._deliver_message(message)
+                if ack is None:
+                    return  # Stopped while retrying.
+                with self._progress:
+                    self.delivered = self._reader.position
+                    self._progress.notify_all()
+                if self._reader.segment_start != purged_up_to:
+                    # Moved on to a new segment, the previous ones can go once the
+                    # cursor no longer points into them.
+                    self._save_cursor()
+                    self.journal.purge(self.delivered)
+                    purged_up_to = self._reader.segment_start
+            except (JournalError, OSError, ValueError) as e:
+                # The journal or the cursor file couldn't be read or written, a full
+                # disk for instance. Nothing moved forward, so try again later.
+                self.last_error = e
+                if self._stop.wait(self.retry_delay):
+                    return
+
+    def _deliver_message(self, message: bytes) -> Optional[bytes]:
+        # Returns the ACK, or None if stopped before getting one.
+        while True:
+            try:
+                ack = self._exchange(message)
+                break
+            except MllpConnectionError as e:
+                self.last_error = e
+                if self.client.is_connected():
+                    self.client.close()
+                if self._stop.wait(self.retry_delay):
+                    return None
+        try:
+            code = peek_msa(ack, encoding=self.encoding)[1]
+        except (Hl7Exception, UnicodeDecodeError):
+            code = None
+        if code not in (Acks.AA.name, Acks.CA.name) and self.on_reject is not None:
+            try:
+                self.on_reject(message, ack)
+            except Exception:
+                traceback.print_exc()  # The message is skipped all the same.
+        return ack
+
+
+class AckPolicy(Enum):
+    """
+    When `MllpServer` sends the ACKs it generates itself, see `MllpServer`.
+    """
+    OnReceipt = 1
+    AfterCallback = 2
+
+
+def frame_head(message: Union[bytes, memoryview, BinaryIO]) -> Union[bytes, memoryview]:
+    """
+    Returns `message`, or the first `FRAME_HEAD_SIZE` bytes of it when it's a
+    spilled frame, enough to read the header from. The file position is kept.
+    """
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        return message
+    position = message.tell()
+    message.seek(0)
+    head = message.read(FRAME_HEAD_SIZE)
+    message.seek(position)
+    return head
+
+
+def frame_size(message: Union[bytes, memoryview, BinaryIO]) -> int:
+    """
+    Size of `message` in bytes, also for a spilled frame.
+    """
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        return len(message)
+    position = message.tell()
+    size = message.seek(0, os.SEEK_END)
+    message.seek(position)
+    return size
+
+
+def make_ack(message: Union[bytes, memoryview, BinaryIO],
+             result: Union[None, bytes, Acks],
+             auto_ack: Optional[AckPolicy],
+             encoding: str = 'ascii') -> Optional[bytes]:
+    """
+    Turn the `result` of a server callback for `message` into the ACK to send,
+    if any, according to the `auto_ack` policy. See `MllpServer`.
+    """
+    if auto_ack is None or isinstance(result, bytes):
+        return result
+    try:
+        return generate_ack_bytes(frame_head(message),
+                                  Acks.AA if result is None else result,
+                                  encoding=encoding)
+    except (InvalidHl7Message, UnicodeDecodeError):
+        return None
 
 
 class MllpServer:
@@ -197,88 +1342,949 @@ class MllpServer:
     NOTE: The callback is responsible to handle all Exceptions it encounters. Any
     exception that is raised by the callback or not handled by the callback will be
     allowed to bubble up to the caller of `server_forever()` and as such, will kill
-    the server.
+    the server, except with `AckPolicy.AfterCallback`, see below.
 
     It is intentional that MllpServer does not do the HL7 parsing as MLLP can be used
     as transport for non-HL7 messages.
+
+    For HL7 messages, the server can generate the ACKs itself from the message
+    header, without parsing the whole message, by setting the `auto_ack` option:
+
+    `AckPolicy.OnReceipt` -- An AA is queued, and sent if the socket allows it, as soon
+                             as the message is received, before the callback is called
+                             and without waiting for the callbacks of the previous
+                             messages. The return value of the callback is ignored.
+
+    `AckPolicy.AfterCallback` -- The callback is called first and its return value
+                                 decides the ACK. `None` means AA, an `Acks` value
+                                 like `Acks.AE` or `Acks.AR` is used as the ACK code,
+                                 and `bytes` are sent as-is like without `auto_ack`.
+
+    Messages without a valid MSH segment can't be acknowledged and get no ACK.
+
+    With `AckPolicy.AfterCallback`, an exception raised by the callback does not
+    kill the server, the message gets an AE instead and the traceback is printed
+    to stderr.
+
+    By default the callback runs in the server loop. With an `executor`, like a
+    `concurrent.futures.ThreadPoolExecutor`, callbacks are submitted to it instead
+    and the server keeps accepting and reading while they run. Messages from a
+    connection are still processed one at a time and ACKed in order, while messages
+    from different connections run in parallel. A `ProcessPoolExecutor` works too
+    as long as the callback can be pickled. Exceptions from the callback are
+    re-raised in the server loop, as if the callback had run there.
+
+    The callback can also defer its result by returning a `concurrent.futures.Future`
+    instead, to hand the message over to its own workers or queues and get the
+    server back to the other connections right away. The ACK is sent once the
+    future is resolved, from its result as if the callback had returned it. Until
+    then the next messages of the connection wait, so the ACKs stay in order.
+    An awaitable, like a coroutine, can be returned as well when an asyncio `loop`
+    running in another thread is given, it's run on that loop:
+
+    ```
+    async def callback(message: bytes) -> Acks:
+        await store(message)
+        return Acks.AA
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    server = MllpServer(port=2575, callback=callback, auto_ack=AckPolicy.AfterCallback, loop=loop)
+    ```
+
+    With `AckPolicy.OnReceipt` the result is ignored and isn't waited for. An
+    exception raised by a future kills the server, like one from the callback,
+    unless the policy is `AckPolicy.AfterCallback`, see above.
+
+    To protect the server from misbehaving clients, connections beyond
+    `max_connections` in total, or beyond `max_connections_per_address` from the
+    same IP address, are closed as soon as they are accepted. A connection
+    that received and sent nothing for `idle_timeout` seconds is closed, unless
+    it's waiting on its callbacks. ACKs waiting to be sent don't keep it open, a
+    client that stops reading them times out. A message that is still incomplete
+    `frame_timeout` seconds after its first bytes were received gets its connection
+    closed as well. While reading is paused by the high water mark, the messages
+    are held back by the server instead, and the connection is closed once no ACK
+    could be sent for `frame_timeout` seconds, the client stopped reading them. The
+    timeouts are kept in a heap, checked once per iteration of the server loop, at
+    no cost for the active connections beyond noting the time of their last
+    activity.
+
+    With `zero_copy`, connections are read with `recv_into()` into a reusable
+    buffer per connection, see `ZeroCopyFrameDecoder`, and the callback gets a
+    `memoryview` of the message instead of `bytes`. The view is released as soon
+    as the callback returns, it must be copied with `bytes()` to be kept. With an
+    `executor`, the callback runs later and gets a `bytes` copy.
+
+    A client sending a message larger than `max_message_size` bytes is disconnected,
+    `hl7lw.mllp.MAX_MESSAGE_SIZE` applies when it's `None`. With `spill_threshold`,
+    messages larger than that are streamed to a `tempfile.SpooledTemporaryFile`
+    while they are received instead of being held in memory, and the callback gets
+    the file, positioned at the start of the message, instead of `bytes`. The file
+    is closed once the callback returns. The ACKs are still generated from the
+    MSH of spilled messages. This allows a large `max_message_size`, for reports
+    with embedded documents for instance, without the memory to match.
+
+    ACKs waiting to be sent are buffered per connection. Once more than
+    `write_high_water` bytes are waiting, the server stops reading from that
+    connection until the client has read enough ACKs to bring it back under
+    `write_low_water` bytes. A client that sends without ever reading its ACKs
+    ends up blocked by TCP flow control instead of growing the buffer forever.
+
+    Pass a `hl7lw.metrics.Metrics` as `metrics` to get counters for connections,
+    messages and bytes, the frame sizes, the callback latency and the bytes waiting
+    to be sent.
+
+    With a `hl7lw.journal.Journal` as `journal`, every message received is appended
+    to it before anything else happens, and no ACK goes out before the messages
+    are on disk. The fsync is done once per iteration of the server loop, for all
+    the messages received in that iteration, and the ACKs held until then are
+    released. The processing can then be left to a consumer reading the journal
+    with a `hl7lw.journal.JournalReader`, at its own pace, in which case the
+    callback can be `None`:
+
+    ```
+    journal = Journal("/var/spool/hl7/in")
+    server = MllpServer(port=2575, callback=None, auto_ack=AckPolicy.OnReceipt, journal=journal)
+    ```
+
+    The server does not close the journal. Only one process can write to a
+    journal, so with `serve_prefork()` each worker needs its own, opened in
+    `worker_init`.
+
+    With a `hl7lw.dedup.DedupCache` as `dedup`, a message received again after it
+    was accepted, typically resent by a client that did not get the ACK, is not
+    passed to the callback, nor appended to the journal. It gets the ACK of the
+    first copy instead, generated again for its header if the server generated
+    the first one. The ACKs still go out in order. See `DedupCache` for how
+    messages are identified and for how long they are remembered.
     """
-    def __init__(self, port: int, callback: Callable[[bytes], Optional[bytes]]) -> None:
+    def __init__(self,
+                 port: int,
+                 callback: Optional[Callable[[bytes], Union[None, bytes, Acks, Future, Awaitable]]],
+                 auto_ack: Optional[AckPolicy] = None,
+                 ack_encoding: str = 'ascii',
+                 executor: Optional[Executor] = None,
+                 write_high_water: int = WRITE_HIGH_WATER,
+                 write_low_water: int = WRITE_LOW_WATER,
+                 metrics: Optional[Metrics] = None,
+                 journal: Optional[Journal] = None,
+                 zero_copy: bool = False,
+                 max_message_size: Optional[int] = None,
+                 spill_threshold: Optional[int] = None,
+                 dedup: Optional[DedupCache] = None,
+                 loop: Optional[asyncio.AbstractEventLoop] = None,
+                 max_connections: Optional[int] = None,
+                 max_connections_per_address: Optional[int] = None,
+                 idle_timeout: Optional[float] = None,
+                 frame_timeout: Optional[float] = None) -> None:
         """
         Initialize the server configuration, providing both the `port` and the `callback`.
+
+        The `auto_ack` policy is optional, see above. The `ack_encoding` is used to
+        decode the message header and encode the ACK when `auto_ack` is set.
+
+        The `executor` is optional, see above. The server does not shut it down.
+
+        The `write_high_water` and `write_low_water` marks are in bytes, see above.
+
+        The `metrics`, the `journal`, `zero_copy`, `max_message_size`,
+        `spill_threshold`, `dedup` and `loop` are optional, see above.
+
+        The connection limits and the timeouts, in seconds, are disabled by
+        default, see above. The `callback` can only be `None`
+        with a `journal`.
         """
+        if not 0 <= write_low_water <= write_high_water:
+            raise ValueError("Need 0 <= write_low_water <= write_high_water.")
+        if callback is None and journal is None:
+            raise ValueError("A callback is needed without a journal.")
+        if zero_copy and spill_threshold is not None:
+            raise ValueError("Spilling is not supported in zero copy mode.")
         self.port = port
         self.callback = callback
+        self.auto_ack = auto_ack
+        self.ack_encoding = ack_encoding
+        self.executor = executor
+        self.write_high_water = write_high_water
+        self.write_low_water = write_low_water
+        self.metrics = metrics
+        self.journal = journal
+        self.zero_copy = zero_copy
+        self.max_message_size = max_message_size
+        self.spill_threshold = spill_threshold
+        self.dedup = dedup
+        self.loop = loop
+        self.max_connections = max_connections
+        self.max_connections_per_address = max_connections_per_address
+        self.idle_timeout = idle_timeout
+        self.frame_timeout = frame_timeout
+        self._per_address: dict[str, int] = {}
+        # (time, sequence, connection) of the next timeout check of every
+        # connection. Entries are stale once the connection's check_at moved.
+        self._timers: list[tuple[float, int, ServerConnection]] = []
+        self._timer_sequence = itertools.count()
+        self._held: set[ServerConnection] = set()  # Have ACKs waiting on the journal
+        self.socket: Optional[socket.socket] = None
+        self.selector: Optional[selectors.BaseSelector] = None
+        self.connections: dict[socket.socket, ServerConnection] = {}
+        self._shutdown_requested = False
+        # Completed callbacks are handed back to the server loop through this
+        # queue, and the loop is woken up by writing to the wakeup socket.
+        self._completed: deque[tuple[ServerConnection, bytes, Future]] = deque()
+        self._wakeup_r: Optional[socket.socket] = None
+        self._wakeup_w: Optional[socket.socket] = None
+        self.worker_pids: dict[int, float] = {}  # pid -> start time, see serve_prefork()
+
+    def make_ack(self, message: bytes, result: Union[None, bytes, Acks]) -> Optional[bytes]:
+        """
+        Turn the result of the callback for `message` into the ACK to send, if any,
+        according to the `auto_ack` policy.
+        """
+        return make_ack(message, result, self.auto_ack, self.ack_encoding)
     
-    def serve_forever(self):
+    def new_decoder(self) -> Union[MllpFrameDecoder, ZeroCopyFrameDecoder]:
+        """
+        Returns the frame decoder for a new connection.
+        """
+        if self.zero_copy:
+            return ZeroCopyFrameDecoder(max_message_size=self.max_message_size)
+        return MllpFrameDecoder(max_message_size=self.max_message_size, spill_threshold=self.spill_threshold)
+
+    def listen(self, reuse_port: bool = False) -> None:
+        """
+        Create the listening socket. This is done by `serve_forever()` if it hasn't
+        been done already, calling it beforehand allows binding to port 0 and then
+        finding the port picked by the OS in `self.port`.
+
+        With `reuse_port`, the socket is opened with `SO_REUSEPORT` so several
+        processes can listen on the same port, see `serve_prefork()`.
+        """
+        if self.socket is None:
+            self.socket = socket.create_server(('', self.port), reuse_port=reuse_port)
+            self.socket.setblocking(False)
+            self.port = self.socket.getsockname()[1]
+
+    def shutdown(self) -> None:
+        """
+        Ask `serve_forever()` to return. It can be called from any thread or from
+        the callback. All connections and the listening socket get closed.
+        """
+        self._shutdown_requested = True
+        self.wakeup()
+
+    def wakeup(self) -> None:
+        """
+        Wake up the server loop, safe to call from any thread.
+        """
+        wakeup_w = self._wakeup_w
+        if wakeup_w is not None:
+            try:
+                wakeup_w.send(b'\0')
+            except OSError:
+                pass  # Buffer full means a wake up is pending anyway, or we're closing.
+
+    def process_message(self,
+                        connection: ServerConnection,
+                        message: Union[bytes, memoryview, BinaryIO]) -> None:
+        """
+        Run the callback for `message`, received on `connection`, and queue the ACK.
+        """
+        spilled = not isinstance(message, (bytes, memoryview))
+        if self.metrics is not None:
+            self.metrics.inc('mllp_server_messages_received_total')
+            self.metrics.observe('mllp_server_frame_size_bytes', frame_size(message))
+        digest = None
+        if self.dedup is not None:
+            digest = self.dedup.digest(message)
+            ack = self.duplicate_ack(message, digest)
+            if ack is not None:
+                if spilled:
+                    message.close()
+                if self.auto_ack is not AckPolicy.OnReceipt and (connection.busy or connection.pending):
+                    connection.pending.append(DuplicateAck(ack))  # Wait for its turn.
+                else:
+                    self.queue_write(connection, START_BYTE + ack + END_BYTES)
+                return
+        if self.journal is not None:
+            self.journal.append(message)
+        if self.callback is None or self.auto_ack is AckPolicy.OnReceipt:
+            ack = self.make_ack(message, None)
+            if ack is not None:
+                self.queue_write(connection, START_BYTE + ack + END_BYTES)
+                if self.callback is not None:
+                    # Try to get the ACK out before the callback runs.
+                    self.write(connection)
+            self.remember(digest, None, ack)
+            if self.callback is None:
+                if spilled:
+                    message.close()
+                return
+        if self.executor is not None or connection.busy or connection.pending:
+            # Waits for the executor, or for the deferred ACK of the previous message.
+            # The file of a spilled frame is closed once the callback completed.
+            connection.pending.append(message if spilled else bytes(message))
+            if not connection.busy:
+                self.dispatch_next(connection)
+            return
+        try:
+            if self.auto_ack is AckPolicy.OnReceipt:
+                self.run_callback(message)
+            else:
+                result = self.run_callback(message)
+                if isinstance(result, Future):
+                    # The message is needed for the ACK, a spilled one is closed once completed.
+                    self.defer(connection, message if spilled else bytes(message), result)
+                    spilled = False
+                    return
+                ack = self.make_ack(message, result)
+                if ack is not None:
+                    self.queue_write(connection, START_BYTE + ack + END_BYTES)
+                self.remember(digest, result, ack)
+        finally:
+            if spilled:
+                message.close()
+
+    def duplicate_ack(self, message: Union[bytes, memoryview, BinaryIO], digest: Optional[bytes]) -> Optional[bytes]:
+        """
+        Returns the ACK to send if `message`, identified by `digest`, is a duplicate
+        of one accepted earlier, `None` otherwise.
+        """
+        if digest is None:
+            return None
+        cached = self.dedup.get(digest)
+        if cached is None:
+            return None
+        if self.metrics is not None:
+            self.metrics.inc('mllp_server_duplicates_total')
+        if isinstance(cached, bytes):
+            return cached
+        return self.make_ack(message, cached)
+
+    def remember(self, digest: Optional[bytes], result: Union[None, bytes, Acks], ack: Optional[bytes]) -> None:
+        """
+        Record the `ack` sent for a message in the dedup cache, if there is one.
+        """
+        if self.dedup is not None:
+            self.dedup.remember(digest, result, ack)
+
+    def run_callback(self, message: bytes) -> Union[None, bytes, Acks, Future]:
+        """
+        Call the callback in the server loop, timing it if there are metrics. An
+        awaitable returned by the callback is returned as a `Future`, see
+        `as_future()`, and a deferred result is timed until it's resolved.
+        """
+        start = time.perf_counter()
+        result = None
+        try:
+            try:
+                result = self.callback(message)
+            except Exception as e:
+                result = self.callback_failed(e)
+            result = self.as_future(result)
+            return result
+        finally:
+            if self.metrics is not None:
+                if isinstance(result, Future):
+                    result.add_done_callback(lambda _: self.metrics.observe('mllp_server_callback_seconds',
+                                                                            time.perf_counter() - start))
+                else:
+                    self.metrics.observe('mllp_server_callback_seconds', time.perf_counter() - start)
+
+    def callback_failed(self, error: Exception) -> Acks:
+        """
+        Called with the exception raised by the callback, or by its future. With
+        `AckPolicy.AfterCallback`, the message gets an AE and the server carries on,
+        the exception is re-raised otherwise.
+        """
+        if self.auto_ack is not AckPolicy.AfterCallback:
+            raise error
+        if self.metrics is not None:
+            self.metrics.inc('mllp_server_callback_errors_total')
+        traceback.print_exception(type(error), error, error.__traceback__)
+        return Acks.AE
+
+    def as_future(self, result: Union[None, bytes, Acks, Future, Awaitable]) -> Union[None, bytes, Acks, Future]:
+        """
+        Returns the `result` of a callback, with an awaitable scheduled on `loop`
+        and turned into a `concurrent.futures.Future`. An `MllpServerError` is
+        raised for an awaitable if there's no `loop`.
+        """
+        if result is None or isinstance(result, (bytes, Acks, Future)) or not inspect.isawaitable(result):
+            return result
+        if self.loop is None:
+            raise MllpServerError("The callback returned an awaitable, a loop is needed to run it.")
+        return asyncio.run_coroutine_threadsafe(_await(result), self.loop)
+
+    def defer(self,
+              connection: ServerConnection,
+              message: Union[bytes, BinaryIO],
+              future: Future,
+              submitted: Optional[float] = None) -> None:
+        """
+        Wait for `future`, the result of the callback for `message`, without holding
+        up the server loop. Until it's resolved, the next messages of `connection`
+        wait, so the ACKs go out in order. The callback's time is observed from
+        `submitted` on, if given.
+        """
+        connection.busy = True
+
+        def done(future: Future) -> None:
+            if self.metrics is not None and submitted is not None:
+                # Includes the time waiting for a worker.
+                self.metrics.observe('mllp_server_callback_seconds', time.perf_counter() - submitted)
+            self._completed.append((connection, message, future))
+            self.wakeup()
+
+        future.add_done_callback(done)
+
+    def dispatch_next(self, connection: ServerConnection) -> None:
+        """
+        Run the callback for the next pending messages of `connection`, in the
+        executor if there's one. Only one message per connection is in flight at
+        any time, and the messages are processed in order.
+        """
+        while not connection.closed and not connection.busy and connection.pending:
+            message = connection.pending.popleft()
+            if isinstance(message, DuplicateAck):
+                self.queue_write(connection, START_BYTE + message.ack + END_BYTES)
+                continue
+            if self.executor is not None:
+                self.defer(connection, message, self.executor.submit(self.callback, message), time.perf_counter())
+                return
+            result = self.run_callback(message)
+            if isinstance(result, Future) and self.auto_ack is not AckPolicy.OnReceipt:
+                self.defer(connection, message, result)
+                return
+            self.complete(connection, message, result)
+
+    def complete(self, connection: ServerConnection, message: Union[bytes, BinaryIO],
+                 result: Union[None, bytes, Acks]) -> None:
+        """
+        Queue the ACK for `message` given the `result` of its callback.
+        """
+        if self.auto_ack is not AckPolicy.OnReceipt:
+            ack = self.make_ack(message, result)
+            if ack is not None:
+                self.queue_write(connection, START_BYTE + ack + END_BYTES)
+            if self.dedup is not None:
+                self.remember(self.dedup.digest(message), result, ack)
+        if not isinstance(message, bytes):
+            message.close()  # Spilled frame
+
+    def process_completed(self) -> None:
+        """
+        Queue the ACKs of the callbacks that completed in the executor, or whose
+        deferred result was resolved, and move on to the next message of their
+        connection.
+        """
+        while self._completed:
+            connection, message, future = self._completed.popleft()
+            connection.busy = False
+            try:
+                result = future.result()
+            except Exception as e:
+                result = self.callback_failed(e)
+            if self.auto_ack is not AckPolicy.OnReceipt:
+                result = self.as_future(result)
+                if isinstance(result, Future):
+                    # A callback in the executor deferred its result too.
+                    self.defer(connection, message, result)
+                    continue
+            self.complete(connection, message, result)
+            self.dispatch_next(connection)
+
+    def update_events(self, connection: ServerConnection) -> None:
+        """
+        Register `connection` for the events matching its state: writability while
+        there's data to send, readability unless reading is paused.
+        """
+        events = 0 if connection.paused else selectors.EVENT_READ
+        if connection.writing:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(connection.sock, events, connection)
+
+    def queue_write(self, connection: ServerConnection, data: bytes) -> None:
+        """
+        Queue `data` to be sent on `connection` as soon as the socket allows it.
+        Reading from the connection is paused if this takes the queue over the
+        high water mark.
+
+        With a journal, the data is held until the journal is synced, see
+        `release_held()`.
+        """
+        if connection.closed:
+            return
+        if self.journal is not None:
+            connection.held.append(data)
+            self._held.add(connection)
+            return
+        self.buffer_write(connection, data)
+
+    def release_held(self) -> None:
+        """
+        Sync the journal and queue all the data held until then. Called by the
+        server loop at the end of every iteration.
+        """
+        if not self._held:
+            return
+        self.journal.sync()
+        for connection in self._held:
+            if connection.closed:
+                continue
+            for data in connection.held:
+                self.buffer_write(connection, data)
+            connection.held.clear()
+            self.write(connection)
+        self._held.clear()
+
+    def buffer_write(self, connection: ServerConnection, data: bytes) -> None:
+        """
+        Add `data` to the write queue of `connection`, see `queue_write()`.
+        """
+        connection.write_queue.append(memoryview(data))
+        connection.write_size += len(data)
+        if self.metrics is not None:
+            self.metrics.inc('mllp_server_messages_sent_total')
+            self.metrics.gauge_add('mllp_server_write_queue_bytes', len(data))
+        changed = False
+        if not connection.writing:
+            connection.writing = True
+            changed = True
+        if not connection.paused and connection.write_size > self.write_high_water:
+            connection.paused = True
+            changed = True
+            if self.metrics is not None:
+                self.metrics.inc('mllp_server_read_pauses_total')
+            if self.frame_timeout is not None:
+                self.schedule_check(connection, connection.last_activity + self.frame_timeout)
+        if changed:
+            self.update_events(connection)
+
+    def write(self, connection: ServerConnection) -> None:
+        """
+        Send as much of the pending data of `connection` as the socket allows.
+        Reading resumes once the queue is down to the low water mark.
+        """
+        if connection.closed or not connection.write_queue:
+            return
+        queue = connection.write_queue
+        while queue:
+            try:
+                count = connection.sock.send(queue[0])
+            except BlockingIOError:
+                break
+            except OSError:
+                self.close_connection(connection)
+                return
+            connection.write_size -= count
+            connection.last_activity = time.monotonic()
+            if self.metrics is not None:
+                self.metrics.inc('mllp_server_bytes_sent_total', count)
+                self.metrics.gauge_add('mllp_server_write_queue_bytes', -count)
+            if count < len(queue[0]):
+                queue[0] = queue[0][count:]  # A view, the data isn't copied.
+                break
+            queue.popleft()
+        changed = False
+        if not queue and connection.writing:
+            # Nothing left to send, stop waking up for writability.
+            connection.writing = False
+            changed = True
+        if connection.paused and connection.write_size <= self.write_low_water:
+            connection.paused = False
+            changed = True
+        if changed:
+            self.update_events(connection)
+
+    def read(self, connection: ServerConnection) -> None:
+        """
+        Read from `connection` and process every complete message received.
+        """
+        if connection.paused:
+            return
+        try:
+            if self.zero_copy:
+                count = connection.decoder.recv_into(connection.sock, BUFSIZE)
+            else:
+                data = connection.sock.recv(BUFSIZE)
+                count = len(data)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close_connection(connection)
+            return
+        if not count:
+            self.close_connection(connection)  # Closed by the client.
+            return
+        connection.last_activity = time.monotonic()
+        if self.metrics is not None:
+            self.metrics.inc('mllp_server_bytes_received_total', count)
+        if not self.zero_copy:
+            connection.decoder.feed(data)
+        self.process_buffered(connection)
+
+    def process_buffered(self, connection: ServerConnection) -> None:
+        """
+        Process the complete messages already read from `connection`, until there
+        are none left or reading gets paused.
+        """
+        # Process every message we got, there could be several.
+        while not connection.closed and not connection.paused:
+            try:
+                message = connection.decoder.next_frame()
+            except MllpMessageTooLarge:
+                self.close_connection(connection)
+                return
+            if message is None:
+                if self.frame_timeout is not None:
+                    self.track_frame(connection)
+                return
+            connection.frame_started = None
+            try:
+                self.process_message(connection, message)
+            finally:
+                connection.decoder.release()
+
+    def track_frame(self, connection: ServerConnection) -> None:
+        """
+        Note when the incomplete frame of `connection`, if any, was started, for
+        the `frame_timeout`.
+        """
+        if not connection.decoder.in_frame():
+            connection.frame_started = None
+        elif connection.frame_started is None:
+            connection.frame_started = time.monotonic()
+            self.schedule_check(connection, connection.frame_started + self.frame_timeout)
+
+    def schedule_check(self, connection: ServerConnection, deadline: float) -> None:
+        """
+        Make sure the timeouts of `connection` are checked at `deadline` at the latest.
+        """
+        if connection.check_at is None or deadline < connection.check_at:
+            connection.check_at = deadline
+            heapq.heappush(self._timers, (deadline, next(self._timer_sequence), connection))
+
+    def next_deadline(self, connection: ServerConnection, now: float) -> Optional[float]:
+        """
+        When `connection` times out if nothing happens until then, `None` if never.
+        """
+        deadlines = []
+        if self.idle_timeout is not None:
+            if connection.busy or connection.pending or connection.held:
+                connection.last_activity = now  # Not idle, waiting on us.
+            # ACKs waiting to be sent don't count, only bytes actually sent do, or
+            # a client that stops reading its ACKs would never time out.
+            deadlines.append(connection.last_activity + self.idle_timeout)
+        if self.frame_timeout is not None:
+            if connection.paused:
+                # The messages are held back by us, for as long as the client keeps
+                # reading its ACKs. Once it stops, the exchange is stuck on its side.
+                deadlines.append(connection.last_activity + self.frame_timeout)
+            elif connection.frame_started is not None:
+                deadlines.append(connection.frame_started + self.frame_timeout)
+        return min(deadlines, default=None)
+
+    def expire_connections(self) -> None:
+        """
+        Close the connections that timed out. Called by the server loop on every
+        iteration.
+        """
+        timers = self._timers
+        if not timers or timers[0][0] > time.monotonic():
+            return
+        now = time.monotonic()
+        while timers and timers[0][0] <= now:
+            deadline, _, connection = heapq.heappop(timers)
+            if connection.closed or connection.check_at != deadline:
+                continue  # Stale
+            connection.check_at = None
+            deadline = self.next_deadline(connection, now)
+            if deadline is None:
+                continue
+            if deadline > now:
+                self.schedule_check(connection, deadline)
+                continue
+            if self.metrics is not None:
+                idle = self.idle_timeout is not None and connection.last_activity + self.idle_timeout <= now
+                self.metrics.inc('mllp_server_idle_timeouts_total' if idle else 'mllp_server_frame_timeouts_total')
+            self.close_connection(connection)
+
+    def accept(self) -> None:
+        """
+        Accept a new client connection.
+        """
+        try:
+            sock, address = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        host = address[0] if isinstance(address, tuple) else address
+        if (self.max_connections is not None and len(self.connections) >= self.max_connections
+                or self.max_connections_per_address is not None
+                and self._per_address.get(host, 0) >= self.max_connections_per_address):
+            sock.close()
+            if self.metrics is not None:
+                self.metrics.inc('mllp_server_connections_rejected_total')
+            return
+        sock.setblocking(False)
+        connection = ServerConnection(sock, address, self.new_decoder())
+        self.connections[sock] = connection
+        self._per_address[host] = self._per_address.get(host, 0) + 1
+        self.selector.register(sock, selectors.EVENT_READ, connection)
+        if self.idle_timeout is not None:
+            self.schedule_check(connection, connection.last_activity + self.idle_timeout)
+        if self.metrics is not None:
+            self.metrics.inc('mllp_server_connections_accepted_total')
+            self.metrics.gauge_add('mllp_server_connections_open', 1)
+
+    def close_connection(self, connection: ServerConnection) -> None:
+        """
+        Close `connection` and forget about it. Pending ACKs are discarded.
+        """
+        if connection.closed:
+            return
+        connection.closed = True
+        self.selector.unregister(connection.sock)
+        del self.connections[connection.sock]
+        host = connection.address[0] if isinstance(connection.address, tuple) else connection.address
+        if self._per_address.get(host, 0) > 1:
+            self._per_address[host] -= 1
+        else:
+            self._per_address.pop(host, None)
+        if isinstance(connection.decoder, MllpFrameDecoder):
+            connection.decoder.clear()  # Closes the file of a frame being spilled.
+        for message in connection.pending:
+            if not isinstance(message, (bytes, DuplicateAck)):
+                message.close()  # Spilled frame
+        connection.pending.clear()
+        if self.metrics is not None:
+            self.metrics.gauge_add('mllp_server_connections_open', -1)
+            if connection.write_size:
+                self.metrics.gauge_add('mllp_server_write_queue_bytes', -connection.write_size)
+        try:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # Already disconnected.
+        connection.sock.close()
+
+    def serve_forever(self, poll_interval: float = 0.1) -> None:
         """
         Main loop of the server.
 
-        When a message is received, the callback will be called. The server is paused while
-        the callback processes. There is absolutely no concurrency in play.
+        When a message is received, the callback will be called. Without an `executor`,
+        the callback runs in this loop and the server is paused while it processes. With
+        one, or when the callback defers its result, the loop keeps serving the other
+        connections meanwhile, see the class documentation.
+
+        Every complete message read from a connection is processed right away, in order,
+        so a client sending several messages without waiting for ACKs is never stalled.
+        A client sending a message larger than `max_message_size` gets disconnected.
+
+        The sockets are watched with the best mechanism available on the platform (epoll
+        on Linux) through the `selectors` module, so idle connections cost nothing. The
+        `poll_interval` is how often `shutdown()` requests are checked for.
         """
-        server_sock = socket.create_server(('', self.port))
-        server_sock.setblocking(False)
-        clients: dict[socket.socket, tuple[str, int]] = {}
-        read_buffers: dict[socket.socket, bytes] = {}
-        write_buffers: dict[socket.socket, bytes] = {}
-        client_socks = [server_sock]
-        while True:
-            ready_r, ready_w, _ = select.select(client_socks, write_buffers.keys(), [], 0.1)
-            
-            for sock in ready_w:
-                if sock in write_buffers:
-                    buf = write_buffers[sock]
-                    try:
-                        count = sock.send(buf)
-                    except OSError:
-                        del clients[sock]
-                        del read_buffers[sock]
-                        del write_buffers[sock]
-                        client_socks.remove(sock)
-                        sock.shutdown(socket.SHUT_RDWR)
-                        sock.close()
+        self.listen()
+        self._shutdown_requested = False
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        try:
+            while not self._shutdown_requested:
+                timeout = poll_interval
+                if self._timers:
+                    timeout = max(0.0, min(poll_interval, self._timers[0][0] - time.monotonic()))
+                for key, events in self.selector.select(timeout):
+                    connection = key.data
+                    if key.fileobj is self._wakeup_r:
+                        try:
+                            while self._wakeup_r.recv(BUFSIZE):
+                                pass
+                        except BlockingIOError:
+                            pass
                         continue
-                    buf = buf[count:]
-                    if len(buf) > 0:
-                        write_buffers[sock] = buf
-                    else:
-                        del write_buffers[sock]
-            
-            for sock in ready_r:
-                if sock == server_sock:
-                    conn, addr = sock.accept()
-                    clients[conn] = addr
-                    client_socks.append(conn)
-                    read_buffers[conn] = b''
-                    conn.setblocking(False)
-                elif sock in read_buffers:
-                    buf = read_buffers[sock]
-                    try:
-                        buf += sock.recv(BUFSIZE)
-                    except OSError:
-                        del clients[sock]
-                        del read_buffers[sock]
-                        del write_buffers[sock]
-                        client_socks.remove(sock)
-                        sock.shutdown(socket.SHUT_RDWR)
-                        sock.close()
+                    if connection is None:
+                        self.accept()
                         continue
-                    index = buf.find(START_BYTE)
-                    if index == -1:
-                        buf = b''
-                    else:
-                        buf = buf[index:]
-                    index = buf.find(END_BYTES)
-                    message = None
-                    if index != -1:
-                        message = buf[1:index]
-                        buf = buf[index:]
-                    read_buffers[sock] = buf
-                    # We got a message! Process it.
-                    if message is not None:
-                        ack = self.callback(message)
-                        if ack is not None:
-                            if sock not in write_buffers:
-                                write_buffers[sock] = b''
-                            write_buffers[sock] += START_BYTE + ack + END_BYTES
+                    if events & selectors.EVENT_WRITE:
+                        self.write(connection)
+                        if len(connection.decoder) and not connection.paused:
+                            # Messages left over when reading was paused.
+                            self.process_buffered(connection)
+                    if events & selectors.EVENT_READ:
+                        self.read(connection)
+                self.process_completed()
+                self.release_held()
+                self.expire_connections()
+        finally:
+            if self.journal is not None and not self.journal.closed:
+                self.journal.sync()
+            self._held.clear()
+            for connection in list(self.connections.values()):
+                self.close_connection(connection)
+            self.selector.close()
+            self.selector = None
+            self.socket.close()
+            self.socket = None
+            wakeup_r, wakeup_w = self._wakeup_r, self._wakeup_w
+            self._wakeup_r = self._wakeup_w = None
+            wakeup_r.close()
+            wakeup_w.close()
+            self._completed.clear()
+            self._timers.clear()
+            self._per_address.clear()
+
+
+    def serve_prefork(self,
+                      workers: int,
+                      worker_init: Optional[Callable[[MllpServer], None]] = None,
+                      poll_interval: float = 0.1,
+                      restart_delay: float = 1.0) -> None:
+        """
+        Run `workers` processes each running `serve_forever()` with their own
+        `SO_REUSEPORT` socket on `self.port`. The kernel spreads the incoming
+        connections across them, so parsing and callbacks can use all the cores.
+
+        The calling process becomes a supervisor that restarts any worker that
+        dies. A worker dying less than `restart_delay` seconds after it was started
+        is restarted only once that delay has passed, so a crashing callback can't
+        turn into a fork loop. Calling `shutdown()`, or sending SIGTERM or SIGINT to
+        the supervisor when it runs in the main thread, stops the workers with a
+        SIGTERM and returns.
+
+        Threads don't survive `os.fork()`, so an `executor` must be created in each
+        worker. `worker_init` is called with the server in every worker before it
+        starts serving, which is the place to do it:
+
+        ```
+        def worker_init(server):
+            server.executor = ThreadPoolExecutor(max_workers=8)
 
+        MllpServer(port=2575, callback=callback).serve_prefork(workers=4, worker_init=worker_init)
+        ```
+
+        Only available on platforms with `os.fork()` and `SO_REUSEPORT`, like Linux,
+        an `MllpServerError` is raised otherwise.
+        """
+        if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+            raise MllpServerError("Pre-forking needs os.fork() and SO_REUSEPORT, not available on this platform.")
+        if workers < 1:
+            raise MllpServerError("At least one worker is needed.")
+        if self.socket is not None:
+            raise MllpServerError("The server is already listening, workers need their own socket.")
+        # Hold the port, without listening so no connection is queued here. This
+        # also resolves port 0 to an actual port for all workers.
+        reservation = socket.socket(socket.AF_INET)  # Same as socket.create_server()
+        reservation.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        reservation.bind(('', self.port))
+        self.port = reservation.getsockname()[1]
+
+        def stop(signum, frame) -> None:
+            self.shutdown()
+
+        previous_handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                previous_handlers[signum] = signal.signal(signum, stop)
+
+        self._shutdown_requested = False
+        self.worker_pids = {}
+        restart_at: list[float] = []
+        try:
+            for _ in range(workers):
+                self._start_worker(worker_init)
+            while not self._shutdown_requested:
+                try:
+                    pid, _ = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    pid = 0
+                if pid in self.worker_pids:
+                    started = self.worker_pids.pop(pid)
+                    restart_at.append(max(time.monotonic(), started + restart_delay))
+                    continue  # Check right away for more dead workers.
+                now = time.monotonic()
+                for when in [w for w in restart_at if w <= now]:
+                    restart_at.remove(when)
+                    self._start_worker(worker_init)
+                time.sleep(poll_interval)
+        finally:
+            for pid in self.worker_pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            for pid in self.worker_pids:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+            self.worker_pids = {}
+            reservation.close()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+    def _start_worker(self, worker_init: Optional[Callable[[MllpServer], None]]) -> None:
+        pid = os.fork()
+        if pid != 0:
+            self.worker_pids[pid] = time.monotonic()
+            return
+        # In the worker. Never return from here, it would run the supervisor's code.
+        code = 0
+        try:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda signum, frame: self.shutdown())
+            self.worker_pids = {}
+            self.connections = {}
+            self._completed.clear()
+            self._timers.clear()
+            self._per_address.clear()
+            if worker_init is not None:
+                worker_init(self)
+            self.listen(reuse_port=True)
+            self.serve_forever()
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+
+async def _await(awaitable: Awaitable):
+    # run_coroutine_threadsafe() only takes coroutines.
+    return await awaitable
+
+
+class DuplicateAck:
+    """
+    The ACK of a duplicate, queued behind the messages of a connection still
+    waiting for the executor so the ACKs stay in order.
+    """
+    def __init__(self, ack: bytes) -> None:
+        self.ack = ack
+
+
+class ServerConnection:
+    """
+    State of a client connection to an `MllpServer`.
+    """
+    def __init__(self,
+                 sock: socket.socket,
+                 address: tuple,
+                 decoder: Union[None, MllpFrameDecoder, ZeroCopyFrameDecoder] = None) -> None:
+        self.sock = sock
+        self.address = address
+        self.decoder = decoder if decoder is not None else MllpFrameDecoder()
+        self.write_queue: deque[memoryview] = deque()
+        self.write_size = 0  # Bytes in write_queue
+        self.writing = False  # Registered for EVENT_WRITE
+        self.paused = False  # Not registered for EVENT_READ, over the high water mark
+        self.held: list[bytes] = []  # Waiting for the journal to be synced
+        self.closed = False
+        self.pending: deque[Union[bytes, BinaryIO, DuplicateAck]] = deque()  # Waiting for the executor
+        self.busy = False  # A message is in the executor
+        self.last_activity = time.monotonic()  # Last bytes received or sent
+        self.frame_started: Optional[float] = None  # When the incomplete frame started
+        self.check_at: Optional[float] = None  # Next timeout check scheduled
@@ -1,8 +1,10 @@
 from __future__ import annotations
 from typing import Union, Optional, Iterable
 import re
+import time
 
 from .exceptions import *
+from .metrics import Metrics
 
 
 class Hl7Component:
@@ -503,7 +505,8 @@ class Hl7Parser:
                  ignore_invalid_segments: bool = False,
                  allow_unterminated_last_segment: bool = False,
                  ignore_msh_values_for_parsing: bool = False,
-                 allow_multiple_msh: bool = False) -> None:
+                 allow_multiple_msh: bool = False,
+                 metrics: Optional[Metrics] = None) -> None:
         """
         All arguments are optional and used to alter how strict the parser
         behaviour will be.
@@ -528,6 +531,10 @@ class Hl7Parser:
         
         `allow_multiple_msh` -- Treat any MSH segments after the first one as if they were an
                                 ordinary segment instead of raising an exception.
+
+        A `hl7lw.metrics.Metrics` instance can be given as `metrics` to record how
+        long `parse_message()` and `format_message()` take and how many messages
+        fail to parse.
         
         The default control characters are per the spec:
 
@@ -553,14 +560,16 @@ class Hl7Parser:
         self.allow_unterminated_last_segment = allow_unterminated_last_segment
         self.ignore_msh_values_for_parsing = ignore_msh_values_for_parsing
         self.allow_multiple_msh = allow_multiple_msh
+        self.metrics = metrics
     
     def parse_message(self,
-                      message: Union[bytes, str],
+                      message: Union[bytes, bytearray, memoryview, str],
                       encoding: Optional[str] = 'ascii') -> Hl7Message:
         """
         Parse a `message` which can either be a `str` or a `bytes`. If the
-        `message` is a `bytes` then then `encoding` option will be used to
-        `decode` it into a `str` first. The default value of `encoding` is
+        `message` is a `bytes`, or any bytes-like object like the `memoryview`
+        frames of a zero-copy `MllpServer`, then then `encoding` option will be
+        used to `decode` it into a `str` first. The default value of `encoding` is
         "ascii". The possibly encodings are all the encodings supported by
         the python interpreter.
 
@@ -575,8 +584,22 @@ class Hl7Parser:
         be disabled with the `ignore_msh_values_for_parsing` constructor
         option.
         """
-        if isinstance(message, bytes):
-            message = message.decode(encoding=encoding)
+        if self.metrics is None:
+            return self._parse_message(message, encoding)
+        start = time.perf_counter()
+        try:
+            hl7_msg = self._parse_message(message, encoding)
+        except (Hl7Exception, UnicodeDecodeError):
+            self.metrics.inc('parser_errors_total')
+            raise
+        self.metrics.observe('parser_parse_seconds', time.perf_counter() - start)
+        return hl7_msg
+
+    def _parse_message(self,
+                       message: Union[bytes, bytearray, memoryview, str],
+                       encoding: Optional[str]) -> Hl7Message:
+        if not isinstance(message, str):
+            message = str(message, encoding=encoding)
         hl7_msg = Hl7Message(parser=self)
         if self.newline_as_terminator:
             # We do \r\n collapsing as \r\r would yield illegal empty segments
@@ -604,7 +627,7 @@ class Hl7Parser:
         return hl7_msg
     
     def parse_segment(self,
-                      segment: Union[bytes, str],
+                      segment: Union[bytes, bytearray, memoryview, str],
                       allow_msh: Optional[bool] = True,
                       encoding: Optional[str] = 'ascii') -> Hl7Segment:
         """
@@ -618,8 +641,8 @@ class Hl7Parser:
         can also be used to create an `Hl7Segment` object from a string
         representation.
         """
-        if isinstance(segment, bytes):
-            segment = segment.decode(encoding=encoding)
+        if not isinstance(segment, str):
+            segment = str(segment, encoding=encoding)
         if len(segment) < 4:
             raise InvalidSegment(f"Segment is too short to be valid: [{segment}]")
         if segment.startswith('MSH'):
@@ -681,6 +704,14 @@ class Hl7Parser:
         not specified, a `str` representation will be returned and the caller
         is responsible to encode to `bytes` if necessary.
         """
+        if self.metrics is not None:
+            with self.metrics.timer('parser_format_seconds'):
+                return self._format_message(message, encoding)
+        return self._format_message(message, encoding)
+
+    def _format_message(self,
+                        message: Hl7Message,
+                        encoding: Optional[str]) -> Union[str, bytes]:
         formatted_segments = []
         for segment in message.segments:
             formatted_segments.append(self.format_segment(segment))
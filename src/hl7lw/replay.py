@@ -0,0 +1,447 @@
+"""
+Replay captured HL7 traffic to an MLLP listener.
+
+Reads capture files, either MLLP-framed (a raw dump of the bytes received on a
+connection) or plain/batch files with one segment per line, and sends the
+messages with `MllpClient`, at their original pace, faster or slower with
+`--speed`, or at a fixed `--rate`. The ACK of every message is recorded.
+
+```
+python -m hl7lw.replay engine-test 2575 capture.mllp --speed 4 --streams 4 --results acks.jsonl
+python -m hl7lw.replay engine-test 2575 captures/ --rate 2000 --json
+```
+
+The original timing comes from MSH-7, relative to the first message. A message
+without a usable MSH-7 keeps the time of the one before it, and time never goes
+backward. With second-resolution timestamps, the messages of the same second go
+out back to back, as a burst. `--max-gap` shortens long quiet periods, like
+nights.
+
+Every message has a scheduled time computed upfront and the streams wait for
+that absolute time, so a late send never shifts the ones after it and the
+replay doesn't drift under load. How late each send was is reported as the lag.
+
+With several `--streams`, messages are spread over as many connections, by
+sending application and facility by default so the order is kept per sender,
+or round robin.
+"""
+from __future__ import annotations
+from concurrent.futures import Future
+from typing import Iterator, Optional
+import argparse
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+
+from .bench import percentile, PERCENTILES
+from .exceptions import Hl7Exception, MllpException
+from .mllp import MllpClient, MllpFrameDecoder, MllpPipeline, START_BYTE
+from .utils import Acks, peek_msh, peek_msa
+
+
+SPIN_THRESHOLD = 0.001  # Below this, yield instead of sleeping, sleep() overshoots.
+BATCH_SEGMENTS = ('FHS', 'BHS', 'BTS', 'FTS')
+ACCEPTED = (Acks.AA.name, Acks.CA.name)
+
+
+def read_capture(path: str) -> Iterator[bytes]:
+    """
+    Yield the messages of the capture file `path`. A file holding MLLP start
+    bytes is read as MLLP frames, anything else as text with one segment per line,
+    where every MSH starts a new message and the batch segments are dropped.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if START_BYTE in data:
+        decoder = MllpFrameDecoder(max_message_size=len(data))
+        decoder.feed(data)
+        while True:
+            message = decoder.next_frame()
+            if message is None:
+                return
+            yield message
+    message = []
+    for line in data.replace(b'\r\n', b'\r').replace(b'\n', b'\r').split(b'\r'):
+        if not line.strip() or line[:3].decode('ascii', 'replace') in BATCH_SEGMENTS:
+            continue
+        if line.startswith(b'MSH') and message:
+            yield b'\r'.join(message) + b'\r'
+            message = []
+        message.append(line)
+    if message:
+        yield b'\r'.join(message) + b'\r'
+
+
+def read_captures(paths: list[str]) -> list[bytes]:
+    """
+    Messages of all the capture files in `paths`, files or directories of files,
+    in order.
+    """
+    messages = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+            messages.extend(m for name in names if os.path.isfile(name) for m in read_capture(name))
+        else:
+            messages.extend(read_capture(path))
+    return messages
+
+
+def parse_timestamp(value: str) -> Optional[datetime.datetime]:
+    """
+    Parse an HL7 DTM, `YYYY[MM[DD[HH[MM[SS[.S[S[S[S]]]]]]]]][+/-ZZZZ]`. Without an
+    offset, the local time zone is assumed. Returns `None` if it can't be parsed.
+    """
+    offset = None
+    for sign in ('+', '-'):
+        if sign in value:
+            value, zone = value.split(sign, 1)
+            if len(zone) != 4 or not zone.isdigit():
+                return None
+            minutes = int(zone[:2]) * 60 + int(zone[2:])
+            offset = datetime.timezone(datetime.timedelta(minutes=minutes if sign == '+' else -minutes))
+            break
+    value, _, fraction = value.partition('.')
+    if len(value) < 4 or len(value) > 14 or len(value) % 2 or not value.isdigit():
+        return None
+    if fraction and not fraction.isdigit():
+        return None
+    parts = [int(value[0:4])] + [int(value[i:i + 2]) for i in range(4, len(value), 2)]
+    while len(parts) < 3:
+        parts.append(1)  # Month and day default to the first.
+    try:
+        stamp = datetime.datetime(*parts, microsecond=int((fraction + '000000')[:6]))
+    except ValueError:
+        return None
+    if offset is None:
+        return stamp.astimezone()
+    return stamp.replace(tzinfo=offset)
+
+
+def message_time(message: bytes, encoding: str = 'ascii') -> Optional[float]:
+    """
+    MSH-7 of `message` as a POSIX timestamp, or `None`.
+    """
+    try:
+        msh = peek_msh(message, encoding=encoding)
+        value = msh[7].split(msh.parser.component_separator)[0]  # Older versions have TS^precision
+    except (Hl7Exception, UnicodeDecodeError):
+        return None
+    stamp = parse_timestamp(value)
+    return None if stamp is None else stamp.timestamp()
+
+
+def schedule(messages: list[bytes],
+             speed: float = 1.0,
+             rate: Optional[float] = None,
+             max_gap: Optional[float] = None,
+             encoding: str = 'ascii') -> list[float]:
+    """
+    Send time of every message, in seconds from the start of the replay. With a
+    `rate`, messages are evenly spaced, otherwise they follow MSH-7 divided by
+    `speed`, with gaps between consecutive messages capped to `max_gap` seconds
+    of replay time.
+    """
+    if rate is not None:
+        return [i / rate for i in range(len(messages))]
+    offsets = []
+    previous_time = None
+    offset = 0.0
+    for message in messages:
+        stamp = message_time(message, encoding=encoding)
+        if stamp is not None:
+            if previous_time is not None and stamp > previous_time:
+                gap = (stamp - previous_time) / speed
+                offset += gap if max_gap is None else min(gap, max_gap)
+            if previous_time is None or stamp > previous_time:
+                previous_time = stamp
+        offsets.append(offset)
+    return offsets
+
+
+def sleep_until(deadline: float) -> None:
+    """
+    Wait until `time.perf_counter()` reaches `deadline`.
+    """
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return
+        time.sleep(remaining - SPIN_THRESHOLD if remaining > SPIN_THRESHOLD else 0)
+
+
+class ReplayResult:
+    """
+    What happened to one message of the replay. `lag` is how late it was sent
+    compared to its schedule, including any wait for the pipeline window, and
+    `latency` the time from then until its ACK, both in seconds. `ack_code` is
+    MSA-1, `None` if no ACK was received, in which case `error` says why.
+    """
+    def __init__(self, index: int, stream: int, message_id: Optional[str], scheduled: float) -> None:
+        self.index = index
+        self.stream = stream
+        self.message_id = message_id
+        self.scheduled = scheduled
+        self.lag: Optional[float] = None
+        self.latency: Optional[float] = None
+        self.ack_code: Optional[str] = None
+        self.error: Optional[str] = None
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+
+class Replayer:
+    """
+    Replays `messages` to `host`:`port`, see the module documentation. `offsets`
+    gives the send time of every message, in seconds from the start, as returned
+    by `schedule()`.
+
+    With `pipeline` above 1, each stream keeps up to that many messages in flight
+    with an `MllpPipeline`, to keep up with the schedule on slow links. ACKs are
+    then matched in order.
+
+    In both modes, a stream whose connection fails records the error for the
+    messages affected and reconnects for the next one. Only the first connections,
+    made by `run()`, are not retried: an `MllpConnectionError` is raised if the
+    target can't be reached.
+    """
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 messages: list[bytes],
+                 offsets: list[float],
+                 streams: int = 1,
+                 partition: str = 'sender',
+                 pipeline: int = 1,
+                 timeout: Optional[float] = 30.0,
+                 encoding: str = 'ascii') -> None:
+        if len(offsets) != len(messages):
+            raise ValueError("One offset is needed per message.")
+        if partition not in ('sender', 'round-robin'):
+            raise ValueError(f"Unknown partition {partition!r}.")
+        self.host = host
+        self.port = port
+        self.messages = messages
+        self.offsets = offsets
+        self.streams = streams
+        self.partition = partition
+        self.pipeline = pipeline
+        self.timeout = timeout
+        self.encoding = encoding
+        self.results: list[ReplayResult] = []
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def _stream_of(self, index: int, message: bytes) -> int:
+        if self.partition == 'round-robin':
+            return index % self.streams
+        try:
+            msh = peek_msh(message, encoding=self.encoding)
+            key = f"{msh[3]}|{msh[4]}"
+        except (Hl7Exception, UnicodeDecodeError):
+            key = ''
+        return zlib.crc32(key.encode('utf-8')) % self.streams
+
+    def run(self) -> list[ReplayResult]:
+        """
+        Replay everything and return the results, in message order.
+        """
+        assigned: list[list[int]] = [[] for _ in range(self.streams)]
+        self.results = []
+        for index, message in enumerate(self.messages):
+            stream = self._stream_of(index, message)
+            assigned[stream].append(index)
+            try:
+                message_id = peek_msh(message, encoding=self.encoding)[10]
+            except (Hl7Exception, UnicodeDecodeError):
+                message_id = None
+            self.results.append(ReplayResult(index, stream, message_id, self.offsets[index]))
+        clients = []
+        try:
+            for _ in range(self.streams):
+                client = MllpClient()
+                clients.append(client)
+                self._connect(client)
+        except MllpException:
+            for client in clients:
+                if client.is_connected():
+                    client.close()
+            raise
+        # Leave the threads time to start so the first sends are on time.
+        start = time.perf_counter() + 0.05
+        threads = [threading.Thread(target=self._run_stream, args=(clients[i], assigned[i], start), daemon=True)
+                   for i in range(self.streams)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - start
+        for client in clients:
+            if client.is_connected():
+                client.close()
+        return self.results
+
+    def _connect(self, client: MllpClient) -> None:
+        client.connect(host=self.host, port=self.port)
+        if self.pipeline <= 1:
+            client.socket.settimeout(self.timeout)  # The pipeline has its own timeout.
+
+    def _reconnect(self, client: MllpClient, pipeline: Optional[MllpPipeline]) -> Optional[MllpPipeline]:
+        # Replaces a connection closed by a timeout or an error, in both modes, and
+        # returns the pipeline to send over, if pipelining.
+        if pipeline is not None and pipeline.broken is not None:
+            pipeline.close(wait=False)  # Its messages failed already.
+            pipeline = None
+            if client.is_connected():
+                client.close()
+        if not client.is_connected():
+            self._connect(client)
+        if self.pipeline > 1 and pipeline is None:
+            pipeline = MllpPipeline(client, window=self.pipeline, timeout=self.timeout, match_by_id=False,
+                                    encoding=self.encoding)
+        return pipeline
+
+    def _sent(self, result: ReplayResult, start: float) -> float:
+        # Once the message was handed over, a full window or socket buffer is lag too.
+        sent_at = time.perf_counter()
+        result.lag = sent_at - start - result.scheduled
+        return sent_at
+
+    def _ack(self, result: ReplayResult, ack: bytes) -> None:
+        try:
+            result.ack_code = peek_msa(ack, encoding=self.encoding)[1]
+        except (Hl7Exception, UnicodeDecodeError):
+            result.error = "Invalid ACK"
+
+    def _run_stream(self, client: MllpClient, indexes: list[int], start: float) -> None:
+        pipeline = None
+        try:
+            for index in indexes:
+                result = self.results[index]
+                sleep_until(start + result.scheduled)
+                try:
+                    pipeline = self._reconnect(client, pipeline)
+                    if pipeline is not None:
+                        self._submit(pipeline, result, self.messages[index], start)
+                        continue
+                    client.send(self.messages[index], auto_reconnect=False)
+                    sent_at = self._sent(result, start)
+                    ack = client.recv()
+                except MllpException as e:
+                    result.error = f"{type(e).__name__}: {e}"
+                    continue
+                result.latency = time.perf_counter() - sent_at
+                self._ack(result, ack)
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+
+    def _submit(self, pipeline: MllpPipeline, result: ReplayResult, message: bytes, start: float) -> None:
+        # The ACK may come before submit() returns, the latency is computed once
+        # both times are known.
+        times: dict[str, float] = {}
+
+        def latency() -> None:
+            if 'sent' in times and 'acked' in times:
+                result.latency = times['acked'] - times['sent']
+
+        def done(future: Future) -> None:
+            acked_at = time.perf_counter()
+            if future.cancelled():
+                result.error = "Cancelled"
+            elif future.exception() is not None:
+                e = future.exception()
+                result.error = f"{type(e).__name__}: {e}"
+            else:
+                self._ack(result, future.result())
+                with self._lock:
+                    times['acked'] = acked_at
+                    latency()
+
+        pipeline.submit(message, callback=done)
+        sent_at = self._sent(result, start)
+        with self._lock:
+            times['sent'] = sent_at
+            latency()
+
+    def report(self) -> dict:
+        """
+        Summary of the last `run()`.
+        """
+        codes: dict[str, int] = {}
+        for result in self.results:
+            key = result.ack_code if result.ack_code is not None else 'error'
+            codes[key] = codes.get(key, 0) + 1
+        lags = sorted(r.lag for r in self.results if r.lag is not None)
+        latencies = sorted(r.latency for r in self.results if r.latency is not None)
+        return {
+            'target': f"{self.host}:{self.port}",
+            'messages': len(self.results),
+            'streams': self.streams,
+            'pipeline': self.pipeline,
+            'scheduled_seconds': max(self.offsets, default=0.0),
+            'elapsed_seconds': self.elapsed,
+            'rate_per_second': len(self.results) / self.elapsed if self.elapsed > 0 else 0.0,
+            'ack_codes': codes,
+            'lag_seconds': {**{f"p{p:g}": percentile(lags, p) for p in PERCENTILES},
+                            'max': lags[-1] if lags else None},
+            'latency_seconds': {**{f"p{p:g}": percentile(latencies, p) for p in PERCENTILES},
+                                'max': latencies[-1] if latencies else None},
+        }
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m hl7lw.replay', description="Replay captured HL7 traffic.")
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('captures', nargs='+', help="Capture files, or directories of capture files.")
+    timing = parser.add_mutually_exclusive_group()
+    timing.add_argument('-s', '--speed', type=float, default=1.0,
+                        help="Multiple of the original pace from MSH-7, 2 is twice as fast.")
+    timing.add_argument('-r', '--rate', type=float, help="Fixed rate in messages per second instead.")
+    parser.add_argument('--max-gap', type=float, help="Longest wait between two messages, in seconds.")
+    parser.add_argument('--streams', type=int, default=1, help="Parallel connections.")
+    parser.add_argument('--partition', choices=('sender', 'round-robin'), default='sender',
+                        help="How messages are spread over the streams.")
+    parser.add_argument('-p', '--pipeline', type=int, default=1, help="Messages in flight per stream.")
+    parser.add_argument('--timeout', type=float, default=30.0, help="ACK timeout in seconds.")
+    parser.add_argument('--encoding', default='ascii')
+    parser.add_argument('--results', help="Write the outcome of every message to this file, as JSON lines.")
+    parser.add_argument('--json', action='store_true', help="Print the summary as JSON.")
+    args = parser.parse_args(argv)
+    if args.speed <= 0:
+        parser.error("--speed must be positive.")
+
+    messages = read_captures(args.captures)
+    offsets = schedule(messages, speed=args.speed, rate=args.rate, max_gap=args.max_gap, encoding=args.encoding)
+    replayer = Replayer(args.host, args.port, messages, offsets,
+                        streams=args.streams,
+                        partition=args.partition,
+                        pipeline=args.pipeline,
+                        timeout=args.timeout,
+                        encoding=args.encoding)
+    try:
+        results = replayer.run()
+    except MllpException as e:
+        print(f"Cannot replay to {args.host}:{args.port}: {e}", file=sys.stderr)
+        return 2
+    if args.results:
+        with open(args.results, 'w') as f:
+            for result in results:
+                f.write(json.dumps(result.as_dict()) + '\n')
+    report = replayer.report()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:<18} {value}")
+    return 0 if all(r.ack_code in ACCEPTED for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,394 @@
+from __future__ import annotations
+from concurrent.futures import Future
+from typing import BinaryIO, Callable, Iterable, Optional, Union
+import queue
+import re
+import threading
+import time
+import traceback
+
+from .exceptions import Hl7Exception, MllpException
+from .mllp import MllpClient
+from .parser import Hl7Field, Hl7Message, Hl7Parser, Hl7Reference, Hl7Segment
+from .utils import Acks, peek_msh, peek_msa
+
+
+Matcher = Union[str, Iterable[str], re.Pattern, Callable[[str], bool]]
+
+ACCEPTED = (Acks.AA.name, Acks.CA.name)
+REJECTED = (Acks.AR.name, Acks.CR.name)
+
+
+class Route:
+    """
+    A routing rule. A message matching all the `conditions` is sent to all the
+    `destinations`, by name. The conditions map a field reference, see
+    `Hl7Reference`, to what the field must be:
+
+    - a `str`, the field must be equal to it,
+    - a `set`, `list` or `tuple` of `str`, the field must be one of them,
+    - a compiled regular expression, the whole field must match it,
+    - a callable, called with the field and returning `True` for a match.
+
+    ```
+    Route(["lab", "archive"], {"MSH-9.1": "ORU", "MSH-4": {"LAB1", "LAB2"}})
+    Route(["oncology"], {"MSH-9": re.compile(r"ADT\\^A0[1-4]"), "PV1-3.1": "ONC"}, final=True)
+    ```
+
+    Conditions on the MSH are checked from the header alone, other references need
+    the message to be parsed, which is done once per message and only if a route
+    needs it. With several segments of the same name, like OBX, the condition holds
+    if it does for any of them. A missing segment or field is an empty string.
+
+    No conditions match every message. When a `final` route matches, the routes
+    after it are not checked.
+
+    The references are parsed when the route is created, an invalid one raises an
+    `InvalidHl7FieldReference` exception right away.
+    """
+    def __init__(self,
+                 destinations: Iterable[str],
+                 conditions: Optional[dict[str, Matcher]] = None,
+                 final: bool = False) -> None:
+        self.destinations = list(destinations)
+        self.final = final
+        self.conditions: list[tuple[Hl7Reference, Callable[[str], bool]]] = [
+            (Hl7Reference(reference), _compile_matcher(matcher))
+            for reference, matcher in (conditions or {}).items()
+        ]
+        self.needs_body = any(reference.segment_name != 'MSH' for reference, _ in self.conditions)
+
+    def matches(self, header: Hl7Segment, message: Optional[Hl7Message]) -> bool:
+        """
+        Check the route against the MSH `header` of a message and the message itself,
+        which must be parsed if `needs_body` is set.
+        """
+        for reference, matcher in self.conditions:
+            if reference.segment_name == 'MSH':
+                segments = [header]
+            else:
+                segments = message.get_segments(reference.segment_name) or [None]
+            if not any(matcher(_value(segment, reference)) for segment in segments):
+                return False
+        return True
+
+
+def _compile_matcher(matcher: Matcher) -> Callable[[str], bool]:
+    if isinstance(matcher, str):
+        return lambda value: value == matcher
+    if isinstance(matcher, re.Pattern):
+        return lambda value: matcher.fullmatch(value) is not None
+    if callable(matcher):
+        return matcher
+    choices = frozenset(matcher)
+    return lambda value: value in choices
+
+
+def _value(segment: Optional[Hl7Segment], reference: Hl7Reference) -> str:
+    if segment is None:
+        return ''
+    try:
+        return Hl7Field.get_by_reference(segment, reference)
+    except (Hl7Exception, IndexError):
+        return ''
+
+
+class Delivery:
+    """
+    A message waiting in the queue of a `Destination`. The `future` gets the
+    outcome, `Acks.AA` once delivered, `Acks.AR` if rejected by the destination
+    or `Acks.AE` if it could not be delivered.
+    """
+    def __init__(self, message: bytes) -> None:
+        self.message = message
+        self.attempts = 0
+        self.future: Future = Future()
+
+
+class Destination:
+    """
+    A downstream system messages are forwarded to, with its own queue and its own
+    thread, so a slow or unreachable destination never holds back the others.
+    Messages are sent one at a time, in the order they were queued, over a
+    connection kept open between messages.
+
+    A message is delivered once the destination answers with an AA or CA. An AR or
+    CR is final and the message is dropped. A connection error, a timeout after
+    `ack_timeout` seconds or an AE or CE is retried `retry_delay` seconds later,
+    up to `max_attempts` attempts in total, forever if `None`, after which the
+    message is given up on. Messages behind it wait meanwhile, to keep the order.
+
+    At most `queue_size` messages wait in the queue. When it's full, `enqueue()`
+    fails the message right away by default, so a stalled destination never holds
+    up the server calling `Router.submit()` and the traffic for the others. With
+    an `enqueue_timeout`, it blocks up to that many seconds first, forever if
+    `None`, which is only fit for a callback run in an executor.
+
+    With `wait_for_ack`, the upstream ACK of the `Router` waits for the outcome
+    of the delivery and reflects it. Otherwise the message only needs to be
+    queued, the destination is fire-and-forget as far as the sender is concerned.
+    """
+    def __init__(self,
+                 name: str,
+                 host: str,
+                 port: int,
+                 queue_size: int = 10000,
+                 enqueue_timeout: Optional[float] = 0.0,
+                 retry_delay: float = 1.0,
+                 max_attempts: Optional[int] = 5,
+                 ack_timeout: Optional[float] = 30.0,
+                 wait_for_ack: bool = True,
+                 encoding: str = 'ascii',
+                 client: Optional[MllpClient] = None) -> None:
+        self.name = name
+        self.host = host
+        self.port = port
+        self.enqueue_timeout = enqueue_timeout
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.ack_timeout = ack_timeout
+        self.wait_for_ack = wait_for_ack
+        self.encoding = encoding
+        self.client = client if client is not None else MllpClient()
+        self.delivered = 0
+        self.rejected = 0
+        self.failed = 0
+        self._queue: queue.Queue[Optional[Delivery]] = queue.Queue(maxsize=queue_size)
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"hl7lw-destination-{name}", daemon=True)
+        self._thread.start()
+
+    def backlog(self) -> int:
+        """
+        Number of messages waiting in the queue.
+        """
+        return self._queue.qsize()
+
+    def enqueue(self, message: bytes) -> Future:
+        """
+        Queue `message` for delivery and return the future of its outcome, see
+        `Delivery`.
+        """
+        delivery = Delivery(message)
+        if self._closing.is_set():
+            delivery.future.set_result(Acks.AE)
+            return delivery.future
+        try:
+            self._queue.put(delivery, block=self.enqueue_timeout != 0, timeout=self.enqueue_timeout)
+        except queue.Full:
+            self.failed += 1
+            delivery.future.set_result(Acks.AE)
+        return delivery.future
+
+    def _run(self) -> None:
+        while True:
+            delivery = self._queue.get()
+            if delivery is None:
+                return
+            try:
+                outcome = self._deliver(delivery)
+            except Exception:
+                # A bug rather than the destination failing, but it only costs
+                # this message, the next ones are still delivered.
+                traceback.print_exc()
+                outcome = Acks.AE
+            if outcome is Acks.AA:
+                self.delivered += 1
+            elif outcome is Acks.AR:
+                self.rejected += 1
+            else:
+                self.failed += 1
+            delivery.future.set_result(outcome)
+
+    def _deliver(self, delivery: Delivery) -> Acks:
+        while True:
+            delivery.attempts += 1
+            code = self._exchange(delivery.message)
+            if code in ACCEPTED:
+                return Acks.AA
+            if code in REJECTED:
+                return Acks.AR
+            if self.max_attempts is not None and delivery.attempts >= self.max_attempts:
+                return Acks.AE
+            if self._closing.wait(self.retry_delay):
+                return Acks.AE
+
+    def _exchange(self, message: bytes) -> Optional[str]:
+        # MSA-1 of the ACK, or None if there was none.
+        try:
+            if not self.client.is_connected():
+                self.client.connect(host=self.host, port=self.port)
+                self.client.socket.settimeout(self.ack_timeout)
+            self.client.send(message, auto_reconnect=False)
+            ack = self.client.recv()
+        except (MllpException, OSError):
+            # Like a socket that can't be configured. The next attempt reconnects.
+            if self.client.is_connected():
+                try:
+                    self.client.close()
+                except OSError:
+                    self.client.connected = False
+            return None
+        try:
+            return peek_msa(ack, encoding=self.encoding)[1]
+        except (Hl7Exception, UnicodeDecodeError):
+            self.client.close()  # Can't tell what this ACK answers anymore.
+            return None
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop after delivering the messages already queued, waiting up to `timeout`
+        seconds for them. Past that, the messages still queued are given up on, and
+        so is the one being sent once its current attempt is over.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            self._queue.put(None, timeout=timeout)  # Behind the messages already queued.
+        except queue.Full:
+            pass
+        self._thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        if self._thread.is_alive():
+            self._closing.set()
+            while True:
+                try:
+                    delivery = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if delivery is not None:
+                    self.failed += 1
+                    delivery.future.set_result(Acks.AE)
+            self._queue.put(None)
+            self._thread.join()
+        if self.client.is_connected():
+            self.client.close()
+
+
+class Router:
+    """
+    Content-based routing and fan-out. Every message is checked against the
+    `routes` in order and queued to every matching `Destination`, each delivering
+    concurrently at its own pace.
+
+    ```
+    router = Router(
+        routes=[
+            Route(["lab"], {"MSH-9.1": "ORU", "MSH-3": "LIS"}),
+            Route(["ris", "archive"], {"MSH-9.1": {"ORM", "OMI"}}),
+            Route(["archive"]),
+        ],
+        destinations=[
+            Destination("lab", "lab.example", 2575),
+            Destination("ris", "ris.example", 2575),
+            Destination("archive", "archive.example", 2575, wait_for_ack=False),
+        ])
+    server = MllpServer(port=2575, callback=router.submit, auto_ack=AckPolicy.AfterCallback)
+    server.serve_forever()
+    ```
+
+    `submit()` returns a future of the upstream ACK code, aggregated over the
+    destinations with `wait_for_ack`: `Acks.AA` if they all accepted the message,
+    `Acks.AR` if one rejected it, `Acks.AE` if one could not get it. A message that
+    no route matches, or that has no valid MSH, gets `unrouted`. As an `MllpServer`
+    callback with `AckPolicy.AfterCallback`, the server sends the ACK once the
+    future is resolved, without waiting for it in the meantime.
+
+    Calling the router does the same but waits for the outcome, for a callback
+    run in an executor. With `AckPolicy.OnReceipt` instead, the sender gets an AA
+    as soon as the message is received and the outcomes are only counted by the
+    destinations.
+    """
+    def __init__(self,
+                 routes: Iterable[Route],
+                 destinations: Iterable[Destination],
+                 unrouted: Acks = Acks.AA,
+                 encoding: str = 'ascii',
+                 parser: Optional[Hl7Parser] = None) -> None:
+        self.routes = list(routes)
+        self.destinations = {d.name: d for d in destinations}
+        self.unrouted = unrouted
+        self.encoding = encoding
+        self.parser = parser if parser is not None else Hl7Parser()
+        for route in self.routes:
+            for name in route.destinations:
+                if name not in self.destinations:
+                    raise ValueError(f"Unknown destination [{name}] in a route.")
+
+    def route(self, message: bytes) -> list[Destination]:
+        """
+        Returns the destinations of `message`, without queueing it.
+        """
+        try:
+            header = peek_msh(message, encoding=self.encoding)
+        except (Hl7Exception, UnicodeDecodeError):
+            return []
+        parsed = None
+        names: dict[str, None] = {}  # Ordered and without duplicates.
+        for route in self.routes:
+            if route.needs_body and parsed is None:
+                try:
+                    parsed = self.parser.parse_message(message, encoding=self.encoding)
+                except (Hl7Exception, UnicodeDecodeError):
+                    parsed = Hl7Message(self.parser)  # Only the header routes can match.
+            if route.matches(header, parsed):
+                names.update(dict.fromkeys(route.destinations))
+                if route.final:
+                    break
+        return [self.destinations[name] for name in names]
+
+    def submit(self, message: Union[bytes, memoryview, BinaryIO]) -> Future:
+        """
+        Route and queue `message`, returning the future of the upstream ACK code.
+        """
+        message = _to_bytes(message)
+        outcomes = [(d, d.enqueue(message)) for d in self.route(message)]
+        result: Future = Future()
+        if not outcomes:
+            result.set_result(self.unrouted)
+            return result
+        waited = [future for destination, future in outcomes if destination.wait_for_ack]
+        if not waited:
+            result.set_result(Acks.AA)
+            return result
+        remaining = [len(waited)]
+        lock = threading.Lock()
+
+        def done(_: Future) -> None:
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            codes = [future.result() for future in waited]
+            if Acks.AR in codes:
+                result.set_result(Acks.AR)
+            elif Acks.AE in codes:
+                result.set_result(Acks.AE)
+            else:
+                result.set_result(Acks.AA)
+
+        for future in waited:
+            future.add_done_callback(done)
+        return result
+
+    def __call__(self, message: Union[bytes, memoryview, BinaryIO]) -> Acks:
+        return self.submit(message).result()
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """
+        Close all the destinations, see `Destination.close()`.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for destination in self.destinations.values():
+            destination.close(None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+
+def _to_bytes(message: Union[bytes, memoryview, BinaryIO]) -> bytes:
+    # Messages outlive the server callback, views and spilled files don't.
+    if isinstance(message, bytes):
+        return message
+    if isinstance(message, (bytearray, memoryview)):
+        return bytes(message)
+    position = message.tell()
+    message.seek(0)
+    data = message.read()
+    message.seek(position)
+    return data
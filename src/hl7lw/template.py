@@ -0,0 +1,248 @@
+from __future__ import annotations
+from typing import Optional, Union, Any
+import re
+
+from .exceptions import InvalidHl7Template
+from .parser import Hl7Parser
+
+
+SLOT_RE = re.compile(r'\{\{|\}\}|\{([A-Za-z_][A-Za-z0-9_]*)(?::(raw))?\}')
+
+# Depth at which a slot sits inside its field, used to pick what gets escaped.
+FIELD = 0
+REPETITION = 1
+COMPONENT = 2
+SUBCOMPONENT = 3
+
+
+class Hl7Template:
+    """
+    A message or segment skeleton with named slots, compiled once into a fast renderer.
+
+    The template is plain HL7 text where `{name}` marks a slot. When rendered, the
+    value of a slot is escaped according to its position in the skeleton so it can
+    never break out of it. A slot that is a whole field may hold repetitions and
+    components (like `"Smith^John^Q"`) but a field separator in the value would be
+    escaped to `\\F\\`. A slot inside a component may not hold another component,
+    and so on down to subcomponents. The escape character itself is never escaped,
+    values are allowed to carry their own escape sequences.
+
+    A slot can be written as `{name:raw}` to disable escaping entirely, and `{{` or
+    `}}` produce literal braces. A template without any field separator is taken as
+    a fragment of a field, like `"{id}^^^{issuer}"`.
+
+    ```
+    t = Hl7Template("PID|||{mrn}^^^{issuer}||{name}")
+    t.render(mrn="1234", issuer="EPIC", name="Smith^John")
+    # 'PID|||1234^^^EPIC||Smith^John'
+    ```
+
+    Missing or `None` values render as empty strings. Anything else goes through
+    `builtins.str()`.
+
+    The separators come from MSH-1 and MSH-2 if the template starts with an MSH
+    segment, otherwise from the `parser`, or the spec defaults if there's no parser.
+    """
+    def __init__(self, template: str, parser: Optional[Hl7Parser] = None) -> None:
+        """
+        Compile `template`. An `InvalidHl7Template` exception is raised if the
+        skeleton can't be used, like a slot in MSH-1 or MSH-2 or a dangling brace.
+        """
+        if parser is None:
+            parser = Hl7Parser()
+        self.template = template
+        self.segment_separator = parser.segment_separator
+        self.field_separator = parser.field_separator
+        self.component_separator = parser.component_separator
+        self.repetition_separator = parser.repetition_separator
+        self.escape_character = parser.escape_character
+        self.subcomponent_separator = parser.subcomponent_separator
+        if template.startswith('MSH') and not parser.ignore_msh_values_for_parsing:
+            if len(template) < 8:
+                raise InvalidHl7Template("MSH segment is too short to hold MSH-1 and MSH-2.")
+            self.field_separator = template[3]
+            (self.component_separator,
+             self.repetition_separator,
+             self.escape_character,
+             self.subcomponent_separator) = template[4:8]
+        self._parts: list[str] = []
+        self._slots: list[tuple[int, str, Optional[dict[int, str]]]] = []
+        self._retargeted: dict[tuple[str, ...], Hl7Template] = {}
+        self._compile()
+
+    @property
+    def grammar(self) -> tuple[str, ...]:
+        return (self.segment_separator, self.field_separator, self.component_separator,
+                self.repetition_separator, self.escape_character, self.subcomponent_separator)
+
+    @property
+    def slot_names(self) -> list[str]:
+        """
+        Names of all the slots, in order of appearance.
+        """
+        return [name for _, name, _ in self._slots]
+
+    def _escape_table(self, depth: int) -> dict[int, str]:
+        esc = self.escape_character
+        table = {
+            ord(self.segment_separator): f"{esc}X0D{esc}",
+            ord(self.field_separator): f"{esc}F{esc}",
+        }
+        if depth >= REPETITION:
+            table[ord(self.repetition_separator)] = f"{esc}R{esc}"
+        if depth >= COMPONENT:
+            table[ord(self.component_separator)] = f"{esc}S{esc}"
+        if depth >= SUBCOMPONENT:
+            table[ord(self.subcomponent_separator)] = f"{esc}T{esc}"
+        return table
+
+    def _compile(self) -> None:
+        # First pass, cut the text into literals and slots. Slots get a placeholder
+        # in a scratch copy of the skeleton so the structure can be walked afterward.
+        pieces: list[Union[str, tuple[str, bool]]] = []
+        position = 0
+        for match in SLOT_RE.finditer(self.template):
+            literal = self.template[position:match.start()]
+            position = match.end()
+            if '{' in literal or '}' in literal:
+                raise InvalidHl7Template(f"Dangling brace in template near [{literal}]")
+            if match.group(0) == '{{':
+                literal += '{'
+            elif match.group(0) == '}}':
+                literal += '}'
+            if pieces and isinstance(pieces[-1], str):
+                pieces[-1] += literal
+            else:
+                pieces.append(literal)
+            if match.group(1) is not None:
+                pieces.append((match.group(1), match.group(2) is not None))
+        literal = self.template[position:]
+        if '{' in literal or '}' in literal:
+            raise InvalidHl7Template(f"Dangling brace in template near [{literal}]")
+        pieces.append(literal)
+
+        depths = self._slot_depths(pieces)
+        tables: dict[int, dict[int, str]] = {}
+        slot_index = 0
+        for piece in pieces:
+            if isinstance(piece, str):
+                self._parts.append(piece)
+            else:
+                name, raw = piece
+                depth = depths[slot_index]
+                slot_index += 1
+                if raw:
+                    table = None
+                else:
+                    if depth not in tables:
+                        tables[depth] = self._escape_table(depth)
+                    table = tables[depth]
+                self._slots.append((len(self._parts), name, table))
+                self._parts.append('')
+
+    def _slot_depths(self, pieces: list[Union[str, tuple[str, bool]]]) -> list[int]:
+        # \x00 can't appear in a valid HL7 message so it's safe as a placeholder.
+        scratch = ''.join(p if isinstance(p, str) else '\x00' for p in pieces)
+        depths = []
+        for segment in scratch.split(self.segment_separator):
+            fields = segment.split(self.field_separator)
+            if segment.startswith('MSH') and len(fields) > 1:
+                if '\x00' in fields[0] or '\x00' in fields[1]:
+                    raise InvalidHl7Template("Slots are not allowed in MSH-1 or MSH-2.")
+                fields = fields[2:]
+            elif len(fields) == 1:
+                pass  # A fragment of a field, like a `"{id}^^^{issuer}"`.
+            elif '\x00' in fields[0]:
+                raise InvalidHl7Template("Slots are not allowed in the segment name.")
+            for field in fields:
+                if '\x00' not in field:
+                    continue
+                repetitions = field.split(self.repetition_separator)
+                for repetition in repetitions:
+                    components = repetition.split(self.component_separator)
+                    for component in components:
+                        for _ in range(component.count('\x00')):
+                            if self.subcomponent_separator in component:
+                                depths.append(SUBCOMPONENT)
+                            elif len(components) > 1:
+                                depths.append(COMPONENT)
+                            elif len(repetitions) > 1:
+                                depths.append(REPETITION)
+                            else:
+                                depths.append(FIELD)
+        return depths
+
+    def for_parser(self, parser: Optional[Hl7Parser]) -> Hl7Template:
+        """
+        Returns a version of this template using the separators of `parser`. The
+        template is only recompiled the first time a given set of separators is
+        seen, and `self` is returned when the separators are the same.
+        """
+        if parser is None:
+            return self
+        grammar = (parser.segment_separator, parser.field_separator, parser.component_separator,
+                   parser.repetition_separator, parser.escape_character, parser.subcomponent_separator)
+        if grammar == self.grammar:
+            return self
+        if grammar not in self._retargeted:
+            table = str.maketrans(dict(zip(self.grammar, grammar)))
+            pieces = []
+            position = 0
+            for match in SLOT_RE.finditer(self.template):
+                pieces.append(self.template[position:match.start()].translate(table))
+                pieces.append(match.group(0))
+                position = match.end()
+            pieces.append(self.template[position:].translate(table))
+            retarget = Hl7Parser(ignore_msh_values_for_parsing=parser.ignore_msh_values_for_parsing)
+            (retarget.segment_separator, retarget.field_separator, retarget.component_separator,
+             retarget.repetition_separator, retarget.escape_character,
+             retarget.subcomponent_separator) = grammar
+            self._retargeted[grammar] = Hl7Template(''.join(pieces), parser=retarget)
+        return self._retargeted[grammar]
+
+    def render(self, **values: Any) -> str:
+        """
+        Render the template with the slot values supplied as keyword arguments.
+        """
+        out = self._parts[:]
+        for index, name, table in self._slots:
+            value = values.get(name)
+            if value is None or value == '':
+                continue
+            if not isinstance(value, str):
+                value = str(value)
+            if table is not None:
+                value = value.translate(table)
+            out[index] = value
+        return ''.join(out)
+
+    def render_bytes(self, encoding: str = 'ascii', **values: Any) -> bytes:
+        """
+        Same as `render()` but encodes the result with `encoding`.
+        """
+        return self.render(**values).encode(encoding=encoding)
+
+    @classmethod
+    def from_fields(klass,
+                    segment_name: str,
+                    slots: dict[int, str],
+                    parser: Optional[Hl7Parser] = None) -> Hl7Template:
+        """
+        Build a single segment template from a mapping of field index to slot
+        name. The segment will have as many fields as the largest index.
+
+        ```
+        t = Hl7Template.from_fields('PV1', {2: 'patient_class', 19: 'visit_number'})
+        ```
+        """
+        if parser is None:
+            parser = Hl7Parser()
+        if segment_name == 'MSH':
+            raise InvalidHl7Template("Use a literal template for MSH segments.")
+        field_count = max(slots.keys()) if slots else 0
+        fields = [segment_name] + [''] * field_count
+        for index, name in slots.items():
+            if index < 1:
+                raise InvalidHl7Template(f"Invalid field index [{index}]")
+            fields[index] = f"{{{name}}}"
+        return klass(parser.field_separator.join(fields), parser=parser)
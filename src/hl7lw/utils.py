@@ -1,8 +1,14 @@
 from enum import Enum
-from typing import Optional, List
+from typing import Optional, List, Union, Callable
 import datetime
-import random
-from .parser import Hl7Message, Hl7Segment, Hl7Parser, Hl7Field
+import re
+from . import ids
+from .exceptions import Hl7Exception, InvalidHl7Message
+from .parser import Hl7Message, Hl7Segment, Hl7Parser
+from .template import Hl7Template
+
+
+SEGMENT_END_RE = re.compile(rb'[\r\n]')
 
 
 class Acks(Enum):
@@ -24,23 +30,27 @@ def generate_message_time():
     return datetime.datetime.now().strftime("%Y%m%d%H%M%S")
 
 
-def generate_message_id():
+def generate_message_id(id_generator: Optional[Callable[[], str]] = None):
     """
-    Generate a message control ID suitable for MSH-10.
-
-    This function is not suitable for very high volume message generation as
-    it generates only 1 million possible ID for a given second and with the
-    birthday paradox, you would expect a collision after 1178 messages, 50%
-    of the time.
+    Generate a message control ID suitable for MSH-10 using `id_generator`, or
+    the default generator from `hl7lw.ids.get_default_generator()`, a
+    `hl7lw.ids.SnowflakeIdGenerator` unless replaced.
     """
-    return f"{generate_message_time()}{random.randint(0, 999999):06d}"
+    if id_generator is None:
+        id_generator = ids.get_default_generator()
+    return id_generator()
 
 
-def generate_ack(message: Hl7Message, status: Acks, details: Optional[str] = None) -> Hl7Message:
+def generate_ack(message: Hl7Message,
+                 status: Acks,
+                 details: Optional[str] = None,
+                 id_generator: Optional[Callable[[], str]] = None) -> Hl7Message:
     """
     Generate an acknowledgement for `message` with the acknowledgement code `status`.
     An optional `reason` can be supplied and if so it will be put into MSA-3.
 
+    The ACK's MSH-10 comes from `id_generator`, or the default generator if `None`.
+
     This is a convenience function for implementing simple Hl7 sinks.
     """
     ack = Hl7Message(parser=message.parser)
@@ -54,10 +64,10 @@ def generate_ack(message: Hl7Message, status: Acks, details: Optional[str] = Non
     msh[6] = orig_msh[4]
     msh[7] = generate_message_time()
     msh[9] = 'ACK'
-    msh[10] = generate_message_id()
+    msh[10] = generate_message_id(id_generator)
     
     msa = Hl7Segment(parser=message.parser)
-    msa.parse("MSA|||")
+    msa.parse("MSA" + message.parser.field_separator * 3)
     msa[1] = status.name
     msa[2] = orig_msh[10]
     if details is not None:
@@ -67,17 +77,135 @@ def generate_ack(message: Hl7Message, status: Acks, details: Optional[str] = Non
     return ack
 
 
+def peek_msh(message: Union[bytes, bytearray, memoryview, str], encoding: str = 'ascii') -> Hl7Segment:
+    """
+    Parse only the MSH segment of `message`, without looking at the rest of it.
+    This is a lot cheaper than `Hl7Parser.parse_message()` when only the header
+    is of interest, like for routing or acknowledging messages.
+
+    Both `\r` and `\n` are accepted as the end of the segment. The returned
+    segment carries its own `Hl7Parser` set with the message's encoding characters.
+
+    An `InvalidHl7Message` exception is raised if the message doesn't start with
+    a valid MSH segment.
+    """
+    if isinstance(message, str):
+        end = len(message)
+        for terminator in ('\r', '\n'):
+            index = message.find(terminator, 0, end)
+            if index != -1:
+                end = index
+        header = message[:end]
+    else:
+        # A regex also works on a memoryview, which has no find().
+        match = SEGMENT_END_RE.search(message)
+        end = len(message) if match is None else match.start()
+        header = str(message[:end], encoding=encoding)
+    if not header.startswith('MSH') or len(header) < 8:
+        raise InvalidHl7Message("Message does not start with an MSH segment.")
+    try:
+        return Hl7Parser().parse_segment(header)
+    except Hl7Exception as e:
+        raise InvalidHl7Message(str(e)) from e
+
+
+def peek_msa(message: Union[bytes, bytearray, memoryview, str], encoding: str = 'ascii') -> Hl7Segment:
+    """
+    Like `peek_msh()`, but returns the MSA segment of an acknowledgement. Only the
+    MSH and MSA segments are looked at.
+
+    An `InvalidHl7Message` exception is raised if the message has no MSA segment.
+    """
+    msh = peek_msh(message, encoding=encoding)
+    marker = 'MSA' + msh.parser.field_separator
+    if isinstance(message, str):
+        text = message
+    else:
+        # Only the MSA segment itself is decoded, up to its terminator.
+        binary_marker = re.escape(marker.encode(encoding=encoding))
+        match = re.search(rb'[\r\n]' + binary_marker, message)
+        if match is None:
+            raise InvalidHl7Message("No MSA segment found.")
+        segment_end = SEGMENT_END_RE.search(message, match.end())
+        text = str(message[match.start() + 1:len(message) if segment_end is None else segment_end.start()],
+                   encoding=encoding)
+    start = -1
+    for terminator in ('\r', '\n'):
+        start = text.find(terminator + marker)
+        if start != -1:
+            start += 1
+            break
+    if start == -1:
+        if not text.startswith(marker):
+            raise InvalidHl7Message("No MSA segment found.")
+        start = 0
+    end = len(text)
+    for terminator in ('\r', '\n'):
+        index = text.find(terminator, start, end)
+        if index != -1:
+            end = index
+    try:
+        return msh.parser.parse_segment(text[start:end], allow_msh=False)
+    except Hl7Exception as e:
+        raise InvalidHl7Message(str(e)) from e
+
+
+ACK_TEMPLATE = Hl7Template(
+    "MSH|^~\\&|{receiving_application:raw}|{receiving_facility:raw}|{sending_application:raw}|"
+    "{sending_facility:raw}|{message_time}|{security:raw}|ACK|{message_id}{trailer:raw}\r"
+    "MSA|{status}|{control_id:raw}|{details}\r"
+)
+
+
+def generate_ack_bytes(message: Union[bytes, bytearray, memoryview, str],
+                       status: Acks,
+                       details: Optional[str] = None,
+                       id_generator: Optional[Callable[[], str]] = None,
+                       encoding: str = 'ascii') -> bytes:
+    """
+    Fast version of `generate_ack()` working straight from the raw `message`
+    and returning the encoded ACK, ready to be sent.
+
+    Only the MSH segment is looked at, with `peek_msh()`, and the ACK is rendered
+    from a precompiled template with MSH-3/4 and MSH-5/6 swapped and MSH-10 echoed
+    in MSA-2. The result is identical to formatting the result of `generate_ack()`.
+    """
+    msh = peek_msh(message, encoding=encoding)
+    fields = msh.fields
+    fs = msh.parser.field_separator
+    return ACK_TEMPLATE.for_parser(msh.parser).render(
+        receiving_application=msh[5],
+        receiving_facility=msh[6],
+        sending_application=msh[3],
+        sending_facility=msh[4],
+        message_time=generate_message_time(),
+        security=msh[8],
+        message_id=generate_message_id(id_generator),
+        trailer=fs + fs.join(fields[10:]) if len(fields) > 10 else '',
+        status=status.name,
+        control_id=msh[10],
+        details=details,
+    ).encode(encoding=encoding)
+
+
+PATIENT_ID_TEMPLATE = Hl7Template("{patient_id}^^^{issuer}")
+PATIENT_ID_NO_ISSUER_TEMPLATE = Hl7Template("{patient_id}^")
+
+
 class PatientID:
     def __init__(self, patient_id: str, issuer: Optional[str] = None) -> None:
         self.patient_id = patient_id
         self.issuer = issuer
     
     def __str__(self) -> str:
-        f = Hl7Field(Hl7Parser())
-        f[1][1] = self.patient_id
-        if self.issuer is not None:
-            f[1][4] = self.issuer
-        return str(f)
+        if self.issuer is None:
+            # Rendered as a component so it gets escaped like one, then the
+            # trailing separator is dropped.
+            return PATIENT_ID_NO_ISSUER_TEMPLATE.render(patient_id=self.patient_id)[:-1]
+        return PATIENT_ID_TEMPLATE.render(patient_id=self.patient_id, issuer=self.issuer)
+
+
+PID_TEMPLATE = Hl7Template.from_fields('PID', {3: 'patient_ids', 5: 'name', 7: 'birthdate', 8: 'sex'})
 
 
 class Patient:
@@ -87,19 +215,22 @@ class Patient:
         self.birthdate = birthdate
         self.sex = sex
     
+    def render(self, parser: Optional[Hl7Parser] = None) -> str:
+        """
+        Render the PID segment as a `str`, without segment terminator.
+        """
+        repetition_separator = '~' if parser is None else parser.repetition_separator
+        return PID_TEMPLATE.for_parser(parser).render(
+            patient_ids=repetition_separator.join([str(k) for k in self.patient_ids]),
+            name=self.name,
+            birthdate=self.birthdate,
+            sex=self.sex,
+        )
+
     def as_segment(self, parser: Optional[Hl7Parser] = None) -> Hl7Segment:
         if parser is None:
             parser = Hl7Parser()
-        pid = Hl7Segment(parser=parser)
-        pid.parse('PID|')
-        pid3 = Hl7Field(parser)
-        for index, patient_id in enumerate(self.patient_ids, start=1):
-            pid3[index] = str(patient_id)
-        pid[3] = str(pid3)
-        pid[5] = self.name
-        pid[7] = self.birthdate
-        pid[8] = self.sex
-        return pid
+        return parser.parse_segment(self.render(parser=parser))
 
 
 class VisitIndicator(Enum):
@@ -119,6 +250,15 @@ class PatientClass(Enum):
     Unknown = "U"
 
 
+PV1_TEMPLATE = Hl7Template.from_fields('PV1', {
+    2: 'patient_class',
+    3: 'patient_location',
+    8: 'referring_physician',
+    19: 'visit_number',
+    51: 'visit_indicator',
+})
+
+
 class Visit:
     def __init__(self,
                  patient_class: PatientClass = PatientClass.Outpatient,
@@ -133,17 +273,22 @@ class Visit:
         self.visit_number = visit_number
         self.visit_indicator = visit_indicator
     
+    def render(self, parser: Optional[Hl7Parser] = None) -> str:
+        """
+        Render the PV1 segment as a `str`, without segment terminator.
+        """
+        return PV1_TEMPLATE.for_parser(parser).render(
+            patient_class=self.patient_class.value,
+            patient_location=self.patient_location,
+            referring_physician=self.referring_physician,
+            visit_number=self.visit_number,
+            visit_indicator=self.visit_indicator.value,
+        )
+
     def as_segment(self, parser: Optional[Hl7Parser] = None) -> Hl7Segment:
         if parser is None:
             parser = Hl7Parser()
-        pv1 = Hl7Segment(parser=parser)
-        pv1.parse('PV1|')
-        pv1[2] = self.patient_class.value
-        pv1[3] = self.patient_location
-        pv1[8] = self.referring_physician
-        pv1[19] = self.visit_number
-        pv1[51] = self.visit_indicator.value
-        return pv1
+        return parser.parse_segment(self.render(parser=parser))
 
 
 class OrderControl(Enum):
@@ -217,6 +362,9 @@ class ResultStatus(Enum):
     OrderCancelled = "X"
 
 
+QUANTITY_TIMING_TEMPLATE = Hl7Template("^^^{start_time}^{end_time}^{priority}")
+
+
 class QuantityTiming:
     def __init__(self, start_time: str = "", end_time: str = "", priority: str = "") -> None:
         self.start_time = start_time
@@ -224,11 +372,12 @@ class QuantityTiming:
         self.priority = priority
         
     def __str__(self) -> str:
-        f = Hl7Field(Hl7Parser())
-        f[1][4] = self.start_time
-        f[1][5] = self.end_time
-        f[1][6] = self.priority
-        return str(f)
+        return QUANTITY_TIMING_TEMPLATE.render(start_time=self.start_time,
+                                               end_time=self.end_time,
+                                               priority=self.priority)
+
+
+UNIVERSAL_SERVICE_ID_TEMPLATE = Hl7Template("{procedure_code}^{procedure_description}")
 
 
 class Procedure:
@@ -252,10 +401,47 @@ class Procedure:
         self.result_status = result_status
     
     def as_universal_service_id(self):
-        f = Hl7Field(Hl7Parser())
-        f[1][1] = self.procedure_code
-        f[1][2] = self.procedure_description
-        return str(f)
+        return UNIVERSAL_SERVICE_ID_TEMPLATE.render(procedure_code=self.procedure_code,
+                                                    procedure_description=self.procedure_description)
+
+
+ORC_TEMPLATE = Hl7Template.from_fields('ORC', {
+    1: 'order_control',
+    2: 'placer_order_number',
+    3: 'filler_order_number',
+    5: 'order_status',
+    7: 'quantity_timing',
+    12: 'ordering_provider',
+    15: 'start_time',
+    17: 'entering_organization',
+})
+OBR_BASE_TEMPLATE = Hl7Template.from_fields('OBR', {
+    1: 'set_id',
+    2: 'placer_order_number',
+    3: 'filler_order_number',
+    18: 'accession_number',
+    31: 'reason_for_study',
+})
+OBR_TEMPLATE = Hl7Template.from_fields('OBR', {
+    1: 'set_id',
+    2: 'placer_order_number',
+    3: 'filler_order_number',
+    4: 'universal_service_id',
+    5: 'priority',
+    6: 'start_time',
+    7: 'observation_time',
+    8: 'end_time',
+    16: 'ordering_provider',
+    18: 'accession_number',
+    19: 'requested_procedure_id',
+    24: 'modality_or_service',
+    25: 'result_status',
+    27: 'quantity_timing',
+    31: 'reason_for_study',
+    36: 'scheduled_time',
+    44: 'procedure_code',
+})
+REASON_FOR_STUDY_TEMPLATE = Hl7Template("^{reason_for_exam}")
 
 
 class OrderGroup:
@@ -279,60 +465,63 @@ class OrderGroup:
         self.procedures.append(procedure)
         return self
 
-    def add_to_message(self, message: Hl7Message) -> None:
-        base_orc = message.parser.parse_segment('ORC|')
-        base_obr = message.parser.parse_segment('OBR|')
-        
-        base_orc[1] = self.order_control.value
-        base_orc[2] = self.placer_order_number
-        base_orc[3] = self.filler_order_number
-        base_orc[17] = self.entering_organization
-
-        base_obr[1] = "1"
-        base_obr[2] = self.placer_order_number
-        base_obr[3] = self.filler_order_number
-        base_obr[18] = self.accession_number
-        reason = Hl7Field(parser=message.parser)
-        reason[1][2] = self.reason_for_exam
-        base_obr[31] = str(reason)
+    def render(self, parser: Optional[Hl7Parser] = None) -> List[str]:
+        """
+        Render the ORC and OBR segments of the order group as a list of `str`,
+        without segment terminators.
+        """
+        orc_template = ORC_TEMPLATE.for_parser(parser)
+        obr_template = OBR_TEMPLATE.for_parser(parser)
+        common = dict(
+            order_control=self.order_control.value,
+            placer_order_number=self.placer_order_number,
+            filler_order_number=self.filler_order_number,
+            entering_organization=self.entering_organization,
+            set_id="1",
+            accession_number=self.accession_number,
+            reason_for_study=REASON_FOR_STUDY_TEMPLATE.for_parser(parser).render(
+                reason_for_exam=self.reason_for_exam),
+        )
 
         if len(self.procedures) == 0:
-            message.segments.append(base_orc)
-            message.segments.append(base_obr)
-        else:
-            segments_to_add = []
-            p = message.parser
-            for index, procedure in enumerate(self.procedures, start=1):
-                # Reparse to make deep copies.
-                orc = p.parse_segment(p.format_segment(base_orc))
-                obr = p.parse_segment(p.format_segment(base_obr))
-
-                if procedure.quantity_timing is not None:
-                    orc[7] = str(procedure.quantity_timing)
-                    obr[27] = orc[7]
-                    obr[5] = procedure.quantity_timing.priority
-                    obr[6] = procedure.quantity_timing.start_time
-                    obr[7] = procedure.quantity_timing.start_time
-                    obr[8] = procedure.quantity_timing.end_time
-                    orc[15] = procedure.quantity_timing.start_time
-                    obr[36] = procedure.quantity_timing.start_time
-                if procedure.result_status is not None:
-                    obr[25] = procedure.result_status.value
-                obr[4] = procedure.as_universal_service_id()
-                orc[5] = procedure.order_status
-                orc[12] = procedure.ordering_provider
-                obr[16] = procedure.ordering_provider
-                obr[19] = procedure.requested_procedure_id
-                obr[24] = procedure.modality_or_service
-                obr[44] = procedure.procedure_code
-
-                segments_to_add.append(orc)
-                segments_to_add.append(obr)
-
-            message.segments += segments_to_add
-
-
-BASE_MSH = b'MSH|^~\\&|||||||||T|2.3.1||||||||||\r'
+            return [orc_template.render(**common),
+                    OBR_BASE_TEMPLATE.for_parser(parser).render(**common)]
+
+        segments = []
+        for procedure in self.procedures:
+            values = dict(common)
+            quantity_timing = procedure.quantity_timing
+            if quantity_timing is not None:
+                values['quantity_timing'] = str(quantity_timing)
+                values['priority'] = quantity_timing.priority
+                values['start_time'] = quantity_timing.start_time
+                values['observation_time'] = quantity_timing.start_time
+                values['end_time'] = quantity_timing.end_time
+                values['scheduled_time'] = quantity_timing.start_time
+            if procedure.result_status is not None:
+                values['result_status'] = procedure.result_status.value
+            values['universal_service_id'] = procedure.as_universal_service_id()
+            values['order_status'] = procedure.order_status
+            values['ordering_provider'] = procedure.ordering_provider
+            values['requested_procedure_id'] = procedure.requested_procedure_id
+            values['modality_or_service'] = procedure.modality_or_service
+            values['procedure_code'] = procedure.procedure_code
+            segments.append(orc_template.render(**values))
+            segments.append(obr_template.render(**values))
+        return segments
+
+    def add_to_message(self, message: Hl7Message) -> None:
+        p = message.parser
+        message.segments += [p.parse_segment(s) for s in self.render(parser=p)]
+
+
+MSH_TEMPLATE = Hl7Template(
+    "MSH|^~\\&|{sending_application}|{sending_facility}|{receiving_application}|{receiving_facility}|"
+    "{message_time}||{message_type}|{message_id}|{processing_id}|{version_id}||||||||||"
+)
+EMPTY_PID_TEMPLATE = Hl7Template("PID|")
+EMPTY_ORC_TEMPLATE = Hl7Template("ORC|")
+EMPTY_OBR_TEMPLATE = Hl7Template("OBR|")
 
 
 class ProcessingMode(Enum):
@@ -348,7 +537,8 @@ class OrmBuilder:
                  receiving_application: str = "",
                  receiving_facility: str = "",
                  hl7_version: str = "2.3.1",
-                 processing_mode: ProcessingMode = ProcessingMode.Production 
+                 processing_mode: ProcessingMode = ProcessingMode.Production,
+                 id_generator: Optional[Callable[[], str]] = None
                  ) -> None:
         self.sending_application = sending_application
         self.sending_facility = sending_facility
@@ -356,6 +546,7 @@ class OrmBuilder:
         self.receiving_facility = receiving_facility
         self.hl7_version = hl7_version
         self.processing_mode = processing_mode
+        self.id_generator = id_generator
 
         self.patient: Optional[Patient] = None
         self.visit: Optional[Visit] = None
@@ -373,33 +564,49 @@ class OrmBuilder:
         self.order_group = order_group
         return self
     
-    def build(self, parser: Optional[Hl7Parser] = None) -> Hl7Message:
-        if parser is None:
-            parser = Hl7Parser()
-        m = parser.parse_message(BASE_MSH)
-        msh = m.get_segment('MSH')
-        msh[3] = self.sending_application
-        msh[4] = self.sending_facility
-        msh[5] = self.receiving_application
-        msh[6] = self.receiving_facility
-        msh[7] = generate_message_time()
-        msh[9] = 'ORM^O01'
-        msh[10] = generate_message_id()
-        msh[11] = self.processing_mode.value
-        msh[12] = self.hl7_version
+    def render(self,
+               parser: Optional[Hl7Parser] = None,
+               encoding: Optional[str] = None) -> Union[str, bytes]:
+        """
+        Render the ORM straight from the templates, without building an `Hl7Message`.
+
+        Like `Hl7Parser.format_message()`, a `bytes` is returned if `encoding` is
+        supplied, otherwise a `str` is returned.
+        """
+        segments = [MSH_TEMPLATE.for_parser(parser).render(
+            sending_application=self.sending_application,
+            sending_facility=self.sending_facility,
+            receiving_application=self.receiving_application,
+            receiving_facility=self.receiving_facility,
+            message_time=generate_message_time(),
+            message_type='ORM^O01',
+            message_id=generate_message_id(self.id_generator),
+            processing_id=self.processing_mode.value,
+            version_id=self.hl7_version,
+        )]
 
         if self.patient is None:
-            m.segments.append(parser.parse_segment("PID|"))
+            segments.append(EMPTY_PID_TEMPLATE.for_parser(parser).render())
         else:
-            m.segments.append(self.patient.as_segment(parser=parser))
+            segments.append(self.patient.render(parser=parser))
 
         if self.visit is not None:
-            m.segments.append(self.visit.as_segment(parser=parser))
+            segments.append(self.visit.render(parser=parser))
 
         if self.order_group is None:
-            m.segments.append(parser.parse_segment("ORC|"))
-            m.segments.append(parser.parse_segment("OBR|"))
+            segments.append(EMPTY_ORC_TEMPLATE.for_parser(parser).render())
+            segments.append(EMPTY_OBR_TEMPLATE.for_parser(parser).render())
         else:
-            self.order_group.add_to_message(message=m)
-        
-        return m
+            segments += self.order_group.render(parser=parser)
+
+        segment_separator = '\r' if parser is None else parser.segment_separator
+        segments.append('')  # will force termination of last segment
+        rendered = segment_separator.join(segments)
+        if encoding is not None:
+            return rendered.encode(encoding=encoding)
+        return rendered
+
+    def build(self, parser: Optional[Hl7Parser] = None) -> Hl7Message:
+        if parser is None:
+            parser = Hl7Parser()
+        return parser.parse_message(self.render(parser=parser))
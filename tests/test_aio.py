@@ -0,0 +1,126 @@
+import asyncio
+import pytest
+from src.hl7lw import Hl7Parser
+from src.hl7lw.aio import AsyncMllpClient, AsyncMllpServer
+from src.hl7lw.mllp import AckPolicy, START_BYTE, END_BYTES
+from src.hl7lw.exceptions import MllpConnectionError
+from src.hl7lw.utils import Acks
+
+
+async def serve(server: AsyncMllpServer) -> asyncio.Task:
+    await server.start()
+    return asyncio.ensure_future(server.serve_forever())
+
+
+def test_async_roundtrip(trivial_a08: bytes) -> None:
+    async def callback(message: bytes) -> bytes:
+        await asyncio.sleep(0)
+        return b"ACK:" + message[:3]
+
+    async def run():
+        server = AsyncMllpServer(0, callback, host='127.0.0.1')
+        task = await serve(server)
+        c = AsyncMllpClient()
+        await c.connect('127.0.0.1', server.port)
+        await c.send(trivial_a08)
+        assert await c.recv() == b"ACK:MSH"
+        await c.close()
+        await server.close()
+        await task
+
+    asyncio.run(run())
+
+
+def test_async_auto_ack_pipelined(trivial_a08: bytes) -> None:
+    received = []
+
+    def callback(message: bytes):
+        received.append(message)
+        return Acks.AE if len(received) == 2 else None
+
+    async def run():
+        server = AsyncMllpServer(0, callback, auto_ack=AckPolicy.AfterCallback, host='127.0.0.1')
+        task = await serve(server)
+        c = AsyncMllpClient()
+        await c.connect('127.0.0.1', server.port)
+        c.writer.write((START_BYTE + trivial_a08 + END_BYTES) * 3)
+        p = Hl7Parser()
+        codes = [p.parse_message(await c.recv())["MSA-1"] for _ in range(3)]
+        assert codes == ["AA", "AE", "AA"]
+        await c.close()
+        await server.close()
+        await task
+
+    asyncio.run(run())
+    assert received == [trivial_a08] * 3
+
+
+def test_async_callback_error_gets_ae() -> None:
+    def callback(message: bytes):
+        if b"|FAIL|" in message:
+            raise RuntimeError("Callback failure")
+        return None
+
+    async def run():
+        server = AsyncMllpServer(0, callback, auto_ack=AckPolicy.AfterCallback, host='127.0.0.1')
+        task = await serve(server)
+        c = AsyncMllpClient()
+        await c.connect('127.0.0.1', server.port)
+        p = Hl7Parser()
+        codes = []
+        for control_id in ("1", "FAIL", "2"):
+            await c.send(f"MSH|^~\\&|A|B|C|D|||ADT^A08|{control_id}|P|2.3\rEVN|A08\r".encode())
+            codes.append(p.parse_message(await c.recv())["MSA-1"])
+        # The connection survives and the failure is answered.
+        assert codes == ["AA", "AE", "AA"]
+        await c.close()
+        await server.close()
+        await task
+
+    asyncio.run(run())
+
+
+def test_async_connections_are_concurrent() -> None:
+    release = None
+
+    async def callback(message: bytes) -> bytes:
+        if message == b"slow":
+            await release.wait()
+        return b"ACK:" + message
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        server = AsyncMllpServer(0, callback, host='127.0.0.1')
+        task = await serve(server)
+        slow, fast = AsyncMllpClient(), AsyncMllpClient()
+        await slow.connect('127.0.0.1', server.port)
+        await fast.connect('127.0.0.1', server.port)
+        await slow.send(b"slow")
+        await fast.send(b"fast")
+        assert await asyncio.wait_for(fast.recv(), timeout=5) == b"ACK:fast"
+        release.set()
+        assert await asyncio.wait_for(slow.recv(), timeout=5) == b"ACK:slow"
+        await slow.close()
+        await fast.close()
+        await server.close()
+        await task
+
+    asyncio.run(run())
+
+
+def test_async_client_errors() -> None:
+    async def run():
+        c = AsyncMllpClient()
+        with pytest.raises(MllpConnectionError, match=r'^Not connected!'):
+            await c.recv()
+        with pytest.raises(MllpConnectionError, match=r'^No host configured!'):
+            await c.send(b"message")
+        server = AsyncMllpServer(0, lambda message: None, host='127.0.0.1')
+        await server.start()
+        port = server.port
+        await server.close()
+        with pytest.raises(MllpConnectionError, match=r'^Failed to connect'):
+            await c.connect('127.0.0.1', port)
+
+    asyncio.run(run())
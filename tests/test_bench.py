@@ -0,0 +1,40 @@
+import json
+from src.hl7lw import bench
+
+
+def test_percentile() -> None:
+    values = [float(i) for i in range(1, 101)]
+    assert bench.percentile(values, 50) == 50.0
+    assert bench.percentile(values, 99) == 99.0
+    assert bench.percentile(values, 100) == 100.0
+    assert bench.percentile([], 50) is None
+
+
+def test_load_corpus(tmp_path) -> None:
+    (tmp_path / "a.hl7").write_bytes(b"MSH|^~\\&|A\nPID|1\n")
+    (tmp_path / "b.hl7").write_bytes(b"MSH|^~\\&|B\r\n")
+    (tmp_path / "empty.hl7").write_bytes(b"")
+    assert bench.load_corpus([str(tmp_path)]) == [b"MSH|^~\\&|A\rPID|1\r", b"MSH|^~\\&|B\r"]
+
+
+def test_run_lockstep_and_pipelined() -> None:
+    for pipeline in (1, 4):
+        report = bench.run(connections=2, messages=51, pipeline=pipeline, server_mode='thread')
+        assert report['sent'] == report['acked'] == 51
+        assert report['errors'] == 0
+        latency = report['latency_seconds']
+        assert 0 < latency['min'] <= latency['p50'] <= latency['p99'] <= latency['max']
+        # The server thread is part of this process, there is no server process.
+        assert 'children_cpu_user_seconds' not in report
+        assert 'server process' not in bench.format_report(report)
+
+
+def test_main_json(capsys, tmp_path) -> None:
+    (tmp_path / "a.hl7").write_bytes(bench.DEFAULT_MESSAGE)
+    assert bench.main(['-c', '2', '-n', '20', '--rate', '400', '--corpus', str(tmp_path / "a.hl7"),
+                       '--server', 'thread', '--json']) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert report['acked'] == 20
+    assert report['target_rate'] == 400
+    assert report['elapsed_seconds'] >= 9 / 200  # 10 messages per connection at 200/s
+    assert report['max_rss_bytes'] > 0
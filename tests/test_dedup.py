@@ -0,0 +1,54 @@
+import pytest
+from src.hl7lw.dedup import DedupCache
+from src.hl7lw.utils import Acks, generate_ack_bytes
+
+
+def message(control_id: str, body: str = "PID|1", sender: str = "APP") -> bytes:
+    return f"MSH|^~\\&|{sender}|FAC|RCV|FAC|20240101||ADT^A08|{control_id}|P|2.5\r{body}\r".encode()
+
+
+def test_digest_keys() -> None:
+    header = DedupCache()
+    assert header.digest(message("1")) == header.digest(message("1", body="PID|2"))
+    assert header.digest(message("1")) != header.digest(message("2"))
+    assert header.digest(message("1")) != header.digest(message("1", sender="OTHER"))
+    assert len(header.digest(message("1"))) == 16
+    assert header.digest(message("")) is None
+    assert header.digest(b"not hl7") is None
+    content = DedupCache(key='content')
+    assert content.digest(message("1")) != content.digest(message("1", body="PID|2"))
+    assert content.digest(b"not hl7") is not None
+    with pytest.raises(ValueError):
+        DedupCache(key='msh10')
+
+
+def test_lru_and_ttl() -> None:
+    now = [0.0]
+    cache = DedupCache(max_size=2, ttl=10, clock=lambda: now[0])
+    cache.put(b"a", Acks.AA)
+    cache.put(b"b", Acks.AA)
+    assert cache.get(b"a") is Acks.AA  # Now the most recently used.
+    cache.put(b"c", Acks.CA)
+    assert len(cache) == 2
+    assert cache.get(b"b") is None
+    assert cache.get(b"c") is Acks.CA
+    now[0] = 5
+    cache.put(b"d", Acks.AA)
+    now[0] = 11
+    assert cache.get(b"c") is None  # Expired
+    assert cache.get(b"d") is Acks.AA
+    assert cache.hits == 3
+
+
+def test_remember_only_accepted() -> None:
+    cache = DedupCache()
+    for i, (result, code) in enumerate([(None, Acks.AA), (Acks.AE, Acks.AE), (Acks.CA, Acks.CA)]):
+        cache.remember(str(i).encode(), result, generate_ack_bytes(message(str(i)), code))
+    custom = generate_ack_bytes(message("3"), Acks.AA)
+    cache.remember(b"3", custom, custom)
+    cache.remember(b"4", None, None)
+    assert cache.get(b"0") is Acks.AA
+    assert cache.get(b"1") is None
+    assert cache.get(b"2") is Acks.CA
+    assert cache.get(b"3") == custom
+    assert cache.get(b"4") is None
@@ -0,0 +1,97 @@
+import pytest
+import threading
+from src.hl7lw import ids, utils, Hl7Parser
+
+
+def test_snowflake_unique_and_ordered() -> None:
+    g = ids.SnowflakeIdGenerator(node_id=7)
+    generated = [g() for _ in range(50000)]
+    assert len(set(generated)) == len(generated)
+    assert generated == sorted(generated)
+    assert all(len(i) == 20 and i.isdigit() for i in generated)
+
+
+def test_snowflake_threads() -> None:
+    g = ids.SnowflakeIdGenerator(node_id=3)
+    results = [[] for _ in range(8)]
+
+    def work(out):
+        for _ in range(5000):
+            out.append(g())
+
+    threads = [threading.Thread(target=work, args=(r,)) for r in results]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    generated = [i for r in results for i in r]
+    assert len(set(generated)) == len(generated)
+
+
+def test_snowflake_clock_going_backward(mocker) -> None:
+    g = ids.SnowflakeIdGenerator(node_id=1, sequence_bits=1)
+    clock = mocker.patch("time.time_ns", return_value=g.epoch_ms * 1000000 + 5000000000)
+    first = [g.next_value() for _ in range(5)]
+    clock.return_value -= 1000000000
+    second = [g.next_value() for _ in range(5)]
+    values = first + second
+    assert values == sorted(values)
+    assert len(set(values)) == len(values)
+
+
+def test_snowflake_nodes_differ() -> None:
+    a = ids.SnowflakeIdGenerator(node_id=1)
+    b = ids.SnowflakeIdGenerator(node_id=2)
+    assert len(set([a() for _ in range(1000)] + [b() for _ in range(1000)])) == 2000
+
+
+def test_snowflake_fork(mocker) -> None:
+    g = ids.SnowflakeIdGenerator()
+    parent_pid = g._pid
+    assert g.node_id == ids.default_node_id(g.node_bits)
+    g()
+    mocker.patch("os.getpid", return_value=parent_pid + 1)
+    g()
+    assert g._pid == parent_pid + 1
+    assert g.node_id == ids.default_node_id(g.node_bits)
+
+
+def test_snowflake_default_node(mocker) -> None:
+    g = ids.SnowflakeIdGenerator()
+    assert 0 <= g.node_id < 2 ** 14
+    generated = [g() for _ in range(1000)]
+    assert len(set(generated)) == len(generated)
+    assert all(len(i) == 20 and i.isdigit() for i in generated)
+    # Process IDs that used to fold onto the same node don't anymore.
+    mocker.patch("os.getpid", return_value=100)
+    low = ids.default_node_id(14)
+    mocker.patch("os.getpid", return_value=100 + 2 ** 14)
+    assert ids.default_node_id(14) != low
+    assert ids.SnowflakeIdGenerator(node_bits=15, sequence_bits=11).node_id < 2 ** 15
+
+
+def test_snowflake_length_limits() -> None:
+    g = ids.SnowflakeIdGenerator(node_id=5, max_length=13, alphabet=ids.BASE36)
+    i = g()
+    assert len(i) == 13
+    assert int(i, 36) > 0
+    with pytest.raises(ValueError):
+        ids.SnowflakeIdGenerator(node_id=5, max_length=16)
+    with pytest.raises(ValueError):
+        ids.SnowflakeIdGenerator(node_id=2 ** 14)
+
+
+def test_default_generator(trivial_a08: bytes) -> None:
+    previous = ids.get_default_generator()
+    assert isinstance(previous, ids.SnowflakeIdGenerator)
+    assert len(utils.generate_message_id()) == 20
+    try:
+        ids.set_default_generator(lambda: "fixed")
+        assert utils.generate_message_id() == "fixed"
+    finally:
+        ids.set_default_generator(previous)
+    p = Hl7Parser()
+    ack = utils.generate_ack(p.parse_message(trivial_a08), utils.Acks.AA, id_generator=lambda: "myid")
+    assert ack["MSH-10"] == "myid"
+    orm = utils.OrmBuilder(id_generator=lambda: "ormid").build()
+    assert orm["MSH-10"] == "ormid"
@@ -0,0 +1,114 @@
+import pytest
+import os
+import threading
+from src.hl7lw.journal import Journal, JournalReader, JournalCursor, HEADER
+from src.hl7lw.exceptions import JournalError
+
+
+def test_append_commit_read(tmp_path) -> None:
+    journal = Journal(str(tmp_path))
+    positions = [journal.append(f"message {i}".encode()) for i in range(2)]
+    assert positions[0] == 0
+    assert positions[1] == HEADER.size + len(b"message 0")
+    reader = journal.read()
+    assert list(reader) == []  # Nothing committed yet.
+    journal.commit(positions[0])  # Commits everything appended so far.
+    assert [m for _, m in reader] == [b"message 0", b"message 1"]
+    positions.append(journal.append(b"message 2"))
+    assert list(reader) == []
+    journal.sync()
+    assert list(reader) == [(positions[2], b"message 2")]
+    assert reader.position == journal.end
+    reader.close()
+    journal.close()
+    with pytest.raises(JournalError):
+        journal.append(b"closed")
+
+
+def test_rotation_and_purge(tmp_path) -> None:
+    journal = Journal(str(tmp_path), segment_size=100)
+    messages = [f"message {i:02d}".encode() for i in range(20)]
+    positions = [journal.append(m) for m in messages]
+    journal.sync()
+    segments = journal.segments()
+    assert len(segments) > 3
+    assert set(segments) <= set(positions)
+    # A reader in another process only sees the files.
+    reader = JournalReader(str(tmp_path))
+    assert [m for _, m in reader] == messages
+    reader.close()
+    reader = JournalReader(str(tmp_path), positions[10])
+    assert [m for _, m in reader] == messages[10:]
+    reader.close()
+    assert journal.purge(positions[10]) > 0
+    assert journal.segments()[0] <= positions[10]
+    with pytest.raises(JournalError):
+        JournalReader(str(tmp_path), 0).next_record()
+    journal.close()
+
+
+def test_reopen_recovers_torn_tail(tmp_path) -> None:
+    journal = Journal(str(tmp_path))
+    journal.append(b"first")
+    journal.append(b"second")
+    journal.close()
+    path = journal.segment_path(0)
+    with open(path, 'ab') as f:
+        f.write(HEADER.pack(100, 0) + b"torn")  # Crashed halfway through a write.
+    journal = Journal(str(tmp_path))
+    assert journal.end == os.path.getsize(path) == 2 * HEADER.size + len(b"firstsecond")
+    journal.append(b"third")
+    journal.sync()
+    assert [m for _, m in journal.read()] == [b"first", b"second", b"third"]
+    journal.close()
+
+
+def test_corrupted_record(tmp_path) -> None:
+    journal = Journal(str(tmp_path), fsync=False)
+    journal.append(b"first")
+    journal.close()
+    with open(journal.segment_path(0), 'r+b') as f:
+        f.seek(HEADER.size)
+        f.write(b"F")
+    with pytest.raises(JournalError):
+        list(JournalReader(str(tmp_path)))
+
+
+def test_group_commit_threads(tmp_path) -> None:
+    journal = Journal(str(tmp_path))
+    written = []
+
+    def writer(n):
+        for i in range(200):
+            message = f"{n}-{i}".encode()
+            journal.commit(journal.append(message))
+            written.append(message)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert journal.synced == journal.end
+    assert sorted(m for _, m in journal.read()) == sorted(written)
+    journal.close()
+
+
+def test_cursor(tmp_path) -> None:
+    cursor = JournalCursor(str(tmp_path / "cursor"))
+    assert cursor.load() == 0
+    cursor.save(1234)
+    assert JournalCursor(str(tmp_path / "cursor")).load() == 1234
+
+
+def test_append_file(tmp_path) -> None:
+    journal = Journal(str(tmp_path))
+    payload = os.urandom(200000)
+    with open(tmp_path / "payload", "w+b") as f:
+        f.write(payload)
+        f.seek(0)
+        position = journal.append(f)
+        assert f.tell() == 0
+    journal.sync()
+    assert list(journal.read()) == [(position, payload)]
+    journal.close()
@@ -16,6 +16,14 @@ def test_a08_parsing(trivial_a08: bytes) -> None:
     assert expected == actual
 
 
+def test_parsing_bytes_like(trivial_a08: bytes) -> None:
+    p = Hl7Parser()
+    expected = str(p.parse_message(trivial_a08))
+    assert str(p.parse_message(bytearray(trivial_a08))) == expected
+    assert str(p.parse_message(memoryview(trivial_a08))) == expected
+    assert p.parse_segment(memoryview(b"PID|1||1234")).fields == ['1', '', '1234']
+
+
 def test_segments(trivial_a08: bytes) -> None:
     p = Hl7Parser()
     m = p.parse_message(message=trivial_a08)
@@ -0,0 +1,82 @@
+import pytest
+import threading
+from src.hl7lw import Hl7Parser, InvalidHl7Message
+from src.hl7lw.metrics import Metrics, Histogram
+from src.hl7lw.mllp import MllpClient, MllpServer, AckPolicy
+
+
+def test_histogram_buckets() -> None:
+    h = Histogram([1, 10, 100])
+    for value in (0.5, 1, 5, 50, 500):
+        h.observe(value)
+    assert h.cumulative() == [(1, 2), (10, 3), (100, 4), (float('inf'), 5)]
+    assert h.sum == 556.5
+    assert h.count == 5
+
+
+def test_render_prometheus() -> None:
+    events = []
+    m = Metrics(sink=lambda *event: events.append(event))
+    m.inc('mllp_server_messages_received_total')
+    m.inc('mllp_server_messages_received_total', 2)
+    m.gauge_add('mllp_server_connections_open', 1)
+    m.observe('mllp_server_frame_size_bytes', 200)
+    m.observe('custom_seconds', 0.02)
+    text = m.render_prometheus()
+    assert "# TYPE hl7lw_mllp_server_messages_received_total counter\n" in text
+    assert "hl7lw_mllp_server_messages_received_total 3\n" in text
+    assert "hl7lw_mllp_server_connections_open 1\n" in text
+    assert 'hl7lw_mllp_server_frame_size_bytes_bucket{le="128"} 0\n' in text
+    assert 'hl7lw_mllp_server_frame_size_bytes_bucket{le="256"} 1\n' in text
+    assert 'hl7lw_mllp_server_frame_size_bytes_bucket{le="+Inf"} 1\n' in text
+    assert "hl7lw_mllp_server_frame_size_bytes_count 1\n" in text
+    assert 'hl7lw_custom_seconds_bucket{le="0.025"} 1\n' in text
+    assert "hl7lw_custom_seconds_sum 0.02\n" in text
+    assert "# TYPE hl7lw_custom_seconds histogram\n" in text
+    assert events[:3] == [
+        ('counter', 'hl7lw_mllp_server_messages_received_total', 1),
+        ('counter', 'hl7lw_mllp_server_messages_received_total', 2),
+        ('gauge', 'hl7lw_mllp_server_connections_open', 1),
+    ]
+    assert Metrics().render_prometheus() == ''
+
+
+def test_parser_metrics(trivial_a08: bytes) -> None:
+    m = Metrics()
+    p = Hl7Parser(metrics=m)
+    message = p.parse_message(trivial_a08)
+    p.format_message(message)
+    with pytest.raises(InvalidHl7Message):
+        p.parse_message(b"MSH|^~\\&|unterminated")
+    assert m.histograms['parser_parse_seconds'].count == 1
+    assert m.histograms['parser_format_seconds'].count == 1
+    assert m.counters['parser_errors_total'] == 1
+
+
+def test_mllp_metrics(trivial_a08: bytes) -> None:
+    m = Metrics()
+    server = MllpServer(0, lambda message: None, auto_ack=AckPolicy.AfterCallback, metrics=m)
+    server.listen()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    c = MllpClient(metrics=m)
+    c.connect(host='127.0.0.1', port=server.port)
+    for _ in range(3):
+        c.send(trivial_a08)
+        c.recv()
+    c.close()
+    server.shutdown()
+    thread.join(timeout=5)
+    assert m.counters['mllp_server_connections_accepted_total'] == 1
+    assert m.gauges['mllp_server_connections_open'] == 0
+    assert m.counters['mllp_server_messages_received_total'] == 3
+    assert m.counters['mllp_server_bytes_received_total'] == 3 * (len(trivial_a08) + 3)
+    assert m.histograms['mllp_server_frame_size_bytes'].sum == 3 * len(trivial_a08)
+    assert m.histograms['mllp_server_callback_seconds'].count == 3
+    assert m.counters['mllp_server_messages_sent_total'] == 3
+    assert m.counters['mllp_server_bytes_sent_total'] == m.counters['mllp_client_bytes_received_total']
+    assert m.gauges['mllp_server_write_queue_bytes'] == 0
+    assert m.counters['mllp_client_messages_sent_total'] == 3
+    assert m.counters['mllp_client_bytes_sent_total'] == 3 * (len(trivial_a08) + 3)
+    assert m.counters['mllp_client_messages_received_total'] == 3
+    assert m.histograms['mllp_client_ack_seconds'].count == 3
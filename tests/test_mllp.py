@@ -1,8 +1,44 @@
+import asyncio
 import pytest
+import os
+import random
+import selectors
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 from unittest.mock import call
 import src.hl7lw.mllp
-from src.hl7lw.mllp import MllpClient, MllpServer, START_BYTE, END_BYTES
-from src.hl7lw.exceptions import MllpConnectionError
+from src.hl7lw import Hl7Parser
+from src.hl7lw.mllp import (MllpClient, MllpServer, MllpPipeline, MllpConnectionPool, MllpStoreAndForward,
+                            AckPolicy, START_BYTE, END_BYTES)
+from src.hl7lw.exceptions import (MllpConnectionError, MllpAckTimeout, MllpPoolExhausted, MllpMessageTooLarge,
+                                  MllpServerError, JournalError)
+from src.hl7lw.utils import Acks, generate_ack_bytes, peek_msa
+from src.hl7lw.journal import Journal, JournalCursor, JournalReader
+from src.hl7lw.dedup import DedupCache
+from src.hl7lw.metrics import Metrics
+
+
+SERVER_THREADS = {}
+
+
+def start_server(server: MllpServer) -> MllpClient:
+    """
+    Run `server` in a daemon thread and return a client connected to it.
+    """
+    server.listen()
+    SERVER_THREADS[server] = threading.Thread(target=server.serve_forever, daemon=True)
+    SERVER_THREADS[server].start()
+    c = MllpClient()
+    c.connect(host='127.0.0.1', port=server.port)
+    return c
+
+
+def stop_server(server: MllpServer) -> None:
+    server.shutdown()
+    SERVER_THREADS.pop(server).join(timeout=5)
 
 
 def test_client_connect(mocker) -> None:
@@ -130,13 +166,49 @@ def test_two_messages_in_one_packet(mocker) -> None:
     assert received2 == b"message2"
 
 
+def test_get_message_end_bytes_split(mocker, trivial_a08: bytes) -> None:
+    c = MllpClient(bufsize=1)
+    mock_socket = mocker.patch('socket.socket')
+    framed = START_BYTE + trivial_a08 + END_BYTES + START_BYTE + b"second" + END_BYTES
+    mock_socket.recv.side_effect = [framed[i:i + 1] for i in range(len(framed))]
+    mocker.patch("socket.create_connection", return_value=mock_socket)
+    c.connect(host='test', port=1234)
+    assert c.recv() == trivial_a08
+    assert c.recv() == b"second"
+    assert mock_socket.recv.call_args == call(1)
+
+
+def test_get_large_message_many_reads(mocker) -> None:
+    c = MllpClient()
+    mock_socket = mocker.patch('socket.socket')
+    payload = b"A" * (900 * 1024)
+    framed = START_BYTE + payload + END_BYTES
+    mock_socket.recv.side_effect = [framed[i:i + 4096] for i in range(0, len(framed), 4096)]
+    mocker.patch("socket.create_connection", return_value=mock_socket)
+    c.connect(host='test', port=1234)
+    assert c.recv() == payload
+    assert len(c.decoder) == 0
+
+
+def test_get_message_connection_closed(mocker) -> None:
+    c = MllpClient()
+    mock_socket = mocker.patch('socket.socket')
+    mock_socket.recv.side_effect = [START_BYTE + b"partial", b""]
+    mocker.patch("socket.create_connection", return_value=mock_socket)
+    c.connect(host='test', port=1234)
+    with pytest.raises(MllpConnectionError, match=r'^Connection closed'):
+        c.recv()
+    assert not c.is_connected()
+
+
 def test_send_message(mocker, trivial_a08: bytes) -> None:
     c = MllpClient()
     mock_socket = mocker.patch('socket.socket')
     mocker.patch("socket.create_connection", return_value=mock_socket)
+    mock_socket.sendmsg.return_value = len(START_BYTE + trivial_a08 + END_BYTES)
     c.connect(host='test', port=1234)
     c.send(trivial_a08)
-    assert mock_socket.sendall.call_args == call(START_BYTE + trivial_a08 + END_BYTES)
+    assert mock_socket.sendmsg.call_args == call([START_BYTE, trivial_a08, END_BYTES])
 
 
 def test_send_message_not_connected_default(mocker, trivial_a08: bytes) -> None:
@@ -148,8 +220,9 @@ def test_send_message_not_connected_default(mocker, trivial_a08: bytes) -> None:
     c.close()
     assert mock_socket.close.called
     assert not c.is_connected()
+    mock_socket.sendmsg.return_value = len(START_BYTE + trivial_a08 + END_BYTES)
     c.send(trivial_a08)
-    assert mock_socket.sendall.call_args == call(START_BYTE + trivial_a08 + END_BYTES)
+    assert mock_socket.sendmsg.call_args == call([START_BYTE, trivial_a08, END_BYTES])
 
 
 def test_close_unopened():
@@ -181,8 +254,1114 @@ def test_send_message_exception(mocker, trivial_a08: bytes) -> None:
     c = MllpClient()
     e = OSError("socket")
     mock_socket = mocker.patch('socket.socket')
-    mock_socket.sendall.side_effect = e
+    mock_socket.sendmsg.side_effect = e
     mocker.patch("socket.create_connection", return_value=mock_socket)
     c.connect(host='test', port=1234)
     with pytest.raises(MllpConnectionError, match=r'^Failed to send message to client.'):
         c.send(trivial_a08)
+
+
+def test_send_message_partial_sends(mocker, trivial_a08: bytes) -> None:
+    c = MllpClient()
+    mock_socket = mocker.patch('socket.socket')
+    mocker.patch("socket.create_connection", return_value=mock_socket)
+    sent = []
+
+    def sendmsg(buffers):
+        data = b''.join(buffers)[:10]  # A slow socket, 10 bytes at a time.
+        sent.append(data)
+        return len(data)
+
+    mock_socket.sendmsg.side_effect = sendmsg
+    c.connect(host='test', port=1234)
+    c.send(trivial_a08)
+    assert b''.join(sent) == START_BYTE + trivial_a08 + END_BYTES
+
+
+def test_send_message_without_sendmsg(mocker, trivial_a08: bytes) -> None:
+    mocker.patch("src.hl7lw.mllp.HAS_SENDMSG", False)
+    c = MllpClient()
+    mock_socket = mocker.patch('socket.socket')
+    mocker.patch("socket.create_connection", return_value=mock_socket)
+    c.connect(host='test', port=1234)
+    c.send_many([trivial_a08, trivial_a08])
+    assert mock_socket.sendall.call_args == call((START_BYTE + trivial_a08 + END_BYTES) * 2)
+    if hasattr(socket, 'TCP_CORK'):
+        assert mock_socket.setsockopt.call_args_list == [call(socket.IPPROTO_TCP, socket.TCP_CORK, 1),
+                                                         call(socket.IPPROTO_TCP, socket.TCP_CORK, 0)]
+
+
+def test_send_many() -> None:
+    server = MllpServer(0, lambda message: None, auto_ack=AckPolicy.AfterCallback)
+    c = start_server(server)
+    c.send_many(numbered_message(i) for i in range(500))
+    if hasattr(socket, 'TCP_CORK'):
+        assert c.socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_CORK) == 0  # Flushed
+    assert [peek_msa(c.recv())[2] for _ in range(500)] == [str(i) for i in range(500)]
+    c.send_many([])
+    c.close()
+    stop_server(server)
+
+
+def test_server_callback_ack(trivial_a08: bytes) -> None:
+    server = MllpServer(0, lambda message: b"ACK:" + message[:3])
+    c = start_server(server)
+    c.send(trivial_a08)
+    assert c.recv() == b"ACK:MSH"
+    c.close()
+    stop_server(server)
+
+
+def test_server_auto_ack_after_callback(trivial_a08: bytes) -> None:
+    results = [None, Acks.AE]
+    received = []
+
+    def callback(message: bytes):
+        received.append(message)
+        return results.pop(0)
+
+    server = MllpServer(0, callback, auto_ack=AckPolicy.AfterCallback)
+    c = start_server(server)
+    p = Hl7Parser()
+    c.send(trivial_a08)
+    ack = p.parse_message(c.recv())
+    assert ack["MSA-1"] == "AA"
+    assert ack["MSA-2"] == "203550"
+    c.send(trivial_a08)
+    assert p.parse_message(c.recv())["MSA-1"] == "AE"
+    assert received == [trivial_a08, trivial_a08]
+    c.close()
+    stop_server(server)
+
+
+@pytest.mark.parametrize("mode", ["inline", "executor", "future"])
+def test_server_callback_error_gets_ae(mode: str) -> None:
+    metrics = Metrics()
+
+    def callback(message: bytes):
+        if message == numbered_message(1):
+            if mode == "future":
+                future = Future()
+                future.set_exception(RuntimeError("Deferred failure"))
+                return future
+            raise RuntimeError("Callback failure")
+        return None
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        server = MllpServer(0, callback, auto_ack=AckPolicy.AfterCallback, metrics=metrics,
+                            executor=executor if mode == "executor" else None)
+        c = start_server(server)
+        for i in range(3):
+            c.send(numbered_message(i))
+        # The server survives the exception and the ACKs stay in order.
+        assert [(peek_msa(ack)[1], peek_msa(ack)[2]) for ack in (c.recv() for _ in range(3))] == \
+            [("AA", "0"), ("AE", "1"), ("AA", "2")]
+        c.close()
+        stop_server(server)
+    assert metrics.counters['mllp_server_callback_errors_total'] == 1
+
+
+def test_server_auto_ack_on_receipt(trivial_a08: bytes) -> None:
+    acked = threading.Event()
+    callback_ran_after_ack = []
+
+    def callback(message: bytes):
+        callback_ran_after_ack.append(acked.wait(timeout=5))
+        return Acks.AR  # Ignored
+
+    server = MllpServer(0, callback, auto_ack=AckPolicy.OnReceipt)
+    c = start_server(server)
+    c.send(trivial_a08)
+    ack = Hl7Parser().parse_message(c.recv())
+    acked.set()
+    assert ack["MSA-1"] == "AA"
+    c.send(b"not hl7")
+    c.send(trivial_a08)
+    assert Hl7Parser().parse_message(c.recv())["MSA-1"] == "AA"
+    for _ in range(50):
+        if len(callback_ran_after_ack) == 3:
+            break
+        time.sleep(0.05)  # The callback runs after the ACK is out.
+    assert callback_ran_after_ack == [True, True, True]
+    c.close()
+    stop_server(server)
+
+
+def test_server_pipelined_messages() -> None:
+    server = MllpServer(0, lambda message: b"ACK:" + message)
+    c = start_server(server)
+    # All in one write, the server must not wait for more bytes to process them.
+    c.socket.sendall(b"".join(START_BYTE + m + END_BYTES for m in (b"1", b"2", b"3")))
+    assert [c.recv(), c.recv(), c.recv()] == [b"ACK:1", b"ACK:2", b"ACK:3"]
+    c.close()
+    stop_server(server)
+
+
+def test_server_disconnects_oversized(mocker) -> None:
+    mocker.patch("src.hl7lw.mllp.MAX_MESSAGE_SIZE", 1024)
+    server = MllpServer(0, lambda message: b"ACK")
+    c = start_server(server)
+    c.send(b"A" * 4096)
+    with pytest.raises(MllpConnectionError):
+        c.recv()
+    stop_server(server)
+
+
+def test_server_shutdown_and_idle_connections() -> None:
+    server = MllpServer(0, lambda message: b"ACK")
+    server.listen()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    idle = [socket.create_connection(('127.0.0.1', server.port)) for _ in range(20)]
+    c = MllpClient()
+    c.connect(host='127.0.0.1', port=server.port)
+    c.send(b"message")
+    assert c.recv() == b"ACK"
+    assert len(server.connections) == 21
+    # Write interest is dropped once the ACK is out.
+    for _ in range(50):
+        if not any(conn.writing for conn in server.connections.values()):
+            break
+        time.sleep(0.02)
+    assert not any(conn.writing for conn in server.connections.values())
+    server.shutdown()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert server.socket is None
+    assert len(server.connections) == 0
+    for sock in idle:
+        assert sock.recv(10) == b""
+        sock.close()
+
+
+def test_server_executor_ordering_and_concurrency() -> None:
+    release = threading.Event()
+
+    def callback(message: bytes) -> bytes:
+        if message == b"slow":
+            release.wait(timeout=5)
+        else:
+            time.sleep(random.random() / 100)
+        return b"ACK:" + message
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        server = MllpServer(0, callback, executor=executor)
+        slow = start_server(server)
+        fast = MllpClient()
+        fast.connect(host='127.0.0.1', port=server.port)
+        slow.send(b"slow")
+        messages = [str(i).encode() for i in range(20)]
+        for m in messages:
+            fast.send(m)
+        # The slow callback does not hold back the other connection, and ACKs
+        # come back in order even though callbacks take random time.
+        assert [fast.recv() for _ in messages] == [b"ACK:" + m for m in messages]
+        release.set()
+        assert slow.recv() == b"ACK:slow"
+        stop_server(server)
+
+
+def uppercase(message: bytes) -> bytes:
+    return message.upper()
+
+
+def test_server_process_pool() -> None:
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        server = MllpServer(0, uppercase, executor=executor)
+        c = start_server(server)
+        c.send(b"message1")
+        c.send(b"message2")
+        assert c.recv() == b"MESSAGE1"
+        assert c.recv() == b"MESSAGE2"
+        stop_server(server)
+
+
+def test_server_executor_auto_ack_on_receipt() -> None:
+    release = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        server = MllpServer(0, lambda message: release.wait(timeout=5),
+                            auto_ack=AckPolicy.OnReceipt, executor=executor)
+        c = start_server(server)
+        start = time.monotonic()
+        for i in range(3):
+            c.send(numbered_message(i))
+        # All the ACKs are out while the first callback is still blocked.
+        assert [(peek_msa(ack)[1], peek_msa(ack)[2]) for ack in (c.recv() for _ in range(3))] == \
+            [("AA", "0"), ("AA", "1"), ("AA", "2")]
+        assert time.monotonic() - start < 2
+        release.set()
+        stop_server(server)
+
+
+def worker_pid(message: bytes) -> bytes:
+    return str(os.getpid()).encode()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'),
+                    reason="Pre-forking is not supported on this platform")
+def test_server_prefork() -> None:
+    server = MllpServer(0, worker_pid)
+    thread = threading.Thread(target=server.serve_prefork, kwargs=dict(workers=2, restart_delay=0))
+    thread.start()
+    try:
+        for _ in range(100):
+            if len(server.worker_pids) == 2 and server.port != 0:
+                break
+            time.sleep(0.05)
+
+        def ask() -> int:
+            for _ in range(100):
+                c = MllpClient()
+                try:
+                    c.connect(host='127.0.0.1', port=server.port)
+                    c.send(b"pid?")
+                    pid = int(c.recv())
+                    c.close()
+                    return pid
+                except MllpConnectionError:
+                    time.sleep(0.05)  # Worker still starting
+            raise RuntimeError("No worker answered.")
+
+        pids = set(ask() for _ in range(30))
+        assert pids <= set(server.worker_pids)
+        killed = pids.pop()
+        os.kill(killed, signal.SIGKILL)
+        for _ in range(100):
+            if killed not in server.worker_pids and len(server.worker_pids) == 2:
+                break
+            time.sleep(0.05)
+        assert killed not in server.worker_pids
+        assert len(server.worker_pids) == 2
+        assert ask() in server.worker_pids
+    finally:
+        server.shutdown()
+        thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert server.worker_pids == {}
+
+
+def numbered_message(number: int) -> bytes:
+    return f"MSH|^~\\&|A|B|C|D|||ADT^A08|{number}|P|2.3\rEVN|A08\r".encode()
+
+
+def raw_server(handler) -> int:
+    """
+    Accept a single connection and hand the socket to `handler` in a thread.
+    """
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def run():
+        conn, _ = listener.accept()
+        listener.close()
+        with conn:
+            handler(conn)
+
+    threading.Thread(target=run, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def read_frames(conn: socket.socket, count: int) -> list:
+    decoder = src.hl7lw.mllp.MllpFrameDecoder()
+    frames = []
+    while len(frames) < count:
+        decoder.feed(conn.recv(4096))
+        frame = decoder.next_frame()
+        while frame is not None:
+            frames.append(frame)
+            frame = decoder.next_frame()
+    return frames
+
+
+def test_pipeline_window() -> None:
+    server = MllpServer(0, lambda message: None, auto_ack=AckPolicy.AfterCallback)
+    c = start_server(server)
+    pipeline = MllpPipeline(c, window=8)
+    futures = [pipeline.submit(numbered_message(i)) for i in range(50)]
+    assert [peek_msa(f.result(timeout=5))[2] for f in futures] == [str(i) for i in range(50)]
+    pipeline.close()
+    assert pipeline.in_flight() == 0
+    c.close()
+    stop_server(server)
+
+
+@pytest.mark.parametrize("ordered", [False, True])
+def test_pipeline_out_of_order_acks(ordered: bool) -> None:
+    def handler(conn):
+        frames = read_frames(conn, 3)
+        for frame in reversed(frames):
+            conn.sendall(START_BYTE + generate_ack_bytes(frame, Acks.AA) + END_BYTES)
+            time.sleep(0.05)
+        time.sleep(0.5)
+
+    c = MllpClient()
+    c.connect(host='127.0.0.1', port=raw_server(handler))
+    pipeline = MllpPipeline(c, window=3, ordered=ordered)
+    completed = []
+    futures = [pipeline.submit(numbered_message(i), callback=lambda f: completed.append(f)) for i in range(3)]
+    assert [peek_msa(f.result(timeout=5))[2] for f in futures] == ["0", "1", "2"]
+    if ordered:
+        assert completed == futures
+    else:
+        assert completed == list(reversed(futures))
+    pipeline.close()
+
+
+def test_pipeline_timeout_and_disconnect() -> None:
+    def handler(conn):
+        frames = read_frames(conn, 2)
+        conn.sendall(START_BYTE + generate_ack_bytes(frames[1], Acks.AA) + END_BYTES)
+        read_frames(conn, 1)
+
+    c = MllpClient()
+    c.connect(host='127.0.0.1', port=raw_server(handler))
+    pipeline = MllpPipeline(c, window=4, timeout=0.2)
+    first = pipeline.submit(numbered_message(1))
+    second = pipeline.submit(numbered_message(2))
+    with pytest.raises(MllpAckTimeout):
+        first.result(timeout=5)
+    assert peek_msa(second.result(timeout=5))[2] == "2"
+    third = pipeline.submit(numbered_message(3))
+    # The handler closes the connection without acking.
+    with pytest.raises(MllpConnectionError):
+        third.result(timeout=5)
+    assert not c.is_connected()
+    with pytest.raises(MllpConnectionError):
+        pipeline.submit(numbered_message(4))
+    pipeline.close()
+
+
+def high_fd(sock: socket.socket, fd: int = 2000) -> socket.socket:
+    """
+    Move `sock` to a descriptor past FD_SETSIZE, or skip the test if that's not allowed.
+    """
+    resource = pytest.importorskip("resource")
+    if resource.getrlimit(resource.RLIMIT_NOFILE)[0] <= fd:
+        pytest.skip("Not enough file descriptors allowed")
+    os.dup2(sock.fileno(), fd)
+    moved = socket.socket(fileno=fd)
+    sock.close()
+    return moved
+
+
+def test_pipeline_high_fd() -> None:
+    server = MllpServer(0, lambda message: None, auto_ack=AckPolicy.AfterCallback)
+    c = start_server(server)
+    c.socket = high_fd(c.socket)
+    pipeline = MllpPipeline(c, window=4)
+    futures = [pipeline.submit(numbered_message(i)) for i in range(10)]
+    assert [peek_msa(f.result(timeout=5))[2] for f in futures] == [str(i) for i in range(10)]
+    start = time.monotonic()
+    pipeline.close()
+    assert time.monotonic() - start < 1
+    c.close()
+    stop_server(server)
+
+
+def test_pipeline_settles_once() -> None:
+    def handler(conn):
+        read_frames(conn, 1)
+        time.sleep(0.5)
+
+    c = MllpClient()
+    c.connect(host='127.0.0.1', port=raw_server(handler))
+    pipeline = MllpPipeline(c, window=1, timeout=None)
+    first = pipeline.submit(numbered_message(1))
+    pending = pipeline._by_id["1"][0]
+    pipeline._fail_all(MllpConnectionError("Broken"))
+    # A late ACK for a failed message is ignored, the future is only resolved once.
+    pipeline._complete(pending, generate_ack_bytes(numbered_message(1), Acks.AA))
+    with pytest.raises(MllpConnectionError, match="Broken"):
+        first.result(timeout=5)
+    with pytest.raises(MllpConnectionError):
+        pipeline.submit(numbered_message(2))
+    pipeline.close()
+    c.close()
+
+
+def test_pipeline_reader_survives_errors(mocker) -> None:
+    def handler(conn):
+        read_frames(conn, 1)
+        time.sleep(0.5)
+
+    c = MllpClient()
+    c.connect(host='127.0.0.1', port=raw_server(handler))
+    pipeline = MllpPipeline(c, window=1, timeout=5)
+    mocker.patch.object(pipeline, "_expire", side_effect=RuntimeError("Unexpected"))
+    first = pipeline.submit(numbered_message(1))
+    with pytest.raises(MllpConnectionError):
+        first.result(timeout=5)
+    # The slot is given back, submitting fails instead of blocking forever.
+    with pytest.raises(MllpConnectionError):
+        pipeline.submit(numbered_message(2))
+    pipeline.close()
+
+
+def test_pool_reuses_connections(trivial_a08: bytes) -> None:
+    server = MllpServer(0, lambda message: None, auto_ack=AckPolicy.AfterCallback)
+    start_server(server).close()
+    pool = MllpConnectionPool(max_size=2)
+    with pool.connection('127.0.0.1', server.port) as c:
+        c.send(trivial_a08)
+        c.recv()
+    with pool.connection('127.0.0.1', server.port) as c2:
+        c2.send(trivial_a08)
+        c2.recv()
+    assert c2 is c
+    assert pool.size('127.0.0.1', server.port) == 1
+    assert pool.idle('127.0.0.1', server.port) == 1
+    pool.close()
+    assert not c.is_connected()
+    with pytest.raises(MllpConnectionError):
+        pool.checkout('127.0.0.1', server.port)
+    stop_server(server)
+
+
+def test_pool_max_size_across_threads(trivial_a08: bytes) -> None:
+    server = MllpServer(0, lambda message: None, auto_ack=AckPolicy.AfterCallback)
+    start_server(server).close()
+    pool = MllpConnectionPool(max_size=2)
+    peak = []
+
+    def worker():
+        for _ in range(20):
+            with pool.connection('127.0.0.1', server.port) as c:
+                peak.append(pool.size('127.0.0.1', server.port))
+                c.send(trivial_a08)
+                c.recv()
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert len(peak) == 160
+    assert max(peak) <= 2
+
+    first = pool.checkout('127.0.0.1', server.port)
+    second = pool.checkout('127.0.0.1', server.port)
+    with pytest.raises(MllpPoolExhausted):
+        pool.checkout('127.0.0.1', server.port, timeout=0.05)
+    pool.checkin(first)
+    assert pool.checkout('127.0.0.1', server.port, timeout=0.05) is first
+    pool.checkin(first)
+    pool.checkin(second, discard=True)
+    assert not second.is_connected()
+    assert pool.size('127.0.0.1', server.port) == 1
+    with pytest.raises(ValueError):
+        pool.checkin(second)
+    pool.close()
+    stop_server(server)
+
+
+def test_pool_discards_stale_connections() -> None:
+    listener = socket.create_server(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    pool = MllpConnectionPool()
+    c = pool.checkout('127.0.0.1', port)
+    pool.checkin(c)
+    conn, _ = listener.accept()
+    conn.close()  # The other side drops the idle connection.
+    time.sleep(0.05)
+    c2 = pool.checkout('127.0.0.1', port)
+    assert c2 is not c
+    assert not c.is_connected()
+    assert pool.size('127.0.0.1', port) == 1
+    pool.checkin(c2)
+    listener.close()
+    pool.close()
+
+
+def test_pool_health_check_high_fd() -> None:
+    server = MllpServer(0, lambda message: None, auto_ack=AckPolicy.AfterCallback)
+    start_server(server).close()
+    pool = MllpConnectionPool(max_size=1)
+    c = pool.checkout('127.0.0.1', server.port)
+    c.socket = high_fd(c.socket)
+    assert MllpConnectionPool.is_healthy(c)
+    pool.checkin(c)
+    assert pool.checkout('127.0.0.1', server.port) is c  # Not reconnected.
+    c.send(numbered_message(1))
+    assert peek_msa(c.recv())[2] == "1"
+    c.socket.sendall(START_BYTE + numbered_message(2) + END_BYTES)
+    time.sleep(0.1)  # An unread ACK makes it unusable.
+    assert not MllpConnectionPool.is_healthy(c)
+    pool.checkin(c)
+    pool.close()
+    stop_server(server)
+
+
+def test_pool_idle_eviction_and_warm() -> None:
+    listener = socket.create_server(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    pool = MllpConnectionPool(min_size=1, max_size=4, idle_timeout=0.05)
+    pool.warm('127.0.0.1', port)
+    assert pool.idle('127.0.0.1', port) == 1
+    clients = [pool.checkout('127.0.0.1', port) for _ in range(3)]
+    for c in clients:
+        pool.checkin(c)
+    assert pool.idle('127.0.0.1', port) == 3
+    time.sleep(0.1)
+    assert pool.prune() == 2
+    assert pool.size('127.0.0.1', port) == 1
+    pool.close()
+    pool = MllpConnectionPool(min_size=3, max_size=4)
+    pool.warm('127.0.0.1', port)
+    assert pool.size('127.0.0.1', port) == 3
+    assert pool.idle('127.0.0.1', port) == 3
+    pool.warm('127.0.0.1', port)
+    assert pool.size('127.0.0.1', port) == 3
+    listener.close()
+    pool.close()
+
+
+def test_server_write_watermarks(mocker) -> None:
+    server = MllpServer(0, lambda message: None, write_high_water=10, write_low_water=4)
+    server.selector = mocker.Mock()
+    sock = mocker.Mock()
+    connection = src.hl7lw.mllp.ServerConnection(sock, ('127.0.0.1', 1234))
+    server.queue_write(connection, b'123456')
+    assert not connection.paused
+    server.selector.modify.assert_called_with(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+    server.queue_write(connection, b'789ABC')
+    assert connection.paused
+    assert connection.write_size == 12
+    server.selector.modify.assert_called_with(sock, selectors.EVENT_WRITE, connection)
+    # Partial sends keep a view on the remainder, still over the low water mark.
+    sock.send.side_effect = [4]
+    server.write(connection)
+    assert [bytes(b) for b in connection.write_queue] == [b'56', b'789ABC']
+    sock.send.side_effect = [2, 1]
+    server.write(connection)
+    assert connection.write_size == 5
+    assert [bytes(b) for b in connection.write_queue] == [b'89ABC']
+    assert connection.paused
+    sock.send.side_effect = [BlockingIOError()]
+    server.write(connection)
+    assert connection.paused
+    sock.send.side_effect = [1]
+    server.write(connection)
+    assert not connection.paused
+    server.selector.modify.assert_called_with(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+    sock.send.side_effect = [4]
+    server.write(connection)
+    assert not connection.write_queue
+    assert connection.write_size == 0
+    server.selector.modify.assert_called_with(sock, selectors.EVENT_READ, connection)
+
+
+def test_server_backpressure_on_flooding_client() -> None:
+    count = 1000
+    sizes = []
+
+    def callback(message: bytes) -> bytes:
+        sizes.extend(c.write_size for c in server.connections.values())
+        return b'A' * 10000
+
+    server = MllpServer(0, callback, write_high_water=64 * 1024, write_low_water=16 * 1024)
+    start_server(server).close()
+    flooder = socket.socket()
+    flooder.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    flooder.connect(('127.0.0.1', server.port))
+    sender = threading.Thread(target=lambda: flooder.sendall(
+        b''.join(START_BYTE + numbered_message(i) + END_BYTES for i in range(count))))
+    sender.start()
+    time.sleep(0.5)  # Nobody reads the ACKs, the server has to pause.
+    assert len(sizes) < count
+    assert max(sizes) <= 64 * 1024 + 10000
+    acks = read_frames(flooder, count)
+    sender.join(timeout=5)
+    assert len(acks) == count
+    assert max(sizes) <= 64 * 1024 + 10000
+    flooder.close()
+    stop_server(server)
+
+
+def test_store_and_forward(tmp_path, trivial_a08: bytes) -> None:
+    received = []
+    rejected = []
+
+    def callback(message: bytes):
+        received.append(message)
+        return Acks.AR if b"|REJECT|" in message else None
+
+    server = MllpServer(0, callback, auto_ack=AckPolicy.AfterCallback)
+    server.listen()
+    port = server.port
+    server.socket.close()
+    server.socket = None  # Downstream is down for now.
+    forwarder = MllpStoreAndForward(str(tmp_path), '127.0.0.1', port, retry_delay=0.05,
+                                    on_reject=lambda message, ack: rejected.append(message))
+    reject = numbered_message(2).replace(b"|2|", b"|REJECT|")
+    positions = [forwarder.send(m) for m in (numbered_message(1), reject, numbered_message(3))]
+    assert not forwarder.wait_delivered(timeout=0.2)
+    assert forwarder.last_error is not None
+    start_server(server).close()
+    assert forwarder.wait_delivered(timeout=5)
+    assert received == [numbered_message(1), reject, numbered_message(3)]
+    assert rejected == [reject]
+    assert forwarder.backlog() == 0
+    forwarder.close()
+
+    # Restarting resumes after the last delivered message.
+    forwarder = MllpStoreAndForward(str(tmp_path), '127.0.0.1', port, retry_delay=0.05)
+    assert forwarder.delivered > positions[-1]
+    position = forwarder.send(numbered_message(4))
+    assert forwarder.wait_delivered(position, timeout=5)
+    forwarder.close()
+    assert received[3:] == [numbered_message(4)]
+    stop_server(server)
+
+
+def test_store_and_forward_send_many(mocker, tmp_path) -> None:
+    received = []
+    server = MllpServer(0, received.append, auto_ack=AckPolicy.AfterCallback)
+    server.listen()
+    port = server.port
+    server.socket.close()
+    server.socket = None  # Down, so that only the journal syncs.
+    forwarder = MllpStoreAndForward(str(tmp_path), '127.0.0.1', port, retry_delay=0.05)
+    fsyncs = mocker.spy(os, "fsync")
+    positions = forwarder.send_many(numbered_message(i) for i in range(10))
+    assert fsyncs.call_count == 1
+    assert positions == sorted(positions) and len(positions) == 10
+    assert forwarder.send_many([]) == []
+    assert fsyncs.call_count == 1
+    start_server(server).close()
+    assert forwarder.wait_delivered(positions[-1], timeout=5)
+    assert received == [numbered_message(i) for i in range(10)]
+    forwarder.close()
+    stop_server(server)
+
+
+def test_store_and_forward_cursor_and_close(mocker, tmp_path) -> None:
+    mocker.patch("src.hl7lw.mllp.CLOSE_GRACE", 0.2)
+    saves = mocker.spy(JournalCursor, "save")
+    server = MllpServer(0, lambda message: None, auto_ack=AckPolicy.AfterCallback)
+    start_server(server).close()
+    forwarder = MllpStoreAndForward(str(tmp_path), '127.0.0.1', server.port, cursor_interval=60)
+    positions = [forwarder.send(numbered_message(i)) for i in range(100)]
+    assert forwarder.wait_delivered(timeout=5)
+    forwarder.close()
+    stop_server(server)
+    # Once when leaving the first segment and once on close, not once per ACK.
+    assert saves.call_count == 2
+    assert JournalCursor(str(tmp_path / "cursor")).load() > positions[-1]
+
+    def handler(conn):
+        read_frames(conn, 1)
+        time.sleep(2)  # Never ACKs.
+
+    forwarder = MllpStoreAndForward(str(tmp_path), '127.0.0.1', raw_server(handler), ack_timeout=None)
+    forwarder.send(numbered_message(100))
+    time.sleep(0.1)
+    start = time.monotonic()
+    forwarder.close()
+    assert time.monotonic() - start < 1.5
+    assert forwarder.backlog() > 0
+
+
+def test_store_and_forward_survives_errors(mocker, tmp_path) -> None:
+    server = MllpServer(0, lambda message: Acks.AR, auto_ack=AckPolicy.AfterCallback)
+    start_server(server).close()
+    real_save = JournalCursor.save
+    failures = [OSError("Disk full"), JournalError("Corrupted record")]
+
+    def save(self, position: int) -> None:
+        if failures:
+            raise failures.pop(0)
+        real_save(self, position)
+
+    def on_reject(message: bytes, ack: bytes) -> None:
+        raise RuntimeError("Rejection handler failure")
+
+    mocker.patch.object(JournalCursor, "save", save)
+    forwarder = MllpStoreAndForward(str(tmp_path), '127.0.0.1', server.port, retry_delay=0.05,
+                                    on_reject=on_reject)
+    forwarder.send(numbered_message(1))
+    assert forwarder.wait_delivered(timeout=5)
+    position = forwarder.send(numbered_message(2))
+    assert forwarder.wait_delivered(position, timeout=5)
+    assert forwarder._thread.is_alive()
+    assert isinstance(forwarder.last_error, JournalError)
+    assert not failures
+    forwarder.close()
+    stop_server(server)
+    assert JournalCursor(str(tmp_path / "cursor")).load() > position
+
+
+def test_server_journal(tmp_path, trivial_a08: bytes) -> None:
+    journal = Journal(str(tmp_path))
+    server = MllpServer(0, None, auto_ack=AckPolicy.OnReceipt, journal=journal)
+    c = start_server(server)
+    for i in range(3):
+        c.send(numbered_message(i))
+        assert peek_msa(c.recv())[2] == str(i)
+    c.close()
+    stop_server(server)
+    assert journal.synced == journal.end
+    stop = threading.Event()
+    consumed = []
+    for _, message in JournalReader(str(tmp_path)).follow(poll_interval=0.01, stop=stop):
+        consumed.append(message)
+        if len(consumed) == 3:
+            stop.set()
+    assert consumed == [numbered_message(i) for i in range(3)]
+    journal.close()
+    with pytest.raises(ValueError):
+        MllpServer(0, None)
+
+
+def test_server_journal_holds_acks(mocker, tmp_path) -> None:
+    journal = Journal(str(tmp_path))
+    sync = mocker.spy(journal, 'sync')
+    received = []
+    server = MllpServer(0, received.append, auto_ack=AckPolicy.AfterCallback, journal=journal)
+    server.selector = mocker.Mock()
+    sock = mocker.Mock()
+    sock.send.side_effect = lambda data: len(data)
+    connection = src.hl7lw.mllp.ServerConnection(sock, ('127.0.0.1', 1234))
+    server.process_message(connection, numbered_message(1))
+    server.process_message(connection, numbered_message(2))
+    assert received == [numbered_message(1), numbered_message(2)]
+    assert len(connection.held) == 2
+    assert not sock.send.called
+    assert journal.synced < journal.end
+    server.release_held()
+    assert sync.call_count == 1
+    assert journal.synced == journal.end
+    assert sock.send.call_count == 2
+    assert not connection.held
+    server.release_held()
+    assert sync.call_count == 1
+    journal.close()
+
+
+def test_zero_copy_decoder() -> None:
+    decoder = src.hl7lw.mllp.ZeroCopyFrameDecoder(capacity=16)
+    decoder.feed(b"junk" + START_BYTE + b"first" + END_BYTES + START_BYTE + b"sec")
+    first = decoder.next_frame()
+    assert isinstance(first, memoryview)
+    assert first == b"first"
+    assert decoder.next_frame() is None
+    with pytest.raises(BufferError):
+        decoder.feed(b"ond" + END_BYTES)
+    decoder.release()
+    with pytest.raises(ValueError):
+        bytes(first)  # Released, the buffer may be reused.
+    large = b"X" * 1000  # Grows the buffer.
+    decoder.feed(b"ond" + END_BYTES + START_BYTE + large + END_BYTES)
+    assert decoder.next_frame() == b"second"
+    assert decoder.next_frame() == large
+    assert decoder.next_frame() is None
+    assert len(decoder) == 0
+    decoder.release()
+
+
+def test_zero_copy_decoder_too_large(mocker) -> None:
+    mocker.patch("src.hl7lw.mllp.MAX_MESSAGE_SIZE", 100)
+    decoder = src.hl7lw.mllp.ZeroCopyFrameDecoder()
+    decoder.feed(START_BYTE + b"X" * 200)
+    with pytest.raises(MllpMessageTooLarge):
+        decoder.next_frame()
+
+
+def test_zero_copy_client_and_server(trivial_a08: bytes) -> None:
+    received = []
+
+    def callback(message):
+        received.append((type(message), bytes(message)))
+        assert Hl7Parser().parse_message(message)["MSH-9"] == "ADT^A08"
+        return None
+
+    server = MllpServer(0, callback, auto_ack=AckPolicy.AfterCallback, zero_copy=True)
+    server.listen()
+    SERVER_THREADS[server] = threading.Thread(target=server.serve_forever, daemon=True)
+    SERVER_THREADS[server].start()
+    c = MllpClient(zero_copy=True, bufsize=64)
+    c.connect(host='127.0.0.1', port=server.port)
+    c.send_many([trivial_a08] * 3)
+    acks = []
+    for _ in range(3):
+        ack = c.recv()
+        assert isinstance(ack, memoryview)
+        assert peek_msa(ack)[1] == "AA"
+        acks.append(ack)
+    with pytest.raises(ValueError):
+        bytes(acks[0])  # Released by the following recv().
+    assert received == [(memoryview, trivial_a08)] * 3
+    c.close()
+    stop_server(server)
+
+
+def test_decoder_spill() -> None:
+    decoder = src.hl7lw.mllp.MllpFrameDecoder(spill_threshold=10)
+    payload = bytes(range(256)) * 4
+    framed = START_BYTE + payload + END_BYTES + START_BYTE + b"small" + END_BYTES
+    # Byte at a time so END_BYTES gets split across feeds.
+    frames = []
+    for i in range(len(framed)):
+        decoder.feed(framed[i:i + 1])
+        frame = decoder.next_frame()
+        if frame is not None:
+            frames.append(frame)
+    assert len(frames) == 2
+    assert frames[0].read() == payload
+    frames[0].close()
+    assert frames[1] == b"small"
+
+
+def test_decoder_spill_too_large() -> None:
+    decoder = src.hl7lw.mllp.MllpFrameDecoder(max_message_size=100, spill_threshold=10)
+    decoder.feed(START_BYTE + b"X" * 50)
+    assert decoder.next_frame() is None
+    decoder.feed(b"X" * 100)
+    with pytest.raises(MllpMessageTooLarge):
+        decoder.next_frame()
+    assert decoder._spool_size <= 100  # Checked before writing.
+    decoder.clear()
+    # The last chunk, with the end of the frame, is checked too.
+    decoder.feed(START_BYTE + b"X" * 50)
+    assert decoder.next_frame() is None
+    decoder.feed(b"X" * 51 + END_BYTES)
+    with pytest.raises(MllpMessageTooLarge):
+        decoder.next_frame()
+    decoder.clear()
+    decoder.feed(START_BYTE + b"X" * 50)
+    assert decoder.next_frame() is None
+    decoder.feed(b"X" * 50 + END_BYTES)
+    frame = decoder.next_frame()
+    assert frame.read() == b"X" * 100
+    frame.close()
+
+
+def test_server_spill_and_max_message_size(trivial_a08: bytes) -> None:
+    received = []
+
+    def callback(message):
+        if isinstance(message, bytes):
+            received.append(message)
+        else:
+            received.append(message.read())
+        return None
+
+    server = MllpServer(0, callback, auto_ack=AckPolicy.AfterCallback,
+                        max_message_size=200000, spill_threshold=1000)
+    c = start_server(server)
+    large = trivial_a08 + b"OBX|1|ED|PDF||" + b"A" * 100000 + b"\r"
+    for message in (trivial_a08, large):
+        c.send(message)
+        assert peek_msa(c.recv())[1] == "AA"
+    assert received == [trivial_a08, large]
+    c.send(b"A" * 300000)
+    with pytest.raises(MllpConnectionError):
+        c.recv()
+    stop_server(server)
+    with pytest.raises(ValueError):
+        MllpServer(0, callback, zero_copy=True, spill_threshold=1000)
+
+
+def test_client_max_message_size(mocker) -> None:
+    c = MllpClient(max_message_size=100)
+    mock_socket = mocker.patch('socket.socket')
+    mock_socket.recv.return_value = START_BYTE + b"A" * 200
+    mocker.patch("socket.create_connection", return_value=mock_socket)
+    c.connect(host='test', port=1234)
+    with pytest.raises(MllpMessageTooLarge):
+        c.recv()
+    assert not c.is_connected()
+
+
+def test_server_dedup(trivial_a08: bytes) -> None:
+    received = []
+
+    def callback(message: bytes):
+        received.append(message)
+        return Acks.AE if b"|3|" in message else None
+
+    metrics = Metrics()
+    server = MllpServer(0, callback, auto_ack=AckPolicy.AfterCallback, dedup=DedupCache(), metrics=metrics)
+    c = start_server(server)
+    for i in (1, 2, 1, 3, 3, 1):
+        c.send(numbered_message(i))
+        ack = c.recv()
+        assert peek_msa(ack)[1] == ('AE' if i == 3 else 'AA')
+        assert peek_msa(ack)[2] == str(i)
+    assert received == [numbered_message(i) for i in (1, 2, 3, 3)]  # Rejected ones are not remembered.
+    assert metrics.counters['mllp_server_duplicates_total'] == 2
+    c.close()
+    stop_server(server)
+
+
+def test_server_dedup_executor_keeps_order() -> None:
+    release = threading.Event()
+
+    def callback(message: bytes) -> bytes:
+        if message.startswith(b"slow"):
+            release.wait(timeout=5)
+        return generate_ack_bytes(numbered_message(int(message[-1:])), Acks.AA)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        server = MllpServer(0, callback, executor=executor, dedup=DedupCache(key='content'))
+        c = start_server(server)
+        c.send(b"1")
+        assert peek_msa(c.recv())[2] == "1"
+        c.send(b"slow2")
+        c.send(b"1")  # Duplicate, answered once slow2 is.
+        time.sleep(0.1)
+        release.set()
+        assert [peek_msa(c.recv())[2] for _ in range(2)] == ["2", "1"]
+        c.close()
+        stop_server(server)
+
+
+def test_server_deferred_acks() -> None:
+    futures = {}
+
+    def callback(message: bytes) -> Future:
+        future = Future()
+        futures[message] = future
+        return future
+
+    server = MllpServer(0, callback, auto_ack=AckPolicy.AfterCallback)
+    first = start_server(server)
+    second = MllpClient()
+    second.connect(host='127.0.0.1', port=server.port)
+    for i in (1, 2, 3):
+        first.send(numbered_message(i))
+    second.send(numbered_message(4))
+    deadline = time.monotonic() + 5
+    while len(futures) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # The next messages of the first connection wait for the first future, not the other connection.
+    assert set(futures) == {numbered_message(1), numbered_message(4)}
+    futures[numbered_message(4)].set_result(Acks.AE)
+    ack = second.recv()
+    assert (peek_msa(ack)[1], peek_msa(ack)[2]) == ("AE", "4")
+    futures[numbered_message(1)].set_result(None)
+    while len(futures) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    futures[numbered_message(2)].set_result(Acks.AA)
+    while len(futures) < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    futures[numbered_message(3)].set_result(generate_ack_bytes(numbered_message(3), Acks.AR))
+    acks = [peek_msa(first.recv()) for _ in range(3)]
+    assert [(ack[1], ack[2]) for ack in acks] == [("AA", "1"), ("AA", "2"), ("AR", "3")]
+    first.close()
+    second.close()
+    stop_server(server)
+
+
+def test_server_awaitable_callback() -> None:
+    loop = asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+
+    async def callback(message: bytes):
+        await asyncio.sleep(0.01)
+        return Acks.AE if message.endswith(b"|1|P|2.3\rEVN|A08\r") else None
+
+    coroutine = callback(b"")
+    with pytest.raises(MllpServerError):
+        MllpServer(0, callback).as_future(coroutine)  # No loop
+    coroutine.close()
+    server = MllpServer(0, callback, auto_ack=AckPolicy.AfterCallback, loop=loop)
+    c = start_server(server)
+    for i in range(3):
+        c.send(numbered_message(i))
+    assert [peek_msa(c.recv())[1] for _ in range(3)] == ["AA", "AE", "AA"]
+    c.close()
+    stop_server(server)
+    loop.call_soon_threadsafe(loop.stop)
+    loop_thread.join(timeout=5)
+    loop.close()
+
+
+def test_server_connection_limits() -> None:
+    metrics = Metrics()
+    server = MllpServer(0, lambda message: None, auto_ack=AckPolicy.AfterCallback, metrics=metrics,
+                        max_connections=3, max_connections_per_address=2)
+    first = start_server(server)
+    second = MllpClient()
+    second.connect(host='127.0.0.1', port=server.port)
+    third = MllpClient()
+    third.connect(host='127.0.0.1', port=server.port)  # Accepted by the OS, closed by the server.
+    with pytest.raises(MllpConnectionError):
+        third.recv()
+    for c in (first, second):
+        c.send(numbered_message(1))
+        assert peek_msa(c.recv())[1] == "AA"
+    first.close()
+    deadline = time.monotonic() + 5
+    while len(server.connections) > 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    third.connect(host='127.0.0.1', port=server.port)
+    third.send(numbered_message(2))
+    assert peek_msa(third.recv())[1] == "AA"
+    assert metrics.counters['mllp_server_connections_rejected_total'] == 1
+    assert server.max_connections == 3
+    second.close()
+    third.close()
+    stop_server(server)
+
+
+def test_server_idle_and_frame_timeouts() -> None:
+    metrics = Metrics()
+    server = MllpServer(0, lambda message: None, auto_ack=AckPolicy.AfterCallback, metrics=metrics,
+                        idle_timeout=0.3, frame_timeout=0.15)
+    idle = start_server(server)
+    busy = MllpClient()
+    busy.connect(host='127.0.0.1', port=server.port)
+    stuck = socket.create_connection(('127.0.0.1', server.port))
+    stuck.sendall(START_BYTE + numbered_message(0)[:10])
+    idle.send(numbered_message(1))
+    assert peek_msa(idle.recv())[1] == "AA"
+    # The frame times out first, and well before the idle timeout.
+    stuck.settimeout(5)
+    start = time.monotonic()
+    assert stuck.recv(100) == b""
+    assert time.monotonic() - start < 0.3
+    stuck.close()
+    for i in range(8):
+        busy.send(numbered_message(i))
+        assert peek_msa(busy.recv())[1] == "AA"
+        time.sleep(0.1)
+    # Active for 0.8s, longer than the idle timeout, but only the idle one was closed.
+    with pytest.raises(MllpConnectionError):
+        idle.recv()
+    busy.close()
+    stop_server(server)
+    assert metrics.counters['mllp_server_frame_timeouts_total'] == 1
+    assert metrics.counters['mllp_server_idle_timeouts_total'] == 1
+
+
+@pytest.mark.parametrize("timeout", ["idle_timeout", "frame_timeout"])
+def test_server_times_out_client_not_reading(timeout: str) -> None:
+    metrics = Metrics()
+    server = MllpServer(0, lambda message: b'A' * 10000, metrics=metrics,
+                        write_high_water=64 * 1024, write_low_water=16 * 1024, **{timeout: 0.3})
+    start_server(server).close()
+    flooder = socket.socket()
+    flooder.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    flooder.connect(('127.0.0.1', server.port))
+    flooder.settimeout(10)
+
+    def flood():
+        try:
+            flooder.sendall(b''.join(START_BYTE + numbered_message(i) + END_BYTES for i in range(2000)))
+        except OSError:
+            pass  # Closed by the server.
+
+    sender = threading.Thread(target=flood)
+    sender.start()
+    # The ACKs are never read, the server pauses and then gives up on the client.
+    counter = f"mllp_server_{timeout.split('_')[0]}_timeouts_total"
+    deadline = time.monotonic() + 5
+    while not metrics.counters.get(counter) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert metrics.counters[counter] == 1
+    assert metrics.counters['mllp_server_read_pauses_total'] >= 1
+    sender.join(timeout=5)
+    assert len(server.connections) == 0
+    flooder.close()
+    stop_server(server)
@@ -0,0 +1,141 @@
+import datetime
+import json
+import pytest
+import socket
+import threading
+import time
+from src.hl7lw import replay
+from src.hl7lw.exceptions import MllpConnectionError
+from src.hl7lw.mllp import MllpServer, MllpFrameDecoder, AckPolicy, START_BYTE, END_BYTES
+from src.hl7lw.utils import Acks, generate_ack_bytes
+
+
+def make_message(message_id: str, timestamp: str, sender: str = 'APP') -> bytes:
+    return f"MSH|^~\\&|{sender}|FAC|RCV|FAC|{timestamp}||ADT^A08|{message_id}|P|2.5\rPID|1\r".encode()
+
+
+def test_parse_timestamp() -> None:
+    utc = datetime.timezone.utc
+    assert replay.parse_timestamp("20240102030405+0000") == datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=utc)
+    assert replay.parse_timestamp("20240102030405.25-0130") == datetime.datetime(
+        2024, 1, 2, 3, 4, 5, 250000, tzinfo=datetime.timezone(-datetime.timedelta(hours=1, minutes=30)))
+    assert replay.parse_timestamp("2024+0000") == datetime.datetime(2024, 1, 1, tzinfo=utc)
+    assert replay.parse_timestamp("202401021") is None
+    assert replay.parse_timestamp("20241301") is None
+    assert replay.parse_timestamp("") is None
+
+
+def test_read_capture(tmp_path) -> None:
+    a = make_message("1", "20240101000000")
+    b = make_message("2", "20240101000001")
+    framed = tmp_path / "capture.mllp"
+    framed.write_bytes(START_BYTE + a + END_BYTES + b"\n" + START_BYTE + b + END_BYTES)
+    batch = tmp_path / "capture.hl7"
+    batch.write_bytes(b"FHS|^~\\&\nBHS|^~\\&\n" + a.replace(b"\r", b"\n") + b + b"BTS|2\nFTS|1\n")
+    assert list(replay.read_capture(str(framed))) == [a, b]
+    assert list(replay.read_capture(str(batch))) == [a, b]
+    assert replay.read_captures([str(tmp_path)]) == [a, b, a, b]
+
+
+def test_schedule() -> None:
+    messages = [make_message(str(i), t) for i, t in enumerate(
+        ["20240101000000", "20240101000000", "20240101000010", "bad", "20240101000005", "20240101010010"])]
+    assert replay.schedule(messages) == [0, 0, 10, 10, 10, 3610]
+    assert replay.schedule(messages, speed=10, max_gap=60) == [0, 0, 1, 1, 1, 61]
+    assert replay.schedule(messages, rate=2) == [0, 0.5, 1, 1.5, 2, 2.5]
+
+
+def test_replay(tmp_path, capsys) -> None:
+    received = []
+    server = MllpServer(0, received.append, auto_ack=AckPolicy.AfterCallback)
+    server.listen()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    messages = [make_message(str(i), "20240101000000", sender=f"APP{i % 3}") for i in range(60)]
+    for pipeline in (1, 4):
+        replayer = replay.Replayer('127.0.0.1', server.port, messages, replay.schedule(messages, rate=600),
+                                   streams=3, pipeline=pipeline)
+        results = replayer.run()
+        assert [r.ack_code for r in results] == ['AA'] * 60
+        assert [r.message_id for r in results] == [str(i) for i in range(60)]
+        assert {r.stream for r in results if r.index % 3 == 0} == {results[0].stream}  # Kept per sender
+        report = replayer.report()
+        assert report['ack_codes'] == {'AA': 60}
+        assert report['elapsed_seconds'] >= 59 / 600
+        assert report['lag_seconds']['p50'] < 0.05
+    capture = tmp_path / "capture.hl7"
+    capture.write_bytes(b"".join(messages[:5]))
+    assert replay.main(['127.0.0.1', str(server.port), str(capture), '--rate', '1000', '--streams', '2',
+                        '--partition', 'round-robin', '--results', str(tmp_path / "results.jsonl"), '--json']) == 0
+    assert json.loads(capsys.readouterr().out)['messages'] == 5
+    lines = (tmp_path / "results.jsonl").read_text().splitlines()
+    assert [json.loads(line)['stream'] for line in lines] == [0, 1, 0, 1, 0]
+    server.shutdown()
+    thread.join(timeout=5)
+    assert len(received) == 125
+
+
+def test_replay_unreachable(capsys) -> None:
+    listener = socket.create_server(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    messages = [make_message("1", "20240101000000")]
+    with pytest.raises(MllpConnectionError):
+        replay.Replayer('127.0.0.1', port, messages, [0.0]).run()
+    assert replay.main(['127.0.0.1', str(port), '/dev/null']) == 2
+    assert f"Cannot replay to 127.0.0.1:{port}" in capsys.readouterr().err
+
+
+def test_replay_pipeline_reconnects() -> None:
+    listener = socket.create_server(('127.0.0.1', 0))
+    connections = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            connections.append(conn)
+            decoder = MllpFrameDecoder()
+            with conn:
+                while True:
+                    data = conn.recv(4096)
+                    if not data:
+                        break
+                    decoder.feed(data)
+                    message = decoder.next_frame()
+                    if len(connections) == 1 and message is not None:
+                        break  # Drops the first connection without an ACK.
+                    while message is not None:
+                        conn.sendall(START_BYTE + generate_ack_bytes(message, Acks.AA) + END_BYTES)
+                        message = decoder.next_frame()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    messages = [make_message(str(i), "20240101000000") for i in range(4)]
+    replayer = replay.Replayer('127.0.0.1', listener.getsockname()[1], messages, [0, 0.2, 0.3, 0.4],
+                               pipeline=4, timeout=5)
+    results = replayer.run()
+    listener.close()
+    assert results[0].error.startswith("MllpConnectionError")
+    assert [r.ack_code for r in results[1:]] == ['AA'] * 3
+    assert len(connections) == 2
+
+
+def test_replay_lag_includes_window_wait() -> None:
+    def callback(message: bytes) -> None:
+        time.sleep(0.1)
+
+    server = MllpServer(0, callback, auto_ack=AckPolicy.AfterCallback)
+    server.listen()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    messages = [make_message(str(i), "20240101000000") for i in range(3)]
+    replayer = replay.Replayer('127.0.0.1', server.port, messages, [0.0] * 3, pipeline=2)
+    results = replayer.run()
+    assert [r.ack_code for r in results] == ['AA'] * 3
+    # The third message waited for the first ACK to get into the window.
+    assert results[2].lag >= 0.09
+    server.shutdown()
+    thread.join(timeout=5)
@@ -0,0 +1,209 @@
+import pytest
+import re
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src.hl7lw import Hl7Parser
+from src.hl7lw.exceptions import InvalidHl7FieldReference
+from src.hl7lw.mllp import MllpClient, MllpServer, AckPolicy
+from src.hl7lw.routing import Route, Destination, Router
+from src.hl7lw.utils import Acks, peek_msh, peek_msa
+
+
+def message(message_type: str, sender: str = "LIS", control_id: str = "1", body: str = "PID|1||123") -> bytes:
+    return f"MSH|^~\\&|{sender}|FAC|RCV|FAC|20240101||{message_type}|{control_id}|P|2.5\r{body}\r".encode()
+
+
+class Downstream:
+    """
+    An MllpServer in a thread, recording what it gets and answering with `codes`
+    in turn, AA once they're used up.
+    """
+    def __init__(self, codes=(), delay: float = 0.0) -> None:
+        self.received = []
+        self.codes = list(codes)
+        self.delay = delay
+        self.server = MllpServer(0, self.callback, auto_ack=AckPolicy.AfterCallback)
+        self.server.listen()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def callback(self, message: bytes) -> Acks:
+        time.sleep(self.delay)
+        self.received.append(message)
+        return self.codes.pop(0) if self.codes else Acks.AA
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.thread.join(timeout=5)
+
+
+def test_route_matching() -> None:
+    parse = Hl7Parser().parse_message
+    oru = message("ORU^R01", body="PID|1||123\rOBX|1|ST|A||x\rOBX|2|ST|B||y")
+    adt = message("ADT^A01", sender="ADT")
+    cases = [
+        (Route(["d"]), True, True),
+        (Route(["d"], {"MSH-9.1": "ORU"}), True, False),
+        (Route(["d"], {"MSH-3": {"LIS", "ADT"}, "MSH-9": re.compile(r"ADT\^A0[1-4]")}), False, True),
+        (Route(["d"], {"MSH-10": lambda v: v.isdigit()}), True, True),
+        (Route(["d"], {"OBX-3": "B"}), True, False),
+        (Route(["d"], {"PV1-3": ""}), True, True),  # Missing segments are empty.
+    ]
+    for route, matches_oru, matches_adt in cases:
+        assert route.matches(peek_msh(oru), parse(oru) if route.needs_body else None) is matches_oru
+        assert route.matches(peek_msh(adt), parse(adt) if route.needs_body else None) is matches_adt
+    assert not Route(["d"], {"MSH-9.1": "ORU"}).needs_body
+    assert Route(["d"], {"OBX-3": "B"}).needs_body
+    with pytest.raises(InvalidHl7FieldReference):
+        Route(["d"], {"MSH": "x"})
+
+
+def test_router_fan_out_and_aggregation() -> None:
+    lab, ris, archive = Downstream(), Downstream(codes=[Acks.AR]), Downstream(delay=0.2)
+    destinations = [Destination("lab", '127.0.0.1', lab.server.port),
+                    Destination("ris", '127.0.0.1', ris.server.port),
+                    Destination("archive", '127.0.0.1', archive.server.port, wait_for_ack=False)]
+    with pytest.raises(ValueError):
+        Router([Route(["nowhere"])], destinations)
+    router = Router([Route(["lab"], {"MSH-9.1": "ORU"}),
+                     Route(["ris"], {"MSH-9.1": "ORM"}, final=True),
+                     Route(["lab", "archive"], {"MSH-3": "LIS"})],
+                    destinations, unrouted=Acks.AR)
+    assert [d.name for d in router.route(message("ORU^R01"))] == ["lab", "archive"]
+    assert [d.name for d in router.route(message("ORM^O01"))] == ["ris"]
+    assert router.route(b"junk") == []
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        server = MllpServer(0, router, auto_ack=AckPolicy.AfterCallback, executor=executor)
+        server.listen()
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        c = MllpClient()
+        c.connect(host='127.0.0.1', port=server.port)
+        codes = []
+        for m in (message("ORU^R01", control_id="1"), message("ORM^O01", control_id="2"),
+                  message("ORM^O01", control_id="3"), message("ADT^A01", sender="ADT", control_id="4")):
+            start = time.monotonic()
+            c.send(m)
+            codes.append(peek_msa(c.recv())[1])
+            assert time.monotonic() - start < 0.2  # The slow archive is not waited for.
+        assert codes == ["AA", "AR", "AA", "AR"]
+        c.close()
+        server.shutdown()
+        thread.join(timeout=5)
+    # The server can wait for the future of the outcome itself.
+    server = MllpServer(0, router.submit, auto_ack=AckPolicy.AfterCallback)
+    server.listen()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    c = MllpClient()
+    c.connect(host='127.0.0.1', port=server.port)
+    c.send(message("ORU^R01", control_id="5"))
+    assert peek_msa(c.recv())[1] == "AA"
+    c.close()
+    server.shutdown()
+    thread.join(timeout=5)
+    router.close(timeout=5)
+    assert [peek_msh(m)[10] for m in lab.received] == ["1", "5"]
+    assert [peek_msh(m)[10] for m in ris.received] == ["2", "3"]
+    assert [peek_msh(m)[10] for m in archive.received] == ["1", "5"]
+    assert (router.destinations["ris"].delivered, router.destinations["ris"].rejected) == (1, 1)
+    for downstream in (lab, ris, archive):
+        downstream.stop()
+
+
+def test_destination_retry_and_give_up() -> None:
+    flaky = Downstream(codes=[Acks.AE, Acks.AE])
+    destination = Destination("flaky", '127.0.0.1', flaky.server.port, retry_delay=0.01, max_attempts=3)
+    assert destination.enqueue(message("ORU^R01", control_id="1")).result(timeout=5) is Acks.AA
+    assert len(flaky.received) == 3
+    destination.close()
+    flaky.stop()
+    # Nobody listening anymore.
+    down = Destination("down", '127.0.0.1', flaky.server.port, retry_delay=0.01, max_attempts=2)
+    futures = [down.enqueue(message("ORU^R01", control_id=str(i))) for i in range(2)]
+    assert [f.result(timeout=5) for f in futures] == [Acks.AE, Acks.AE]
+    assert down.failed == 2
+    down.close()
+    stuck = Destination("stuck", '127.0.0.1', flaky.server.port, retry_delay=10, max_attempts=None)
+    futures = [stuck.enqueue(message("ORU^R01", control_id=str(i))) for i in range(3)]
+    stuck.close(timeout=0.1)
+    assert [f.result(timeout=1) for f in futures] == [Acks.AE] * 3
+
+
+def test_destination_survives_socket_errors(mocker) -> None:
+    downstream = Downstream()
+    destination = Destination("d", '127.0.0.1', downstream.server.port, retry_delay=0.01, max_attempts=3)
+    assert destination.enqueue(message("ORU^R01", control_id="1")).result(timeout=5) is Acks.AA
+    # The socket breaks between two sends, and the first reconnection gets a
+    # socket that fails to be configured.
+    destination.client.socket.shutdown(socket.SHUT_RDWR)
+    create_connection = socket.create_connection
+    broken = mocker.Mock()
+    broken.settimeout.side_effect = OSError("Bad file descriptor")
+    connections = []
+
+    def connect(*args, **kwargs):
+        connections.append(args)
+        return broken if len(connections) == 1 else create_connection(*args, **kwargs)
+
+    mocker.patch("socket.create_connection", side_effect=connect)
+    assert destination.enqueue(message("ORU^R01", control_id="2")).result(timeout=5) is Acks.AA
+    assert len(connections) == 2
+    assert broken.close.called
+    assert destination.delivered == 2
+    destination.close(timeout=5)
+    downstream.stop()
+
+
+def test_stalled_destination_does_not_block_the_server() -> None:
+    stalled = socket.create_server(('127.0.0.1', 0))  # Accepts connections, never reads.
+    ok = Downstream()
+    destinations = [Destination("stalled", '127.0.0.1', stalled.getsockname()[1], queue_size=1,
+                                ack_timeout=0.5, max_attempts=None),
+                    Destination("ok", '127.0.0.1', ok.server.port)]
+    router = Router([Route(["stalled"], {"MSH-3": "SLOW"}), Route(["ok"], {"MSH-3": "LIS"})], destinations)
+    server = MllpServer(0, router.submit, auto_ack=AckPolicy.AfterCallback)
+    server.listen()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # The messages of a connection wait for the ACK of the one before, so the
+    # stalled destination is fed from several.
+    senders = [MllpClient() for _ in range(3)]
+    waits = [lambda: destinations[0].client.is_connected(),  # Being sent,
+             lambda: destinations[0].backlog() == 1,  # queued,
+             lambda: destinations[0].failed == 1]  # and doesn't fit.
+    for i, (sender, wait) in enumerate(zip(senders, waits)):
+        sender.connect(host='127.0.0.1', port=server.port)
+        sender.send(message("ORU^R01", sender="SLOW", control_id=str(i)))
+        deadline = time.monotonic() + 5
+        while not wait() and time.monotonic() < deadline:
+            time.sleep(0.01)
+    c = MllpClient()
+    c.connect(host='127.0.0.1', port=server.port)
+    c.socket.settimeout(5)
+    c.send(message("ORU^R01", control_id="3"))
+    assert peek_msa(c.recv())[1] == "AA"
+    senders[2].socket.settimeout(5)
+    assert peek_msa(senders[2].recv())[1] == "AE"
+    c.close()
+    for sender in senders:
+        sender.close()
+    server.shutdown()
+    thread.join(timeout=5)
+    router.close(timeout=0)
+    assert destinations[0].failed == 3
+    stalled.close()
+    ok.stop()
+
+
+def test_destination_survives_unexpected_errors(mocker) -> None:
+    downstream = Downstream()
+    destination = Destination("d", '127.0.0.1', downstream.server.port)
+    mocker.patch.object(destination, "_exchange", side_effect=[RuntimeError("Bug"), "AA"])
+    assert destination.enqueue(message("ORU^R01", control_id="1")).result(timeout=5) is Acks.AE
+    assert destination.enqueue(message("ORU^R01", control_id="2")).result(timeout=5) is Acks.AA
+    assert (destination.delivered, destination.failed) == (1, 1)
+    destination.close(timeout=5)
+    downstream.stop()
@@ -0,0 +1,61 @@
+import pytest
+from src.hl7lw import Hl7Parser
+from src.hl7lw.template import Hl7Template
+from src.hl7lw.exceptions import InvalidHl7Template
+
+
+def test_render() -> None:
+    t = Hl7Template("PID|||{mrn}^^^{issuer}||{name}")
+    assert t.slot_names == ['mrn', 'issuer', 'name']
+    assert t.render(mrn="1234", issuer="EPIC", name="Smith^John") == "PID|||1234^^^EPIC||Smith^John"
+    assert t.render(mrn=1234) == "PID|||1234^^^||"
+
+
+def test_escape_by_position() -> None:
+    t = Hl7Template("ZZZ|{field}|{rep1}~{rep2}|{comp}^x|{sub}&x^y|{raw:raw}")
+    rendered = t.render(field="a^b~c|d", rep1="a^b~c", rep2="e", comp="a^b~c&d", sub="a^b&c", raw="a|b")
+    assert rendered == "ZZZ|a^b~c\\F\\d|a^b\\R\\c~e|a\\S\\b\\R\\c&d^x|a\\S\\b\\T\\c&x^y|a|b"
+    assert t.render(field="a\rb") == "ZZZ|a\\X0D\\b|~|^x|&x^y|"
+
+
+def test_braces() -> None:
+    t = Hl7Template("ZZZ|{{literal}}|{value}")
+    assert t.render(value="v") == "ZZZ|{literal}|v"
+    with pytest.raises(InvalidHl7Template):
+        Hl7Template("ZZZ|{oops")
+    with pytest.raises(InvalidHl7Template):
+        Hl7Template("ZZZ|{not a slot}")
+
+
+def test_msh_template() -> None:
+    t = Hl7Template("MSH|^~\\&|{app}|{facility}\rMSA|{code}\r")
+    assert t.render(app="a|b", facility="f", code="AA") == "MSH|^~\\&|a\\F\\b|f\rMSA|AA\r"
+    with pytest.raises(InvalidHl7Template):
+        Hl7Template("MSH|{encoding}|app")
+    with pytest.raises(InvalidHl7Template):
+        Hl7Template("{name}|1|2")
+
+
+def test_msh_defines_separators() -> None:
+    t = Hl7Template("MSH#!~\\&#{app}#{comp}!x")
+    assert t.render(app="a#b!c", comp="a!b") == "MSH#!~\\&#a\\F\\b!c#a\\S\\b!x"
+
+
+def test_for_parser() -> None:
+    t = Hl7Template("PID|||{mrn}^^^{issuer}")
+    assert t.for_parser(None) is t
+    assert t.for_parser(Hl7Parser()) is t
+    p = Hl7Parser(ignore_msh_values_for_parsing=True)
+    p.field_separator = '#'
+    p.component_separator = '!'
+    retargeted = t.for_parser(p)
+    assert retargeted is t.for_parser(p), "Retargeted templates are cached"
+    assert retargeted.render(mrn="1!2", issuer="EPIC") == "PID###1\\S\\2!!!EPIC"
+
+
+def test_from_fields() -> None:
+    t = Hl7Template.from_fields('PV1', {2: 'patient_class', 5: 'visit'})
+    assert t.render(patient_class="E") == "PV1||E|||"
+    assert t.render_bytes(patient_class="E", visit="1|2") == b"PV1||E|||1\\F\\2"
+    with pytest.raises(InvalidHl7Template):
+        Hl7Template.from_fields('MSH', {3: 'app'})
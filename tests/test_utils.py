@@ -1,11 +1,23 @@
+import pytest
 from freezegun import freeze_time
 import datetime
-from src.hl7lw import Hl7Message, Hl7Segment, Hl7Parser, utils
+from src.hl7lw import Hl7Message, Hl7Segment, Hl7Parser, ids, utils
+from src.hl7lw.exceptions import InvalidHl7Message
 
 
 CONSTANT_TIME = datetime.datetime(year=2024, month=7, day=12, hour=15, minute=6, second=3)
 
 
+@pytest.fixture(autouse=True)
+def timestamp_ids():
+    # The samples were made with the timestamp and random IDs, pinned with the clock
+    # and random.randint.
+    previous = ids.get_default_generator()
+    ids.set_default_generator(ids.TimestampRandomIdGenerator())
+    yield
+    ids.set_default_generator(previous)
+
+
 @freeze_time(CONSTANT_TIME)
 def test_ack(mocker, trivial_a08: bytes, expected_ack: bytes) -> None:
     p = Hl7Parser()
@@ -125,4 +137,61 @@ def test_orm_builder_full(mocker, full_orm: bytes):
             )
         )
     ).build(parser=p)
-    assert p.format_message(orm, encoding="ascii") == full_orm
\ No newline at end of file
+    assert p.format_message(orm, encoding="ascii") == full_orm
+
+@freeze_time(CONSTANT_TIME)
+def test_orm_builder_render(mocker, empty_orm: bytes):
+    mocker.patch("random.randint", return_value=999999)
+    builder = utils.OrmBuilder(
+        sending_application="sa",
+        sending_facility="sf",
+        receiving_application="ra",
+        receiving_facility="rf",
+        hl7_version="2.4",
+        processing_mode=utils.ProcessingMode.Training
+    )
+    assert builder.render(encoding="ascii") == empty_orm
+    assert builder.render() == empty_orm.decode("ascii")
+
+
+@freeze_time(CONSTANT_TIME)
+def test_ack_bytes(mocker, trivial_a08: bytes, expected_ack: bytes) -> None:
+    mocker.patch("random.randint", return_value=999999)
+    assert utils.generate_ack_bytes(trivial_a08, utils.Acks.AA) == expected_ack
+    p = Hl7Parser()
+    a = p.parse_message(utils.generate_ack_bytes(trivial_a08, utils.Acks.AE, details="bad|input"))
+    assert a["MSA-1"] == "AE"
+    assert a["MSA-3"] == "bad\\F\\input"
+
+
+def test_ack_bytes_matches_generate_ack() -> None:
+    p = Hl7Parser()
+    for message in (b"MSH|^~\\&|A|B|C|D|20240101||ADT^A01|123|P\rPID|\r",
+                    b"MSH#!~\\&#A#B#C#D#20240101#SEC#ADT!A01#123\rPID#\r",
+                    b"MSH|^~\\&|A|B|C|D\rPID|\r"):
+        a = utils.generate_ack_bytes(message, utils.Acks.AR, id_generator=lambda: "X")
+        expected = p.format_message(utils.generate_ack(p.parse_message(message), utils.Acks.AR,
+                                                       id_generator=lambda: "X"),
+                                    encoding="ascii")
+        assert a == expected
+
+
+def test_peek_msh(trivial_a08: bytes) -> None:
+    msh = utils.peek_msh(trivial_a08)
+    assert msh.name == 'MSH'
+    assert msh[10] == '203550'
+    assert utils.peek_msh(trivial_a08.decode('ascii'))[10] == '203550'
+    assert utils.peek_msh(b"MSH|^~\\&|A\nPID|")[3] == 'A'
+    with pytest.raises(InvalidHl7Message):
+        utils.peek_msh(b"PID|1|2\r")
+
+
+def test_peek_msa(expected_ack: bytes) -> None:
+    assert utils.peek_msa(expected_ack)[1] == 'AA'
+    assert utils.peek_msa(memoryview(expected_ack))[2] == '203550'
+    # Only the MSA segment is decoded, what follows it doesn't matter.
+    ack = b"MSH|^~\\&|A|B|C|D|||ACK|1|P|2.3\rMSA|AE|42|bad\rERR|\xff\xfe\r"
+    assert utils.peek_msa(ack)[3] == 'bad'
+    assert utils.peek_msa(ack.replace(b"\r", b"\n"))[2] == '42'
+    with pytest.raises(InvalidHl7Message):
+        utils.peek_msa(b"MSH|^~\\&|A|B|C|D|||ACK|1|P|2.3\rPID|1\r")